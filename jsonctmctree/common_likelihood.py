@@ -9,14 +9,19 @@ linear combinations of labeled transitions on edges.
 from __future__ import division, print_function, absolute_import
 
 import sys
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 from numpy.testing import assert_equal
 
-from .node_ordering import get_node_evaluation_order
+from .node_ordering import (
+        get_node_evaluation_order, get_node_evaluation_levels)
+from .common_patterns import get_unique_rows
 
 __all__ = [
         'create_indicator_array',
+        'create_compact_indicator_array',
+        'get_observation_index',
         'get_conditional_likelihoods',
         'get_subtree_likelihoods',
         ]
@@ -92,6 +97,166 @@ def create_indicator_array(
     return obs
 
 
+def create_compact_indicator_array(
+        node,
+        state_space_shape,
+        observable_nodes,
+        observable_axes,
+        iid_observations):
+    """
+    Create a compact representation of the observation indicator array.
+
+    The observations at a node take only a few distinct values across sites.
+    For example if a single variable with k states is observed at the node,
+    then the indicator array has at most k+1 distinct columns,
+    one per observed state plus one for missing data.
+
+    Returns
+    -------
+    columns : 2d ndarray of shape (nstates, ncodes)
+        The distinct columns of the observation indicator array.
+    codes : 1d integer ndarray of shape (nsites, )
+        Maps each site to its column, so that columns[:, codes]
+        is equal to the output of create_indicator_array.
+
+    """
+    nstates = np.prod(state_space_shape)
+    nsites, nobservables = iid_observations.shape
+
+    # Find the distinct combinations of observations at the node.
+    local_observables = np.flatnonzero(observable_nodes == node)
+    local_observations = iid_observations[:, local_observables]
+    unique_observations, codes, counts = get_unique_rows(local_observations)
+
+    # Create the indicator array only for the distinct combinations.
+    columns = create_indicator_array(
+            node,
+            state_space_shape,
+            observable_nodes[local_observables],
+            observable_axes[local_observables],
+            unique_observations)
+    assert_equal(columns.shape[0], nstates)
+    return columns, codes
+
+
+def _expand_compact_array(columns, codes):
+    # A compact array without codes is already dense.
+    if codes is None:
+        return columns
+    return np.take(columns, codes, axis=1)
+
+
+def _multiply_compact_arrays(a_columns, a_codes, b_columns, b_codes):
+    """
+    Elementwise product of two arrays in compact form.
+
+    Sites whose pairs of codes are identical share a column of the product.
+    If too few sites share columns, then the product is dense.
+
+    """
+    if a_codes is not None and b_codes is not None:
+        pairs = np.column_stack((a_codes, b_codes))
+        unique_pairs, codes, counts = get_unique_rows(pairs)
+        if 2 * len(unique_pairs) <= len(codes):
+            columns = (
+                    np.take(a_columns, unique_pairs[:, 0], axis=1) *
+                    np.take(b_columns, unique_pairs[:, 1], axis=1))
+            return columns, codes
+    a = _expand_compact_array(a_columns, a_codes)
+    b = _expand_compact_array(b_columns, b_codes)
+    return a * b, None
+
+
+def get_observation_index(
+        nodes,
+        state_space_shape,
+        observable_nodes,
+        observable_axes,
+        iid_observations):
+    """
+    Precompute the compact observation indicator arrays of the nodes.
+
+    The index is computed once per set of iid observations
+    and is then shared by the traversals and the derivative calculations,
+    instead of creating an indicator array each time a node is visited.
+
+    Parameters
+    ----------
+    nodes : sequence
+        The nodes to index.
+
+    Returns
+    -------
+    observation_index : dict
+        Maps each node to a (columns, codes) pair
+        as returned by create_compact_indicator_array,
+        or to None if the node has no observables.
+        The indicator array of a node without observables
+        would consist entirely of ones.
+
+    """
+    observed_nodes = set(np.asarray(observable_nodes).tolist())
+    observation_index = {}
+    for node in nodes:
+        if node in observed_nodes:
+            observation_index[node] = create_compact_indicator_array(
+                    node,
+                    state_space_shape,
+                    observable_nodes,
+                    observable_axes,
+                    iid_observations)
+        else:
+            observation_index[node] = None
+    return observation_index
+
+
+def _get_compact_indicator_array(observation_index, node, nstates, nsites):
+    # Substitute a single column of ones for a node without observables.
+    compact = observation_index[node]
+    if compact is None:
+        columns = np.ones((nstates, 1), dtype=float)
+        codes = np.zeros(nsites, dtype=int)
+        compact = (columns, codes)
+    return compact
+
+
+def _get_indicator_array(observation_index, node):
+    # Return None for a node without observables.
+    compact = observation_index[node]
+    if compact is None:
+        return None
+    return _expand_compact_array(*compact)
+
+
+def _visit_in_postorder(visit, T, root, nworkers=1):
+    """
+    Call visit(node) for each node after calling it for the children.
+
+    With a single worker the nodes are visited serially in the order
+    of get_node_evaluation_order, which limits the number of arrays
+    that are simultaneously active.
+    Otherwise each level of get_node_evaluation_levels is visited
+    concurrently by a pool of threads, because numpy releases the GIL
+    for most of the work within each visit.
+    Each visit depends only on the visits of the children,
+    so the results do not depend on the number of workers.
+
+    """
+    if nworkers < 1:
+        raise ValueError('expected nworkers to be a positive integer')
+    if nworkers == 1:
+        for node in get_node_evaluation_order(T, root):
+            visit(node)
+        return
+    pool = ThreadPool(nworkers)
+    try:
+        for level in get_node_evaluation_levels(T, root):
+            pool.map(visit, level)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def get_subtree_likelihoods(
         f,
         store_all,
@@ -100,6 +265,9 @@ def get_subtree_likelihoods(
         observable_nodes,
         observable_axes,
         iid_observations,
+        compress_columns=False,
+        observation_index=None,
+        nworkers=1,
         ):
     """
     Compute likelihood arrays associated with nodes.
@@ -109,46 +277,109 @@ def get_subtree_likelihoods(
 
     The shape of each output array is (nstates, nsites).
 
+    If compress_columns is True, then sites that have identical data
+    in a subtree share a single column of the arrays of that subtree,
+    and only the distinct columns are propagated along edges.
+
+    The observation_index is as returned by get_observation_index;
+    it is computed here if it is not provided.
+
+    If nworkers is greater than 1, then independent subtrees
+    are evaluated concurrently by that many threads.
+
     """
     nstates = np.prod(state_space_shape)
+    nsites, nobservables = iid_observations.shape
 
     edge_to_rate = dict(edge_rate_pairs)
     edge_to_process = dict(edge_process_pairs)
 
+    if observation_index is None:
+        observation_index = get_observation_index(
+                T,
+                state_space_shape,
+                observable_nodes,
+                observable_axes,
+                iid_observations)
+
     # For the few nodes that are active at a given point in the traversal,
     # we track a 2d array of shape (nstates, nsites).
+    # Leaves additionally track the compact form of their arrays.
     node_to_array = {}
-    for node in get_node_evaluation_order(T, root):
+    leaf_to_compact_array = {}
+    node_to_compact_array = {}
+    def visit(node):
+
+        # Track the distinct columns of the active arrays,
+        # expanding them only for the arrays that are stored.
+        # The observational likelihood array of a node without observables
+        # is not multiplied in, because it consists entirely of ones.
+        if compress_columns:
+            compact = observation_index[node]
+            for child in T.successors(node):
+                edge = (node, child)
+                edge_rate = edge_to_rate[edge]
+                edge_process = edge_to_process[edge]
+                child_columns, child_codes = node_to_compact_array.pop(child)
+                child_columns = f[edge_process].expm_mul(
+                        edge_rate, child_columns)
+                if compact is None:
+                    compact = (child_columns, child_codes)
+                else:
+                    compact = _multiply_compact_arrays(
+                            compact[0], compact[1], child_columns, child_codes)
+            if compact is None:
+                compact = _get_compact_indicator_array(
+                        observation_index, node, nstates, nsites)
+            node_to_compact_array[node] = compact
+            if store_all or node == root:
+                node_to_array[node] = _expand_compact_array(*compact)
+            return
 
         # When a node is activated, its associated array
         # is initialized to its observational likelihood array.
-        arr = create_indicator_array(
-                node,
-                state_space_shape,
-                observable_nodes,
-                observable_axes,
-                iid_observations)
+        if node != root and not T.out_degree(node):
+            leaf_to_compact_array[node] = _get_compact_indicator_array(
+                    observation_index, node, nstates, nsites)
+        arr = _get_indicator_array(observation_index, node)
 
         # Multiplicatively accumulate over outgoing edges.
         for child in T.successors(node):
             edge = (node, child)
             edge_rate = edge_to_rate[edge]
             edge_process = edge_to_process[edge]
-            child_arr = node_to_array[child]
 
-            child_edge_arr = f[edge_process].expm_mul(edge_rate, child_arr)
+            # The array of a leaf has only a few distinct columns,
+            # so the matrix exponential acts only on those columns.
+            if child in leaf_to_compact_array:
+                columns, codes = leaf_to_compact_array.pop(child)
+                child_edge_columns = f[edge_process].expm_mul(
+                        edge_rate, columns)
+                child_edge_arr = np.take(child_edge_columns, codes, axis=1)
+            else:
+                child_arr = node_to_array[child]
+                child_edge_arr = f[edge_process].expm_mul(
+                        edge_rate, child_arr)
             
             #TODO check this
             #P = f[edge_process].expm_mul(edge_rate, np.identity(nstates))
             #child_edge_arr = child_arr.T.dot(P).T
 
-            arr *= child_edge_arr
+            if arr is None:
+                arr = child_edge_arr.copy() if store_all else child_edge_arr
+            else:
+                arr *= child_edge_arr
             if not store_all:
                 del node_to_array[child]
 
         # Associate the array with the current node.
+        if arr is None:
+            arr = np.ones((nstates, nsites), dtype=float)
         node_to_array[node] = arr
 
+    # Visit each node after its children.
+    _visit_in_postorder(visit, T, root, nworkers)
+
     # If we had been deleting arrays as they become unnecessary for
     # the log likelihood calculation, then we would have only
     # a single active array remaining at this point, corresponding to the root.
@@ -173,6 +404,9 @@ def get_conditional_likelihoods(
         observable_nodes,
         observable_axes,
         iid_observations,
+        compress_columns=False,
+        observation_index=None,
+        nworkers=1,
         ):
     """
     Recursively compute conditional likelihoods at the root.
@@ -189,6 +423,18 @@ def get_conditional_likelihoods(
         These functions compute expm_mul and rate_mul.
     store_all : bool
         Indicates whether all edge arrays should be stored.
+    compress_columns : bool, optional
+        Indicates whether sites that have identical data in a subtree
+        should share a single column of the arrays of that subtree,
+        so that only the distinct columns are propagated along edges.
+    observation_index : dict, optional
+        Maps nodes to compact observation indicator arrays,
+        as returned by get_observation_index.
+        It is computed here if it is not provided.
+    nworkers : int, optional
+        The number of threads used to evaluate independent subtrees
+        concurrently.  With the default single worker, the nodes are
+        evaluated serially in the order of get_node_evaluation_order.
 
     Returns
     -------
@@ -212,19 +458,70 @@ def get_conditional_likelihoods(
     edge_to_rate = dict(edge_rate_pairs)
     edge_to_process = dict(edge_process_pairs)
 
+    if observation_index is None:
+        observation_index = get_observation_index(
+                T,
+                state_space_shape,
+                observable_nodes,
+                observable_axes,
+                iid_observations)
+
     # For the few nodes that are active at a given point in the traversal,
     # we track a 2d array of shape (nsites, nstates).
     node_to_array = {}
-    for node in get_node_evaluation_order(T, root):
+    node_to_compact_array = {}
+    def visit(node):
+
+        # Track the distinct columns of the active arrays,
+        # expanding them only for the arrays that are stored.
+        # The observational likelihood array of a node without observables
+        # is not multiplied in, because it consists entirely of ones.
+        if compress_columns:
+            compact = observation_index[node]
+            for child in T.successors(node):
+                child_columns, child_codes = node_to_compact_array.pop(child)
+                if compact is None:
+                    compact = (child_columns, child_codes)
+                else:
+                    compact = _multiply_compact_arrays(
+                            compact[0], compact[1], child_columns, child_codes)
+            if compact is None:
+                compact = _get_compact_indicator_array(
+                        observation_index, node, nstates, nsites)
+            columns, codes = compact
+            if node != root:
+                edge = child_to_edge[node]
+                edge_rate = edge_to_rate[edge]
+                edge_process = edge_to_process[edge]
+                columns = expm_objects[edge_process].expm_mul(
+                        edge_rate, columns)
+            node_to_compact_array[node] = (columns, codes)
+            if store_all or node == root:
+                arr = _expand_compact_array(columns, codes)
+                assert_equal(arr.shape, (nstates, nsites))
+                node_to_array[node] = arr
+            return
+
+        # At a leaf the observational likelihood array has only a few
+        # distinct columns, so the matrix exponential associated with
+        # the parent edge acts only on those columns,
+        # and the columns are then gathered according to the observations.
+        if node != root and not T.out_degree(node):
+            columns, codes = _get_compact_indicator_array(
+                    observation_index, node, nstates, nsites)
+            edge = child_to_edge[node]
+            edge_rate = edge_to_rate[edge]
+            edge_process = edge_to_process[edge]
+            columns = expm_objects[edge_process].expm_mul(edge_rate, columns)
+            arr = np.take(columns, codes, axis=1)
+            assert_equal(arr.shape, (nstates, nsites))
+            node_to_array[node] = arr
+            return
 
         # When a node is activated, its associated array
-        # is initialized to its observational likelihood array.
-        arr = create_indicator_array(
-                node,
-                state_space_shape,
-                observable_nodes,
-                observable_axes,
-                iid_observations)
+        # is initialized to its observational likelihood array,
+        # unless the node has no observables.
+        arr = _get_indicator_array(observation_index, node)
 
         # When an internal node is activated,
         # this newly activated observational array is elementwise multiplied
@@ -237,9 +534,15 @@ def get_conditional_likelihoods(
         # their associated arrays, but because we want to re-use the
         # per-node arrays for edge length gradients, we keep them.
         for child in T.successors(node):
-            arr *= node_to_array[child]
+            child_arr = node_to_array[child]
+            if arr is None:
+                arr = child_arr.copy() if store_all else child_arr
+            else:
+                arr *= child_arr
             if not store_all:
                 del node_to_array[child]
+        if arr is None:
+            arr = np.ones((nstates, nsites), dtype=float)
 
         # When any node that is not the root is activated,
         # the matrix product P.dot(A) replaces A,
@@ -255,6 +558,9 @@ def get_conditional_likelihoods(
         assert_equal(arr.shape, (nstates, nsites))
         node_to_array[node] = arr
 
+    # Visit each node after its children.
+    _visit_in_postorder(visit, T, root, nworkers)
+
     # If we had been deleting arrays as they become unnecessary for
     # the log likelihood calculation, then we would have only
     # a single active array remaining at this point, corresponding to the root.
@@ -0,0 +1,62 @@
+"""
+Code that is common for finding repeated patterns in integer arrays.
+
+For example, an alignment may have tens of thousands of columns
+but only a few thousand distinct observation patterns.
+Likelihood calculations need to be done only once per distinct pattern.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+from numpy.testing import assert_equal
+
+__all__ = ['get_unique_rows']
+
+
+def get_unique_rows(A):
+    """
+    Find the distinct rows of a 2d integer array.
+
+    This is like np.unique(A, axis=0, return_inverse=True, return_counts=True)
+    except that it also works for arrays with zero rows or zero columns.
+
+    Parameters
+    ----------
+    A : 2d integer ndarray
+        The array whose rows may be repeated.
+
+    Returns
+    -------
+    unique_rows : 2d ndarray
+        The distinct rows of A, in lexicographic order.
+    inverse : 1d integer ndarray
+        Indices such that unique_rows[inverse] is equal to A.
+    counts : 1d integer ndarray
+        The number of times each distinct row appears in A.
+
+    """
+    A = np.asarray(A)
+    assert_equal(len(A.shape), 2)
+    nrows, ncols = A.shape
+
+    # Every row of an array with no columns is the same empty row.
+    if not nrows:
+        return A, np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    if not ncols:
+        return A[:1], np.zeros(nrows, dtype=int), np.array([nrows])
+
+    # Sort the rows lexicographically, with the first column as primary key,
+    # and flag each row that differs from its predecessor.
+    order = np.lexsort(A.T[::-1])
+    A_sorted = A[order]
+    flags = np.empty(nrows, dtype=bool)
+    flags[0] = True
+    flags[1:] = np.any(A_sorted[1:] != A_sorted[:-1], axis=1)
+
+    # Each row is assigned to the group of its distinct representative.
+    groups = np.cumsum(flags) - 1
+    inverse = np.empty(nrows, dtype=int)
+    inverse[order] = groups
+    counts = np.bincount(groups)
+    return A_sorted[flags], inverse, counts
@@ -8,6 +8,7 @@ from numpy.testing import assert_equal
 
 __all__ = [
         'sparse_reduction',
+        'get_pattern_weights',
         'apply_prefixed_reductions',
         'apply_reductions',
         ]
@@ -41,7 +42,42 @@ def sparse_reduction(A, indices, weights, axis):
             axes=([axis], [0]))
 
 
-def apply_prefixed_reductions(state_space_shape, custom_prefix, req, out):
+def get_pattern_weights(req, pattern_inverse, pattern_counts):
+    """
+    Fold the observation reduction of a request onto observation patterns.
+
+    Parameters
+    ----------
+    req : request object
+        The request whose observation reduction is of interest.
+    pattern_inverse : 1d integer ndarray
+        Maps each iid observation to the index of its pattern.
+    pattern_counts : 1d integer ndarray
+        The number of iid observations that share each pattern.
+
+    Returns
+    -------
+    pattern_weights : 1d ndarray or None
+        One weight per pattern, or None if the observation axis
+        of the request is not reduced.
+
+    """
+    observation_code = req.property[0]
+    if observation_code == 's':
+        return np.asarray(pattern_counts, dtype=float)
+    elif observation_code == 'w':
+        indices = req.observation_reduction.observation_indices
+        weights = req.observation_reduction.weights
+        return np.bincount(
+                np.take(pattern_inverse, indices),
+                weights=weights,
+                minlength=len(pattern_counts))
+    else:
+        return None
+
+
+def apply_prefixed_reductions(state_space_shape, custom_prefix, req, out,
+        pattern_weights=None):
     """
     Apply reductions using a custom prefix.
 
@@ -50,6 +86,12 @@ def apply_prefixed_reductions(state_space_shape, custom_prefix, req, out):
     then this function could be called with some letter other than
     {'d', 'n', 's', 'w'} at that position.
 
+    If the observation axis of the input array runs over distinct
+    observation patterns rather than over iid observations,
+    then an 's' or 'w' observation reduction uses pattern_weights
+    as returned by get_pattern_weights,
+    and a 'd' observation axis is left for the caller to expand.
+
     """
     # Define the reduction codes.
     observation_code, edge_code, state_code = custom_prefix
@@ -60,6 +102,8 @@ def apply_prefixed_reductions(state_space_shape, custom_prefix, req, out):
     # Apply the observation reduction if any.
     if observation_code == 'd':
         reduction_axis += 1
+    elif observation_code in ('s', 'w') and pattern_weights is not None:
+        out = np.tensordot(out, pattern_weights, axes=([reduction_axis], [0]))
     elif observation_code == 's':
         out = np.sum(out, axis=reduction_axis)
     elif observation_code == 'w':
@@ -98,11 +142,12 @@ def apply_prefixed_reductions(state_space_shape, custom_prefix, req, out):
     return out
 
 
-def apply_reductions(state_space_shape, req, out):
+def apply_reductions(state_space_shape, req, out, pattern_weights=None):
     """
     Apply reductions using the prefix defined by the request object.
 
     """
     # Unpack the prefix that defines the reduction axes.
     prefix = req.property[:3]
-    return apply_prefixed_reductions(state_space_shape, prefix, req, out)
+    return apply_prefixed_reductions(state_space_shape, prefix, req, out,
+            pattern_weights=pattern_weights)
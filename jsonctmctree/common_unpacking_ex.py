@@ -12,11 +12,14 @@ import re
 import numpy as np
 import networkx as nx
 
+from .common_patterns import get_unique_rows
+
 __all__ = [
         'UnpackingError',
         'TopLevel',
         'interpret_root_prior',
         'interpret_tree',
+        'interpret_iid_observations',
         'request_regex',
         'gen_valid_extended_properties',
         ]
@@ -357,3 +360,20 @@ def interpret_tree(scene):
     edge_rate_pairs = zip(edges, scene.tree.edge_rate_scaling_factors)
     edge_process_pairs = zip(edges, scene.tree.edge_processes)
     return T, root, edges, edge_rate_pairs, edge_process_pairs
+
+
+def interpret_iid_observations(scene):
+    """
+    Compress the iid observations into distinct observation patterns.
+
+    Returns
+    -------
+    patterns : 2d integer ndarray
+        The distinct rows of the iid observations array.
+    pattern_inverse : 1d integer ndarray
+        Maps each iid observation to the index of its pattern.
+    pattern_counts : 1d integer ndarray
+        The number of iid observations that share each pattern.
+
+    """
+    return get_unique_rows(scene.observed_data.iid_observations)
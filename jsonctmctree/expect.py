@@ -21,7 +21,7 @@ from .expm_helpers import (
         ImplicitTransitionExpmFrechet,
         ImplicitDwellExpmFrechet)
 
-from .expm_helpers import create_dense_rate_matrix
+from .expm_helpers import create_dense_rate_matrix, _get_divided_differences
 
 from .node_ordering import get_node_evaluation_order
 
@@ -193,6 +193,96 @@ def get_edge_to_site_expectations(
     return edge_to_site_expectations
 
 
+def get_edge_to_site_expectation_stacks(
+        expm_frechet_stacks, node_to_marginal_distn,
+        node_to_subtree_array,
+        T, root, edges, edge_rate_pairs, edge_process_pairs,
+        ):
+    """
+    Compute the expectations of several linear combinations at once.
+
+    Each expm Frechet stack object provides the products
+    of one process for several directions,
+    so the head marginal distribution is divided by P dot L
+    only once per edge for all of the directions.
+
+    Returns
+    -------
+    edge_to_site_expectations : dict
+        Maps each edge to an array with shape (ndirections, nsites).
+
+    """
+    edge_to_rate = dict(edge_rate_pairs)
+    edge_to_process = dict(edge_process_pairs)
+    edge_to_site_expectations = {}
+    for edge in edges:
+        head_node, tail_node = edge
+        obj = expm_frechet_stacks[edge_to_process[edge]]
+        PR, KRs = obj.get_expm_frechet_products(
+                edge_to_rate[edge], node_to_subtree_array[tail_node])
+        A = node_to_marginal_distn[head_node] * pseudo_reciprocal(PR)
+        edge_to_site_expectations[edge] = np.array(
+                [(A * KR).sum(axis=0) for KR in KRs])
+    return edge_to_site_expectations
+
+
+def get_edge_to_site_dwell_times(
+        nsites, nstates,
+        spectral_factors, node_to_marginal_distn,
+        node_to_subtree_array,
+        T, root, edges, edge_rate_pairs, edge_process_pairs,
+        ):
+    """
+    Compute the expected dwell time in each state, on each edge, at each site.
+
+    The dwell times of all states are computed together from
+    a diagonalization Q = V diag(w) W of the rate matrix of each process,
+    using the closed form of Hobolth and Jensen.
+    The dwell time in state k on an edge with scaled eigenvalues a
+    is proportional to sum_ij alpha_i beta_j J_ij W_ik V_kj,
+    where alpha = V.T A for the scaled marginal distribution A
+    at the head of the edge, beta = W L for the subtree likelihoods L,
+    and J is the matrix of divided differences of exp at a.
+    Like the dwell expectations computed by expm Frechet products,
+    the dwell times are divided by the edge rate scaling factor,
+    and they are zero on edges whose rate is zero.
+
+    Returns
+    -------
+    edge_to_dwell_times : dict
+        Maps each edge to an array with shape (nstates, nsites).
+
+    """
+    edge_to_rate = dict(edge_rate_pairs)
+    edge_to_process = dict(edge_process_pairs)
+    edge_to_dwell_times = {}
+    for edge in edges:
+        head_node, tail_node = edge
+        edge_rate = edge_to_rate[edge]
+        if not edge_rate:
+            edge_to_dwell_times[edge] = np.zeros((nstates, nsites))
+            continue
+        V, w, W = spectral_factors[edge_to_process[edge]]
+        a = w * edge_rate
+
+        # Compute the joint P action once per edge.
+        L = node_to_subtree_array[tail_node]
+        beta = W.dot(L)
+        PL = V.dot(np.exp(a)[:, np.newaxis] * beta).real
+        A = node_to_marginal_distn[head_node] * pseudo_reciprocal(PL)
+        alpha = V.T.dot(A)
+
+        # Accumulate the dwell times of all states.
+        J = _get_divided_differences(a)
+        dwell = np.zeros((nstates, nsites), dtype=np.result_type(V, w, W))
+        for i in range(nstates):
+            Y = V.dot(J[i][:, np.newaxis] * beta)
+            dwell += W[i][:, np.newaxis] * alpha[i] * Y
+        edge_to_dwell_times[edge] = dwell.real
+
+    return edge_to_dwell_times
+
+
 def process_json_in(j_in, debug=False):
 
     if debug:
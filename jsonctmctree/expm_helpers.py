@@ -7,6 +7,9 @@ Some of these do precalculations, so they are not pure functions.
 from __future__ import division, print_function, absolute_import
 
 import sys
+import hashlib
+from collections import OrderedDict
+from threading import Lock
 
 import numpy as np
 from numpy.testing import assert_equal, assert_
@@ -18,16 +21,31 @@ from scipy.sparse import coo_matrix
 from .pyexp import expm_multiply
 from .pyexp.ctmc_ops import (
         Propagator, SmarterPropagator, ExplicitPropagator,
-        MatrixExponential, RdOperator)
+        MatrixExponential, RdOperator, RdcOperator, RdCOperator,
+        RdCStackOperator, CacheInfo)
 from .pyexp.linear_system import LinearSystem
+from .pyexp.cost_model import get_default_cost_model
+from .pyexp.kronecker import decompose_kronecker_sum
 
 
 __all__ = [
-        'PadeExpm', 'EigenExpm', 'ActionExpm',
+        'PadeExpm', 'EigenExpm', 'ActionExpm', 'ReversibleExpm',
         'ExplicitExpmFrechet',
+        'SpectralExpmFrechet',
+        'ReversibleExpmFrechet',
         'ImplicitDwellExpmFrechet',
         'ImplicitTransitionExpmFrechet',
         'ImplicitTransitionExpmFrechetEx',
+        'SpectralExpmFrechetStack',
+        'ImplicitTransitionExpmFrechetStack',
+        'get_reversible_stationary_distribution',
+        'get_spectral_factors',
+        'create_expm_object',
+        'create_dwell_expm_frechet',
+        'create_transition_expm_frechet',
+        'create_transition_expm_frechet_stack',
+        'ExpmObjectRegistry',
+        'get_registered_expm_object',
         ]
 
 
@@ -145,6 +163,25 @@ class EigenExpm(object):
         return rate_scaling_factor * self.Q.dot(PA)
 
 
+def _get_kronecker_structure(state_space_shape, row, col, rate, R,
+        cost_model=None):
+    # For multivariate processes, use the Kronecker sum structure
+    # of the rates if it accounts for most of the transitions
+    # and if the cost model predicts that its products are cheaper
+    # than the products with the sparse pre-rate matrix R.
+    if len(state_space_shape) < 2:
+        return None
+    structure = decompose_kronecker_sum(state_space_shape, row, col, rate)
+    if 2 * structure.residual.nnz > structure.nnz:
+        return None
+    if cost_model is None:
+        cost_model = get_default_cost_model()
+    if not cost_model.prefer_kronecker(
+            R.nnz, *structure.get_matmat_flops()):
+        return None
+    return structure
+
+
 class ActionExpm(object):
     """
     This uses a newer implementation of the matrix exponential vector product.
@@ -154,9 +191,42 @@ class ActionExpm(object):
     exponential approach.
 
     """
-    def __init__(self, state_space_shape, row, col, rate, debug=False):
-        R = create_sparse_pre_rate_matrix(state_space_shape, row, col, rate)
-        self._L = LinearSystem(R)
+    def __init__(self, state_space_shape, row, col, rate, debug=False,
+            cost_model=None):
+        R = create_sparse_pre_rate_matrix(
+                state_space_shape, row, col, rate).tocsr()
+        structure = _get_kronecker_structure(
+                state_space_shape, row, col, rate, R, cost_model=cost_model)
+        self._L = LinearSystem(R, cost_model=cost_model, structure=structure)
+
+    def cache_info(self):
+        """
+        Report hits and misses of the cache of explicit transition matrices.
+
+        Returns None if the matrix exponential is not computed explicitly.
+
+        """
+        P = self._L.propagator
+        if hasattr(P, 'cache_info'):
+            return P.cache_info()
+        return None
+
+    def prefetch(self, rate_scaling_factors, ncols=None):
+        """
+        Precompute the transition matrices for several edges at once.
+
+        First the cost model chooses between the explicit
+        and the abstract strategy for these edges and this number of columns.
+        If the matrix exponential is not computed explicitly then
+        this selects the iteration counts of the matrix exponential
+        vector products instead.
+
+        """
+        P = self._L.select_propagator(rate_scaling_factors, ncols)
+        if isinstance(P, Propagator):
+            P.prefetch(rate_scaling_factors, ncols or 1)
+        elif hasattr(P, 'prefetch'):
+            P.prefetch(rate_scaling_factors)
 
     def expm_rmul(self, rate_scaling_factor, A):
         """
@@ -225,6 +295,208 @@ class ActionExpmOld(object):
         return rate_scaling_factor * self.Q.dot(PA)
 
 
+def get_reversible_stationary_distribution(Q):
+    """
+    Find a positive distribution in detailed balance with a rate matrix.
+
+    Parameters
+    ----------
+    Q : 2d ndarray
+        A dense rate matrix whose rows sum to zero.
+
+    Returns
+    -------
+    distn : 1d ndarray or None
+        A positive stationary distribution that satisfies detailed balance
+        distn[i] * Q[i, j] == distn[j] * Q[j, i],
+        or None if no such distribution was found.
+
+    """
+    n = Q.shape[0]
+    if not n:
+        return None
+    A = np.vstack((Q.T, np.ones(n)))
+    b = np.zeros(n+1)
+    b[-1] = 1
+    # An explicit rcond works with numpy before and after 1.14.
+    distn = np.linalg.lstsq(A, b, rcond=-1)[0]
+    if not np.all(distn > 0):
+        return None
+    F = distn[:, np.newaxis] * Q
+    atol = np.ldexp(1, -40) * max(np.abs(F).max(), 1)
+    if not np.allclose(F, F.T, rtol=1e-8, atol=atol):
+        return None
+    return distn
+
+
+class ReversibleExpm(object):
+    """
+    Use a symmetric eigendecomposition of a time-reversible rate matrix.
+
+    The rate matrix Q is in detailed balance with a positive stationary
+    distribution pi, so S = diag(pi)^(1/2) Q diag(pi)^(-1/2) is symmetric.
+    Its spectral decomposition S = U diag(w) U.T is computed once,
+    after which Q = V diag(w) W with V = diag(pi)^(-1/2) U and W = inv(V).
+    Each edge costs one diagonal scaling and two dense products.
+    The condition number of V is sqrt(max(pi) / min(pi)),
+    and the errors of the transition probabilities grow with its square,
+    so create_expm_object does not use this class if a stationary
+    probability is near zero.
+
+    """
+    def __init__(self, state_space_shape, row, col, rate, distn=None):
+        self.Q = create_dense_rate_matrix(state_space_shape, row, col, rate)
+        if distn is None:
+            distn = get_reversible_stationary_distribution(self.Q)
+        if distn is None:
+            raise ValueError('expected a time-reversible rate matrix')
+        s = np.sqrt(distn)
+        S = s[:, np.newaxis] * self.Q / s
+        self.w, U = scipy.linalg.eigh((S + S.T) / 2)
+        self.V = U / s[:, np.newaxis]
+        self.W = U.T * s
+
+    def expm_rmul(self, rate_scaling_factor, A):
+        """
+        Compute A * exp(Q * r).
+
+        """
+        if not rate_scaling_factor:
+            # The factors only approximate the identity,
+            # which would perturb zero transition probabilities.
+            return A.copy()
+        w_exp = np.exp(self.w * rate_scaling_factor)
+        return (A.dot(self.V) * w_exp).dot(self.W)
+
+    def expm_mul(self, rate_scaling_factor, A):
+        """
+        Compute exp(Q * r) * A.
+
+        """
+        if not rate_scaling_factor:
+            return A.copy()
+        w_exp = np.exp(self.w * rate_scaling_factor)
+        return self.V.dot(w_exp[:, np.newaxis] * self.W.dot(A))
+
+    def rate_mul(self, rate_scaling_factor, PA):
+        """
+        Compute Q * r * PA.
+        This is for gradient calculation.
+
+        """
+        if not rate_scaling_factor:
+            return np.zeros(PA.shape)
+        w_scaled = self.w * rate_scaling_factor
+        return self.V.dot(w_scaled[:, np.newaxis] * self.W.dot(PA))
+
+
+def _get_divided_differences(a):
+    # Divided differences of exp at the points a,
+    # with exp(a[i]) in place of the removable singularities.
+    # Each difference (exp(x) - exp(y)) / (x - y) is computed as
+    # exp(y) expm1(x - y) / (x - y) where y is the point with the larger
+    # real part, so that nothing overflows when the points are far apart.
+    # Points that nearly coincide use exp of their midpoint.
+    first = a[:, np.newaxis]
+    second = a[np.newaxis, :]
+    swap = first.real > second.real
+    x = np.where(swap, second, first)
+    y = np.where(swap, first, second)
+    delta = x - y
+    mask = np.abs(delta) > np.ldexp(1, -26)
+    safe_delta = np.where(mask, delta, 1)
+    ratio = np.where(mask, np.expm1(safe_delta) / safe_delta, 1)
+    return ratio * np.exp(np.where(mask, y, (x + y) / 2))
+
+
+class SpectralExpmFrechet(object):
+    """
+    Compute expm Frechet products using a diagonalization of Q.
+
+    This has the get_expm_frechet_product interface of the implicit
+    expm Frechet classes, for the block matrix
+
+    [[Q, E],
+     [0, Q]]
+
+    where E is a dense matrix of the same shape as Q
+    and Q = V diag(w) W.
+    The Frechet derivative is V ((W E V) o J) W
+    where J is the matrix of divided differences of exp
+    at the scaled eigenvalues.
+    The factors may be complex, in which case
+    the real parts of the products are returned.
+
+    """
+    def __init__(self, spectral_factors, E):
+        self.nstates = E.shape[0]
+        self._V, self._w, self._W = spectral_factors
+        self._G = self._W.dot(E).dot(self._V)
+        self._is_complex = np.iscomplexobj(self._G)
+
+    def get_expm_frechet_product(self, rate_scaling_factor, A):
+        """
+        Returns
+        -------
+        P dot A
+        K dot A
+
+        """
+        t = rate_scaling_factor
+        WA = self._W.dot(A)
+        a = self._w * t
+        PA = self._V.dot(np.exp(a)[:, np.newaxis] * WA)
+        J = _get_divided_differences(a)
+        KA = self._V.dot((self._G * t * J).dot(WA))
+        if self._is_complex:
+            return PA.real, KA.real
+        return PA, KA
+
+
+class SpectralExpmFrechetStack(object):
+    """
+    Compute expm Frechet products in several directions at once.
+
+    This is like SpectralExpmFrechet with a sequence of matrices E,
+    but the eigenbasis projection of A, the divided differences,
+    and the product P dot A are shared across the directions.
+
+    """
+    def __init__(self, spectral_factors, Es):
+        self.nstates = spectral_factors[0].shape[0]
+        self._V, self._w, self._W = spectral_factors
+        self._Gs = [self._W.dot(E).dot(self._V) for E in Es]
+        self._is_complex = any(np.iscomplexobj(x) for x in spectral_factors)
+
+    def get_expm_frechet_products(self, rate_scaling_factor, A):
+        """
+        Returns
+        -------
+        P dot A
+        list of K dot A, one for each direction
+
+        """
+        t = rate_scaling_factor
+        WA = self._W.dot(A)
+        a = self._w * t
+        PA = self._V.dot(np.exp(a)[:, np.newaxis] * WA)
+        tJ = t * _get_divided_differences(a)
+        KAs = [self._V.dot((G * tJ).dot(WA)) for G in self._Gs]
+        if self._is_complex:
+            return PA.real, [KA.real for KA in KAs]
+        return PA, KAs
+
+
+class ReversibleExpmFrechet(SpectralExpmFrechet):
+    """
+    Compute expm Frechet products using the factors of a ReversibleExpm.
+
+    """
+    def __init__(self, expm_object, E):
+        SpectralExpmFrechet.__init__(
+                self, (expm_object.V, expm_object.w, expm_object.W), E)
+
+
 class ExplicitExpmFrechet(object):
     """
     This is for computing conditional expectations on edges.
@@ -251,6 +523,35 @@ class ExplicitExpmFrechet(object):
 
 
 class ImplicitExpmFrechetBase(object):
+    """
+    The matrix to be exponentiated is block upper triangular.
+
+    [[R - D,   C  ],
+     [  0,   R - D]]
+
+    It is represented by a structured operator
+    (RdcOperator if C is diagonal, otherwise RdCOperator)
+    instead of a (2n, 2n) sparse matrix,
+    and its Propagator keeps the norm estimates and the iteration counts
+    across the edges that share the process.
+
+    """
+    def _init_propagator(self, R, C):
+        # R : sparse pre-rate matrix with shape (n, n)
+        # C : 1d array of diagonal entries or sparse matrix with shape (n, n)
+        self.nstates = R.shape[0]
+        R = R.tocsr()
+        exit_rates = R.sum(axis=1).A.flatten()
+        assert_equal(exit_rates.shape, (self.nstates, ))
+        d = -exit_rates
+        mu = np.mean(d)
+        Rd = RdOperator(R, d - mu)
+        if isinstance(C, np.ndarray):
+            op = RdcOperator(Rd, C)
+        else:
+            op = RdCOperator(Rd, C.tocsr())
+        self._propagator = Propagator(op, mu)
+
     def get_expm_frechet_product(self, rate_scaling_factor, A):
         """
         expm([[R - D, R o E],    A0
@@ -266,7 +567,7 @@ class ImplicitExpmFrechetBase(object):
 
         """
         AA = np.vstack((A, A))
-        BB = expm_multiply(self.F * rate_scaling_factor, AA)
+        BB = self._propagator._parameterized_matmat(rate_scaling_factor, AA)
         PA = BB[self.nstates:]
         KA = BB[:self.nstates] - PA
         return PA, KA
@@ -283,7 +584,7 @@ class ImplicitDwellExpmFrechet(ImplicitExpmFrechetBase):
     """
     def __init__(self, state_space_shape, row, col, rate, s_state, s_weight):
         """
-        Define a sparse rate matrix with shape (2n, 2n) where n is nstates.
+        Define an operator with shape (2n, 2n) where n is nstates.
 
         [[R - D,   E  ],
          [  0,   R - D]]
@@ -294,39 +595,13 @@ class ImplicitDwellExpmFrechet(ImplicitExpmFrechetBase):
         an algorithm by Al-Mohy et al.
 
         """
-        nstates = np.prod(state_space_shape)
-        self.nstates = nstates
-
-        # Initialize the upper-left sparse matrix.
-        Q00 = create_sparse_pre_rate_matrix(
-                state_space_shape, row, col, rate)
-        exit_rates = Q00.sum(axis=1).A.flatten()
-        assert_equal(exit_rates.shape, (nstates, ))
+        R = create_sparse_pre_rate_matrix(state_space_shape, row, col, rate)
 
-        # Initialize the upper-right sparse diagonal matrix.
-        Q01 = create_sparse_pre_rate_matrix(
+        # The upper-right block is diagonal.
+        E = create_sparse_pre_rate_matrix(
                 state_space_shape, s_state, s_state, s_weight)
-        Q01.col += nstates
-
-        # Define the diagonal entries of the upper-left sparse matrix.
-        Q00.row = np.concatenate((Q00.row, np.arange(nstates)))
-        Q00.col = np.concatenate((Q00.col, np.arange(nstates)))
-        Q00.data = np.concatenate((Q00.data, -exit_rates))
-        Q00.has_canonical_format = False
-
-        # Initialize the lower-right sparse matrix.
-        Q11 = Q00.copy()
-        Q11.row += nstates
-        Q11.col += nstates
-
-        # Define the full matrix to be exponentiated.
-        F_row = np.concatenate([Q00.row, Q01.row, Q11.row])
-        F_col = np.concatenate([Q00.col, Q01.col, Q11.col])
-        F_data = np.concatenate([Q00.data, Q01.data, Q11.data])
-        F = coo_matrix((F_data, (F_row, F_col)), (2*nstates, 2*nstates))
-
-        # Store the full matrix.
-        self.F = F
+        c = np.asarray(E.tocsr().diagonal(), dtype=float)
+        self._init_propagator(R, c)
 
 
 ##########################################################
@@ -350,7 +625,7 @@ class ImplicitTransitionExpmFrechet(ImplicitExpmFrechetBase):
     """
     def __init__(self, state_space_shape, row, col, rate, expect):
         """
-        Define a sparse rate matrix with shape (2n, 2n) where n is nstates.
+        Define an operator with shape (2n, 2n) where n is nstates.
 
         [[R - D, R o E],
          [  0,   R - D]]
@@ -361,39 +636,10 @@ class ImplicitTransitionExpmFrechet(ImplicitExpmFrechetBase):
         an algorithm by Al-Mohy et al.
 
         """
-        nstates = np.prod(state_space_shape)
-        self.nstates = nstates
-
-        # Initialize the upper-left sparse matrix.
-        Q00 = create_sparse_pre_rate_matrix(
-                state_space_shape, row, col, rate)
-        exit_rates = Q00.sum(axis=1).A.flatten()
-        assert_equal(exit_rates.shape, (nstates, ))
-
-        # Initialize the upper-right sparse matrix.
-        Q01 = create_sparse_pre_rate_matrix(
+        R = create_sparse_pre_rate_matrix(state_space_shape, row, col, rate)
+        RE = create_sparse_pre_rate_matrix(
                 state_space_shape, row, col, rate * expect)
-        Q01.col += nstates
-
-        # Define the diagonal entries of the upper-left sparse matrix.
-        Q00.row = np.concatenate((Q00.row, np.arange(nstates)))
-        Q00.col = np.concatenate((Q00.col, np.arange(nstates)))
-        Q00.data = np.concatenate((Q00.data, -exit_rates))
-        Q00.has_canonical_format = False
-
-        # Initialize the lower-right sparse matrix.
-        Q11 = Q00.copy()
-        Q11.row += nstates
-        Q11.col += nstates
-
-        # Define the full matrix to be exponentiated.
-        F_row = np.concatenate([Q00.row, Q01.row, Q11.row])
-        F_col = np.concatenate([Q00.col, Q01.col, Q11.col])
-        F_data = np.concatenate([Q00.data, Q01.data, Q11.data])
-        F = coo_matrix((F_data, (F_row, F_col)), (2*nstates, 2*nstates))
-
-        # Store the full matrix.
-        self.F = F
+        self._init_propagator(R, RE)
 
 
 class ImplicitTransitionExpmFrechetEx(ImplicitExpmFrechetBase):
@@ -405,7 +651,7 @@ class ImplicitTransitionExpmFrechetEx(ImplicitExpmFrechetBase):
             row, col, rate,
             expect_row, expect_col, expect_rate):
         """
-        Define a sparse rate matrix with shape (2n, 2n) where n is nstates.
+        Define an operator with shape (2n, 2n) where n is nstates.
 
         [[R - D, R o E],
          [  0,   R - D]]
@@ -426,39 +672,309 @@ class ImplicitTransitionExpmFrechetEx(ImplicitExpmFrechetBase):
             a sequence of floating point rates
 
         """
-        nstates = np.prod(state_space_shape)
-        self.nstates = nstates
+        R = create_sparse_pre_rate_matrix(state_space_shape, row, col, rate)
+
+        # Use sparse matrix elementwise multiplication.
+        E = create_sparse_pre_rate_matrix(
+                state_space_shape, expect_row, expect_col, expect_rate)
+        self._init_propagator(R, R.multiply(E))
+
+
+class ImplicitTransitionExpmFrechetStack(object):
+    """
+    Transition expectations for several transition reductions at once.
+
+    The operator has shape ((k+1)n, (k+1)n) where n is nstates
+    and k is the number of reductions E1, ..., Ek.
+
+    [[R - D,   0,   ...,   0,   R o E1],
+     [  0,   R - D, ...,   0,   R o E2],
+                    ...
+     [  0,     0,   ..., R - D, R o Ek],
+     [  0,     0,   ...,   0,   R - D ]]
 
-        # Initialize the upper-left sparse matrix.
+    A single action of its exponential on a stack of copies of A
+    gives P A in the last block and P A + Ki A in block i,
+    so the product P A and the norm estimates are shared
+    instead of using one (2n, 2n) operator per reduction.
+
+    """
+    def __init__(self, state_space_shape, row, col, rate, reductions):
+        """
+        Parameters
+        ----------
+        row : 2d integer array
+            a sequence of multivariate row states
+        col : 2d integer array
+            a sequence of multivariate col states
+        rate : 1d float array
+            a sequence of floating point rates
+        reductions : sequence
+            a (expect_row, expect_col, expect_rate) triple
+            for each transition reduction
+
+        """
+        R = create_sparse_pre_rate_matrix(state_space_shape, row, col, rate)
+        self.nstates = R.shape[0]
+        self.nreductions = len(reductions)
+        Cs = []
+        for expect_row, expect_col, expect_rate in reductions:
+            E = create_sparse_pre_rate_matrix(
+                    state_space_shape, expect_row, expect_col, expect_rate)
+            Cs.append(R.multiply(E).tocsr())
+        R = R.tocsr()
+        d = -R.sum(axis=1).A.flatten()
+        mu = np.mean(d)
+        Rd = RdOperator(R, d - mu)
+        self._propagator = Propagator(RdCStackOperator(Rd, Cs), mu)
+
+    def get_expm_frechet_products(self, rate_scaling_factor, A):
+        """
+        Returns
+        -------
+        P dot A
+        list of K dot A, one for each reduction
+
+        """
+        n = self.nstates
+        AA = np.vstack([A] * (self.nreductions + 1))
+        BB = self._propagator._parameterized_matmat(rate_scaling_factor, AA)
+        PA = BB[-n:]
+        KAs = [BB[i*n:(i+1)*n] - PA for i in range(self.nreductions)]
+        return PA, KAs
+
+
+##############################################################################
+# spectral factors for closed form expectations
+
+
+def get_spectral_factors(expm_object, state_space_shape, row, col, rate,
+        max_nstates=1000, max_condition_number=1e6):
+    """
+    Get a diagonalization Q = V diag(w) W of the rate matrix of a process.
+
+    The factors of a ReversibleExpm are real and are reused.
+    Otherwise the possibly complex eigendecomposition of the dense
+    rate matrix is used if its eigenvectors are well conditioned.
+
+    Parameters
+    ----------
+    expm_object : object
+        The expm object of the process, or None.
+    max_nstates : integer, optional
+        Larger state spaces are not diagonalized.
+    max_condition_number : float, optional
+        The largest accepted condition number of the eigenvectors.
+
+    Returns
+    -------
+    factors : tuple of ndarrays or None
+        The triple (V, w, W), or None if the rate matrix
+        is not diagonalized.
+
+    """
+    if isinstance(expm_object, ReversibleExpm):
+        return expm_object.V, expm_object.w, expm_object.W
+    nstates = np.prod(state_space_shape)
+    if nstates > max_nstates:
+        return None
+    Q = create_dense_rate_matrix(state_space_shape, row, col, rate)
+    w, V = scipy.linalg.eig(Q)
+    if not np.all(np.isfinite(V)):
+        return None
+    if np.linalg.cond(V) > max_condition_number:
+        return None
+    return V, w, np.linalg.inv(V)
+
+
+##############################################################################
+# choose an implementation for each process
+
+
+def create_expm_object(state_space_shape, row, col, rate,
+        debug=False, reversible_max_nstates=1000, cost_model=None,
+        reversible_max_condition_number=1e2):
+    """
+    Use the spectral decomposition of a time-reversible process if possible.
+
+    The decomposition is only tried if the cost model predicts that it is
+    cheaper than the sparse matrix exponential actions of ActionExpm,
+    before any dense matrix is created.
+    Otherwise, or if the state space is too large for dense matrices,
+    or if the eigenvectors of the decomposition are ill-conditioned
+    because some stationary probability is near zero, use ActionExpm.
+
+    """
+    nstates = np.prod(state_space_shape)
+    if nstates <= reversible_max_nstates:
+        if cost_model is None:
+            cost_model = get_default_cost_model()
+        R = create_sparse_pre_rate_matrix(
+                state_space_shape, row, col, rate).tocsr()
+        d = -R.sum(axis=1).A.ravel()
+        one_norm = RdOperator(R, d - np.mean(d)).one_norm()
+        if cost_model.prefer_spectral(nstates, R.nnz, one_norm):
+            Q = create_dense_rate_matrix(state_space_shape, row, col, rate)
+            distn = get_reversible_stationary_distribution(Q)
+            if distn is not None and (np.sqrt(distn.max() / distn.min()) <=
+                    reversible_max_condition_number):
+                return ReversibleExpm(
+                        state_space_shape, row, col, rate, distn)
+    return ActionExpm(state_space_shape, row, col, rate, debug=debug,
+            cost_model=cost_model)
+
+
+def create_dwell_expm_frechet(expm_object, state_space_shape,
+        row, col, rate, s_state, s_weight, spectral_factors=None,
+        spectral=True):
+    """
+    Create an object for the dwell expectations of a process.
+
+    If the process uses ReversibleExpm then its factors are reused.
+    Otherwise if spectral factors from get_spectral_factors are provided
+    then the expectations are computed in closed form from these factors.
+    If spectral is False then the implicit object is used regardless.
+
+    """
+    if spectral and isinstance(expm_object, ReversibleExpm):
+        E = create_sparse_pre_rate_matrix(
+                state_space_shape, s_state, s_state, s_weight).A
+        return ReversibleExpmFrechet(expm_object, E)
+    if spectral and spectral_factors is not None:
+        E = create_sparse_pre_rate_matrix(
+                state_space_shape, s_state, s_state, s_weight).A
+        return SpectralExpmFrechet(spectral_factors, E)
+    return ImplicitDwellExpmFrechet(
+            state_space_shape, row, col, rate, s_state, s_weight)
+
+
+def create_transition_expm_frechet(expm_object, state_space_shape,
+        row, col, rate, expect_row, expect_col, expect_rate,
+        spectral_factors=None, spectral=True):
+    """
+    Create an object for the transition expectations of a process.
+
+    If the process uses ReversibleExpm then its factors are reused.
+    Otherwise if spectral factors from get_spectral_factors are provided
+    then the expectations are computed in closed form from these factors.
+    If spectral is False then the implicit object is used regardless.
+
+    """
+    if spectral and (isinstance(expm_object, ReversibleExpm) or (
+            spectral_factors is not None)):
         Q00 = create_sparse_pre_rate_matrix(
                 state_space_shape, row, col, rate)
-        exit_rates = Q00.sum(axis=1).A.flatten()
-        assert_equal(exit_rates.shape, (nstates, ))
-
-        # Initialize the upper-right sparse matrix.
-        # Use sparse matrix elementwise multiplication.
         R = create_sparse_pre_rate_matrix(
                 state_space_shape, expect_row, expect_col, expect_rate)
-        Q01 = Q00.multiply(R).tocoo()
-        Q01.col += nstates
-        Q01.has_canonical_format = False
-
-        # Define the diagonal entries of the upper-left sparse matrix.
-        Q00.row = np.concatenate((Q00.row, np.arange(nstates)))
-        Q00.col = np.concatenate((Q00.col, np.arange(nstates)))
-        Q00.data = np.concatenate((Q00.data, -exit_rates))
-        Q00.has_canonical_format = False
-
-        # Initialize the lower-right sparse matrix.
-        Q11 = Q00.copy()
-        Q11.row += nstates
-        Q11.col += nstates
-
-        # Define the full matrix to be exponentiated.
-        F_row = np.concatenate([Q00.row, Q01.row, Q11.row])
-        F_col = np.concatenate([Q00.col, Q01.col, Q11.col])
-        F_data = np.concatenate([Q00.data, Q01.data, Q11.data])
-        F = coo_matrix((F_data, (F_row, F_col)), (2*nstates, 2*nstates))
-
-        # Store the full matrix.
-        self.F = F
+        E = Q00.multiply(R).A
+        if isinstance(expm_object, ReversibleExpm):
+            return ReversibleExpmFrechet(expm_object, E)
+        return SpectralExpmFrechet(spectral_factors, E)
+    return ImplicitTransitionExpmFrechetEx(
+            state_space_shape, row, col, rate,
+            expect_row, expect_col, expect_rate)
+
+
+def create_transition_expm_frechet_stack(expm_object, state_space_shape,
+        row, col, rate, reductions, spectral_factors=None, spectral=True):
+    """
+    Create an object for the transition expectations of several reductions.
+
+    This is like create_transition_expm_frechet,
+    but each reduction is a (expect_row, expect_col, expect_rate) triple
+    and the returned object has a get_expm_frechet_products method.
+
+    """
+    if not spectral:
+        spectral_factors = None
+    elif isinstance(expm_object, ReversibleExpm):
+        spectral_factors = expm_object.V, expm_object.w, expm_object.W
+    if spectral_factors is not None:
+        Q00 = create_sparse_pre_rate_matrix(
+                state_space_shape, row, col, rate)
+        Es = []
+        for expect_row, expect_col, expect_rate in reductions:
+            R = create_sparse_pre_rate_matrix(
+                    state_space_shape, expect_row, expect_col, expect_rate)
+            Es.append(Q00.multiply(R).A)
+        return SpectralExpmFrechetStack(spectral_factors, Es)
+    return ImplicitTransitionExpmFrechetStack(
+            state_space_shape, row, col, rate, reductions)
+
+
+##############################################################################
+# share expm objects across calls with identical process definitions
+
+
+def _get_process_key(state_space_shape, row, col, rate):
+    # Hash the content of the process definition.
+    h = hashlib.sha1()
+    arrays = (
+            np.asarray(state_space_shape, dtype=np.int64),
+            np.asarray(row, dtype=np.int64),
+            np.asarray(col, dtype=np.int64),
+            np.asarray(rate, dtype=np.float64))
+    for arr in arrays:
+        h.update(repr(arr.shape).encode('ascii'))
+        h.update(np.ascontiguousarray(arr).tobytes())
+    return h.hexdigest()
+
+
+class ExpmObjectRegistry(object):
+    """
+    A bounded registry of expm objects keyed by process definitions.
+
+    Optimization loops process the same process definitions
+    many times with only the edge rates changing.
+    The registry hands back the existing expm object,
+    including its linear system and its cached norm estimates
+    and transition matrices, if the state space shape and the
+    row states, column states, and transition rates are identical.
+    The least recently used objects are evicted.
+
+    """
+    def __init__(self, maxsize=32):
+        self._maxsize = maxsize
+        self._objects = OrderedDict()
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def cache_info(self):
+        return CacheInfo(self._hits, self._misses,
+                self._maxsize, len(self._objects))
+
+    def cache_clear(self):
+        with self._lock:
+            self._objects.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def get(self, state_space_shape, row, col, rate):
+        key = _get_process_key(state_space_shape, row, col, rate)
+        with self._lock:
+            obj = self._objects.pop(key, None)
+            if obj is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._objects[key] = obj
+                return obj
+        obj = create_expm_object(state_space_shape, row, col, rate)
+        if self._maxsize > 0:
+            with self._lock:
+                self._objects[key] = obj
+                while len(self._objects) > self._maxsize:
+                    self._objects.popitem(last=False)
+        return obj
+
+
+_expm_object_registry = ExpmObjectRegistry()
+
+
+def get_registered_expm_object(state_space_shape, row, col, rate):
+    """
+    Get an expm object from the registry shared across calls.
+
+    """
+    return _expm_object_registry.get(state_space_shape, row, col, rate)
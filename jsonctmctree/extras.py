@@ -19,6 +19,7 @@ from numpy.testing import assert_equal, assert_
 import scipy.optimize
 
 from . import interface
+from .session import Session
 
 __all__ = ['optimize_quasi_newton', 'optimize_em']
 
@@ -204,7 +205,7 @@ def optimize_em(scene, observation_reduction, iterations):
 
 def _mixed_gradient_objective(
         verbose,
-        scene,
+        session,
         observation_reduction,
         get_process_definitions,
         get_root_prior,
@@ -215,8 +216,8 @@ def _mixed_gradient_objective(
     ----------
     verbose : bool
         Extra information is printed if this is True.
-    scene : jsonctmctree scene dict
-        This dictionary aggregates the statistical model and the observed data.
+    session : Session
+        A session on the scene, which is updated with the parameters.
     observation_reduction : dict defining site-specific weights, or None
         A reduction over observations, or None.
         If this is None then an unweighted summation will be used instead.
@@ -254,14 +255,14 @@ def _mixed_gradient_objective(
     B = X[-nB:]
     edge_rates = np.exp(B)
 
-    # Copy the scene.
     # Update the process definitions.
     # Update the root distribution.
     # Update the edge rate scaling factors.
-    scene = copy.deepcopy(scene)
-    scene['process_definitions'] = get_process_definitions(P)
-    scene['root_prior'] = get_root_prior(P)
-    scene['tree']['edge_rate_scaling_factors'] = edge_rates
+    # The session recreates only the objects that depend on changed parts.
+    session.update(
+            edge_rate_scaling_factors=edge_rates,
+            process_definitions=get_process_definitions(P),
+            root_prior=get_root_prior(P))
 
     # Define the log likelihood request and the gradient request.
     if observation_reduction is not None:
@@ -276,15 +277,9 @@ def _mixed_gradient_objective(
         derivatives_request = dict(property = 'SDNDERI')
     requests = [log_likelihood_request, derivatives_request]
 
-    # Create the jsonctmctree input dict,
-    # requesting the log likelihood and some derivatives.
-    j_in = dict(
-            scene = scene,
-            requests = [log_likelihood_request, derivatives_request])
-
     # Compute the negative log likelihood
     # and the part of its gradient related to branch lengths.
-    j_out = interface.process_json_in(j_in)
+    j_out = session.process_requests(requests)
     responses = j_out['responses']
     neg_log_likelihood = -responses[0]
     dydB = [-x for x in responses[1]]
@@ -299,12 +294,10 @@ def _mixed_gradient_objective(
     for i in range(nP):
         P2 = P.copy()
         P2[i] += delta
-        scene['process_definitions'] = get_process_definitions(P2)
-        scene['root_prior'] = get_root_prior(P2)
-        j_in = dict(
-                scene = scene,
-                requests = [log_likelihood_request])
-        j_out = interface.process_json_in(j_in)
+        session.update(
+                process_definitions=get_process_definitions(P2),
+                root_prior=get_root_prior(P2))
+        j_out = session.process_requests([log_likelihood_request])
         negative_log_likelihood_i = -j_out['responses'][0]
         deriv = (negative_log_likelihood_i - neg_log_likelihood) / delta
         dydP.append(deriv)
@@ -370,7 +363,7 @@ def optimize_quasi_newton(
     func_and_grad = functools.partial(
             _mixed_gradient_objective,
             verbose,
-            scene,
+            Session(scene),
             observation_reduction,
             get_process_definitions,
             get_root_prior,
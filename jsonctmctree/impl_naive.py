@@ -18,8 +18,8 @@ from numpy.testing import assert_equal
 
 from .expm_helpers import (
         ActionExpm,
-        ImplicitDwellExpmFrechet,
         ImplicitTransitionExpmFrechetEx,
+        create_dwell_expm_frechet,
         )
 from .common_likelihood import (
         get_conditional_likelihoods, get_subtree_likelihoods)
@@ -29,12 +29,16 @@ from . import expect
 from . import ll
 
 
-def _eagerly_precompute_dwell_objects(scene):
+def _eagerly_precompute_dwell_objects(scene, expm_objects=None,
+        spectral=True):
     """
     Precompute dwell times for each state on each edge at each site.
 
     This will be done more cleverly in the less naive implementation later.
     Predefine the dwell objects for each process for each site.
+    If the expm objects of the processes are provided,
+    then the dwell objects may reuse their precomputed factors,
+    unless spectral is False.
 
     Returns a nested list so that arr[i][j] is the dwell object
     for integer state i and associated with process j.
@@ -53,14 +57,20 @@ def _eagerly_precompute_dwell_objects(scene):
         dwell_weights = np.ones(1)
 
         # For this dwell state index track one object per unique process.
-        for p in scene.process_definitions:
-            obj = ImplicitDwellExpmFrechet(
+        for i, p in enumerate(scene.process_definitions):
+            if expm_objects is None:
+                expm_object = None
+            else:
+                expm_object = expm_objects[i]
+            obj = create_dwell_expm_frechet(
+                    expm_object,
                     scene.state_space_shape,
                     p.row_states,
                     p.column_states,
                     p.transition_rates,
                     dwell_states,
                     dwell_weights,
+                    spectral=spectral,
                     )
             arr.append(obj)
         dwell_objects.append(arr)
@@ -73,12 +83,18 @@ def _apply_eagerly_precomputed_dwell_objects(
         expm_objects, dwell_objects, node_to_marginal_distn,
         node_to_subtree_likelihoods, prior_distn,
         T, root, edges, edge_rate_pairs, edge_process_pairs,
+        iid_observations=None,
         ):
     """
 
+    The iid observations default to those of the scene,
+    but the caller may provide distinct observation patterns instead.
+
     """
+    if iid_observations is None:
+        iid_observations = scene.observed_data.iid_observations
     nprocesses = len(scene.process_definitions)
-    nsites = scene.observed_data.iid_observations.shape[0]
+    nsites = iid_observations.shape[0]
     nstates = np.prod(scene.state_space_shape)
     assert_equal(len(dwell_objects), nprocesses)
 
@@ -90,7 +106,7 @@ def _apply_eagerly_precomputed_dwell_objects(
             scene.state_space_shape,
             scene.observed_data.nodes,
             scene.observed_data.variables,
-            scene.observed_data.iid_observations,
+            iid_observations,
             debug=False)
 
     # These dwell times will be scaled by the edge-specific scaling factor.
@@ -115,12 +131,18 @@ def _compute_transition_expectations(
         node_to_subtree_likelihoods, prior_distn,
         T, root, edges, edge_rate_pairs, edge_process_pairs,
         debug=False,
+        iid_observations=None,
         ):
     """
 
+    The iid observations default to those of the scene,
+    but the caller may provide distinct observation patterns instead.
+
     """
+    if iid_observations is None:
+        iid_observations = scene.observed_data.iid_observations
     nprocesses = len(scene.process_definitions)
-    nsites = scene.observed_data.iid_observations.shape[0]
+    nsites = iid_observations.shape[0]
     nstates = np.prod(scene.state_space_shape)
 
     edge_to_site_expectations = expect.get_edge_to_site_expectations(
@@ -131,7 +153,7 @@ def _compute_transition_expectations(
             scene.state_space_shape,
             scene.observed_data.nodes,
             scene.observed_data.variables,
-            scene.observed_data.iid_observations,
+            iid_observations,
             debug=debug)
 
     # Map expectations back to edge indices.
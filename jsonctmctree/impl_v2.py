@@ -8,25 +8,31 @@ than the naive implementation.
 from __future__ import division, print_function, absolute_import
 
 import sys
+import multiprocessing
 
 import numpy as np
 from numpy.testing import assert_equal, assert_
 
 from .expm_helpers import (
-        ActionExpm,
-        ImplicitDwellExpmFrechet,
-        ImplicitTransitionExpmFrechetEx,
+        get_registered_expm_object,
+        get_spectral_factors,
+        create_dwell_expm_frechet,
+        create_transition_expm_frechet_stack,
         )
 from .common_likelihood import (
+        get_observation_index,
         get_conditional_likelihoods, get_subtree_likelihoods)
-from .common_unpacking_ex import TopLevel, interpret_tree, interpret_root_prior
-from .common_reduction import apply_prefixed_reductions, apply_reductions
+from .node_ordering import get_node_to_subtree_thickness
+from .common_unpacking_ex import (
+        TopLevel, interpret_tree, interpret_root_prior,
+        interpret_iid_observations)
+from .common_reduction import apply_prefixed_reductions, get_pattern_weights
 from . import expect
 from . import ll
+from . import planner
 from .impl_naive import (
         _eagerly_precompute_dwell_objects,
         _apply_eagerly_precomputed_dwell_objects,
-        _compute_transition_expectations,
         )
 
 
@@ -34,14 +40,86 @@ class InfeasibilityError(Exception):
     pass
 
 
+# The reactor and requests that are shared with the worker processes
+# of a process pool.  The worker processes are forked after this is set,
+# so they share the read-only scene and its precomputed objects
+# with the parent process instead of receiving pickled copies.
+_pool_state = None
+
+
+def _process_chunk_in_worker(chunk):
+    # Return None if the observations in the chunk are infeasible.
+    reactor, requests = _pool_state
+    try:
+        return reactor.process_chunk(requests, chunk)
+    except InfeasibilityError:
+        return None
+
+
+def _get_fork_context():
+    # The worker processes inherit _pool_state only if they are forked.
+    # Return a multiprocessing context that forks, or None if forking
+    # is not available.  Python 2 forks except on Windows.
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        if sys.platform == 'win32':
+            return None
+        return multiprocessing
+    try:
+        return get_context('fork')
+    except ValueError:
+        return None
+
+
+def _get_transition_reduction_key(state_space_shape, transition_reduction):
+    # Requests whose transition reductions define the same weighted sum
+    # share a key, regardless of the order of the transitions,
+    # duplicated transitions, and transitions with zero weight.
+    mrow = np.ravel_multi_index(
+            transition_reduction.row_states.T, state_space_shape)
+    mcol = np.ravel_multi_index(
+            transition_reduction.column_states.T, state_space_shape)
+    nstates = np.prod(state_space_shape)
+    index = mrow * nstates + mcol
+    keys, inverse = np.unique(index, return_inverse=True)
+    weights = np.bincount(inverse, weights=transition_reduction.weights)
+    nonzero = weights != 0
+    return keys[nonzero].tobytes(), weights[nonzero].tobytes()
+
+
 class Reactor(object):
     """
     This is like a state machine.
 
     """
-    def __init__(self, scene, debug=False):
+    def __init__(self, scene, debug=False,
+            max_sites_per_chunk=None, memory_budget_bytes=None, nworkers=1,
+            nprocesses=1, spectral=True):
         self.scene = scene
         self.debug = debug
+        # Optionally compute the dwell and transition expectations
+        # in closed form for processes whose rate matrices
+        # have well conditioned diagonalizations.
+        self.spectral = spectral
+        # Optionally evaluate independent subtrees on a pool of threads.
+        if nworkers < 1:
+            raise ValueError('expected nworkers to be a positive integer')
+        self.nworkers = nworkers
+        # Optionally process blocks of observation patterns
+        # in a pool of worker processes.
+        if nprocesses < 1:
+            raise ValueError('expected nprocesses to be a positive integer')
+        self.nprocesses = nprocesses
+        # Optionally process blocks of observation patterns independently,
+        # to bound the memory used by the (nstates, nsites) arrays.
+        if max_sites_per_chunk is not None and max_sites_per_chunk < 1:
+            raise ValueError('expected max_sites_per_chunk '
+                    'to be a positive integer')
+        if memory_budget_bytes is not None and memory_budget_bytes < 1:
+            raise ValueError('expected memory_budget_bytes '
+                    'to be a positive integer')
+        self.max_sites_per_chunk = max_sites_per_chunk
+        self.memory_budget_bytes = memory_budget_bytes
         # interpret some stuff
         self.prior_distn = interpret_root_prior(scene)
         (
@@ -51,8 +129,76 @@ class Reactor(object):
                 self.edge_rate_pairs,
                 self.edge_process_pairs,
                 ) = interpret_tree(scene)
+        # All likelihood, derivative, and expectation calculations
+        # are done once per distinct observation pattern.
+        # The per-pattern results are expanded or folded back
+        # into per-observation results only when requests are answered.
+        (
+                self.patterns,
+                self.pattern_inverse,
+                self.pattern_counts,
+                ) = interpret_iid_observations(scene)
+        self._pattern_weights = {}
+        # The compact observation index of each block of patterns
+        # is dropped when the next block is processed, unless a session
+        # asks to reuse the indices of all blocks across calls to main().
+        self.reuse_observation_indices = False
+        self._observation_indices = {}
+        # The patterns in the block that is currently being processed.
+        self.chunk = slice(0, len(self.patterns))
+        self.iid_observations = self.patterns
+
         # init arrays
+        self._init_arrays()
+
+        # For each process, precompute the objects that are capable
+        # of computing expm_mul and rate_mul for log likelihoods
+        # and for its derivative with respect to edge-specific rates.
+        # Time-reversible processes use a symmetric eigendecomposition.
+        # These objects are shared with earlier calls
+        # that had identical process definitions.
+        self.expm_objects = []
+        for p in scene.process_definitions:
+            obj = get_registered_expm_object(
+                    scene.state_space_shape,
+                    p.row_states,
+                    p.column_states,
+                    p.transition_rates)
+            self.expm_objects.append(obj)
+
+        self._prefetch_expm_objects()
+        # The diagonalizations of the processes are computed
+        # only if expectations are requested.
+        self.spectral_factors = None
+        # Plans are cached by the requested core properties
+        # and the memory budget.
+        self._plans = {}
+        self._note('reactor is initialized')
+
+    def _prefetch_expm_objects(self, process_indices=None):
+        # Choose between explicit and abstract matrix exponentials
+        # for the edges of each process and for the number of columns,
+        # and precompute the transition matrices of all edges of each process
+        # with one batched calculation per process, if the process
+        # computes its matrix exponentials explicitly.
+        if process_indices is None:
+            process_indices = range(len(self.expm_objects))
+        ncols = max(len(self.patterns), 1)
+        if self.max_sites_per_chunk is not None:
+            ncols = min(ncols, self.max_sites_per_chunk)
+        edge_to_rate = dict(self.edge_rate_pairs)
+        process_to_rates = dict(
+                (i, []) for i in range(len(self.expm_objects)))
+        for edge, edge_process in self.edge_process_pairs:
+            process_to_rates[edge_process].append(edge_to_rate[edge])
+        for i in process_indices:
+            obj = self.expm_objects[i]
+            if hasattr(obj, 'prefetch'):
+                obj.prefetch(process_to_rates[i], ncols=ncols)
+
+    def _init_arrays(self):
         self.checked_feasibility = False
+        self.observation_index = None
         self.node_to_subtree_likelihoods = None
         self.node_to_conditional_likelihoods = None
         self.node_to_marginal_distn = None
@@ -69,172 +215,131 @@ class Reactor(object):
         # or node_to_conditional_likelihoods.
         self.root_marginal_distn = None
 
-        # For each process, precompute the objects that are capable
-        # of computing expm_mul and rate_mul for log likelihoods
-        # and for its derivative with respect to edge-specific rates.
-        self.expm_objects = []
-        for p in scene.process_definitions:
-            obj = ActionExpm(
-                    scene.state_space_shape,
-                    p.row_states,
-                    p.column_states,
-                    p.transition_rates,
-                    debug=debug)
-            self.expm_objects.append(obj)
-        self._note('reactor is initialized')
-
     def _note(self, msg):
         if self.debug:
             print(msg, file=sys.stderr)
 
-    def _delete_root_marginal_distn(self, unmet_core_requests):
-        if self.root_marginal_distn is None:
-            return False
-        if unmet_core_requests & {'root'}:
-            return False
-        self.root_marginal_distn = None
-        return True
-
-    def _delete_root_conditional_likelihoods(self, unmet_core_requests):
-        if self.root_conditional_likelihoods is None:
-            return False
-        if not self.checked_feasibility:
-            return False
-        if unmet_core_requests & {'logl', 'deri', 'root'}:
-            return False
-        self.root_conditional_likelihoods = None
-        return True
-
-    def _delete_likelihoods(self, unmet_core_requests):
-        if self.likelihoods is None:
-            return False
-        if not self.checked_feasibility:
-            return False
-        if unmet_core_requests & {'deri'}:
-            return False
-        if unmet_core_requests & {'logl'}:
-            if self.log_likelihoods is None:
-                return False
-        self.likelihoods = None
-        return True
-
-    def _delete_log_likelihoods(self, unmet_core_requests):
-        if self.log_likelihoods is None:
-            return False
-        if unmet_core_requests & {'logl'}:
-            return False
-        self.log_likelihoods = None
-        return True
-
-    def _delete_node_to_subtree_likelihoods(self, unmet_core_requests):
-        if self.node_to_subtree_likelihoods is None:
-            return False
-        if unmet_core_requests & {'dwel', 'tran', 'root', 'node'}:
-            return False
-        self.node_to_subtree_likelihoods = None
-        return True
-
-    def _delete_node_to_conditional_likelihoods(self, unmet_core_requests):
-        if self.node_to_conditional_likelihoods is None:
-            return False
-        if unmet_core_requests & {'logl', 'deri', 'root'}:
-            return False
-        self.node_to_conditional_likelihoods = None
-        return True
-
-    def _delete_node_to_marginal_distn(self, unmet_core_requests):
-        if self.node_to_marginal_distn is None:
-            return False
-        if unmet_core_requests & {'dwel', 'tran', 'root', 'node'}:
-            return False
-        self.node_to_marginal_distn = None
-        return True
-
-    def _delete_derivatives(self, unmet_core_requests):
-        if self.derivatives is None:
-            return False
-        if unmet_core_requests & {'deri'}:
-            return False
-        self.derivatives = None
-        return True
-
+    def _get_observation_index(self):
+        # The compact observation indicator arrays of the nodes
+        # are computed once per block of observation patterns.
+        # They depend only on the tree and the observed data,
+        # so they may be kept across calls to main().
+        if self.observation_index is None:
+            key = (self.chunk.start, self.chunk.stop)
+            index = self._observation_indices.get(key)
+            if index is None:
+                index = get_observation_index(
+                        self.T,
+                        self.scene.state_space_shape,
+                        self.scene.observed_data.nodes,
+                        self.scene.observed_data.variables,
+                        self.iid_observations)
+                if self.reuse_observation_indices:
+                    self._observation_indices[key] = index
+            self.observation_index = index
+        return self.observation_index
+
+    def _apply_reductions(self, request, out, custom_prefix=None):
+        # The observation axis of the input array runs over the patterns
+        # of the current chunk.
+        # A 'd' observation axis is expanded after all chunks are merged.
+        if custom_prefix is None:
+            custom_prefix = request.property[:3]
+        key = id(request)
+        if key not in self._pattern_weights:
+            self._pattern_weights[key] = get_pattern_weights(
+                    request, self.pattern_inverse, self.pattern_counts)
+        pattern_weights = self._pattern_weights[key]
+        if pattern_weights is not None:
+            pattern_weights = pattern_weights[self.chunk]
+        return apply_prefixed_reductions(
+                self.scene.state_space_shape,
+                custom_prefix,
+                request,
+                out,
+                pattern_weights=pattern_weights)
+
+    def _get_pass_workspace_floats(self):
+        # Estimate the floats per pattern used by a pass over the tree.
+        # Each active array has one column of nstates floats per pattern.
+        # The memory-aware node ordering keeps only a few arrays active
+        # when the per-node arrays are not stored.
+        # A few more columns are used as workspace for the matrix
+        # exponential products, some of which act on doubled state spaces.
+        nstates = np.prod(self.scene.state_space_shape)
+        thickness = get_node_to_subtree_thickness(self.T, self.root)
+        ncolumns = thickness[self.root] + 8
+        return int(nstates * ncolumns)
+
+    def _get_bytes_per_site(self, requests):
+        # Estimate the memory used per observation pattern,
+        # including the peak memory of the intermediate arrays of the plan.
+        itemsize = np.dtype(float).itemsize
+        nfloats = self._get_pass_workspace_floats() + self.plan(requests).peak
+        return int(itemsize * nfloats)
+
+    def _get_chunk_size(self, requests):
+        # Get the number of observation patterns per chunk.
+        chunk_size = max(len(self.patterns), 1)
+        if self.max_sites_per_chunk is not None:
+            chunk_size = min(chunk_size, self.max_sites_per_chunk)
+        if self.memory_budget_bytes is not None:
+            nbytes = self._get_bytes_per_site(requests)
+            chunk_size = min(chunk_size,
+                    max(1, self.memory_budget_bytes // nbytes))
+        # Give each worker process at least one block.
+        if self.nprocesses > 1:
+            npatterns = len(self.patterns)
+            chunk_size = min(chunk_size,
+                    max(1, -(-npatterns // self.nprocesses)))
+        return chunk_size
 
     def _check_feasibility(self):
-        if self.checked_feasibility:
-            return False
-        if self.likelihoods is None:
-            return False
         self.checked_feasibility = True
         if not np.all(self.likelihoods):
             raise InfeasibilityError
-        return True
-
 
-    def _create_root_marginal_distn(self, unmet_core_requests):
-        if self.root_marginal_distn is not None:
-            return False
-        if not (unmet_core_requests & {'root'}):
-            return False
-        if self.node_to_marginal_distn is not None:
+    def _get_root_array(self, name):
+        # Get the root conditional likelihoods from an intermediate array.
+        if name == planner.ROOT_CONDITIONAL:
+            return self.root_conditional_likelihoods
+        elif name == planner.NODE_TO_SUBTREE:
+            return self.node_to_subtree_likelihoods[self.root]
+        elif name == planner.NODE_TO_CONDITIONAL:
+            return self.node_to_conditional_likelihoods[self.root]
+        raise ValueError('unrecognized source: %s' % name)
+
+    def _build_root_marginal_distn(self, sources):
+        name, = sources
+        if name == planner.NODE_TO_MARGINAL:
             self.root_marginal_distn = self.node_to_marginal_distn[self.root]
-            return True
-        elif self.root_conditional_likelihoods is not None:
-            root_arr = self.root_conditional_likelihoods
-        elif self.node_to_subtree_likelihoods is not None:
-            root_arr = self.node_to_subtree_likelihoods[self.root]
-        elif self.node_to_conditional_likelihoods is not None:
-            root_arr = self.node_to_conditional_likelihoods[self.root]
-        else:
-            return False
+            return
+        root_arr = self._get_root_array(name)
         full_array = root_arr * self.prior_distn[:, np.newaxis]
         col_sums_recip = expect.pseudo_reciprocal(full_array.sum(axis=0))
         self.root_marginal_distn = full_array * col_sums_recip
-        return True
 
-    def _create_likelihoods(self, unmet_core_requests):
-        if self.likelihoods is not None:
-            return False
-        if self.checked_feasibility:
-            # likelihoods are required for feasibility checking...
-            return False
-        if self.root_conditional_likelihoods is not None:
-            arr = self.root_conditional_likelihoods
-        elif self.node_to_subtree_likelihoods is not None:
-            arr = self.node_to_subtree_likelihoods[self.root]
-        elif self.node_to_conditional_likelihoods is not None:
-            arr = self.node_to_conditional_likelihoods[self.root]
-        else:
-            return False
+    def _build_likelihoods(self, sources):
+        name, = sources
+        arr = self._get_root_array(name)
         self.likelihoods = self.prior_distn.dot(arr)
         assert_equal(len(self.likelihoods.shape), 1)
-        return True
 
-    def _create_log_likelihoods(self, unmet_core_requests):
-        if self.log_likelihoods is not None:
-            return False
-        if not (unmet_core_requests & {'logl'}):
-            return False
-        if self.likelihoods is None:
-            return False
+    def _build_log_likelihoods(self, sources):
         self.log_likelihoods = np.log(self.likelihoods)
-        return True
-
-    def _create_derivatives(self, unmet_core_requests):
-        if self.derivatives is not None:
-            return False
-        if not (unmet_core_requests & {'deri'}):
-            return False
-        if self.likelihoods is None:
-            return False
-        if self.node_to_conditional_likelihoods is None:
-            return False
 
+    def _build_derivatives(self, sources):
         # Compute the derivative of the likelihood
         # with respect to each edge-specific rate scaling parameter.
-        #TODO do not necessarily request all edge derivatives
+        # The edge axis of a deri request is never reduced,
+        # so each edge is needed, but the derivative with respect to
+        # the log of a zero rate scaling factor is zero,
+        # and such edges are not visited by the outside pass.
         nedges = len(self.edges)
-        requested_derivative_edge_indices = set(range(nedges))
-        ei_to_derivatives = ll.get_edge_derivatives(
+        edge_to_rate = dict(self.edge_rate_pairs)
+        requested_derivative_edge_indices = set(
+                ei for ei, edge in enumerate(self.edges) if edge_to_rate[edge])
+        ei_to_derivatives = ll.get_edge_derivatives_by_outside_pass(
                 self.expm_objects, requested_derivative_edge_indices,
                 self.node_to_conditional_likelihoods, self.prior_distn,
                 self.T,
@@ -245,33 +350,18 @@ class Reactor(object):
                 self.scene.state_space_shape,
                 self.scene.observed_data.nodes,
                 self.scene.observed_data.variables,
-                self.scene.observed_data.iid_observations)
+                self.iid_observations,
+                observation_index=self._get_observation_index())
 
         # Fill an array with all unreduced derivatives.
-        iid_observation_count = len(self.scene.observed_data.iid_observations)
-        self.derivatives = np.empty((iid_observation_count, nedges))
+        npatterns = len(self.iid_observations)
+        self.derivatives = np.zeros((npatterns, nedges))
         for ei, der in ei_to_derivatives.items():
             self.derivatives[:, ei] = der / self.likelihoods
-        return True
 
-    def _create_root_conditional_likelihoods(self, unmet_core_requests):
-        if self.root_conditional_likelihoods is not None:
-            return False
-        if self.node_to_subtree_likelihoods is not None:
-            return False
-        if self.node_to_conditional_likelihoods is not None:
-            return False
-        if unmet_core_requests & {'deri'}:
-            # in this case we need all conditional likelihoods not just root
-            return False
-        if unmet_core_requests & {'dwel', 'trans', 'node'}:
-            # in these cases we need all subtree likelihoods not just root
-            return False
-        if self.checked_feasibility:
-            if not (unmet_core_requests & {'logl', 'root'}):
-                return False
-        store_all = False
-        d = get_conditional_likelihoods(
+    def _get_likelihood_arrays(self, store_all, f):
+        # Compute conditional or subtree likelihoods with a pass over the tree.
+        return f(
                 self.expm_objects,
                 store_all,
                 self.T,
@@ -282,63 +372,25 @@ class Reactor(object):
                 self.scene.state_space_shape,
                 self.scene.observed_data.nodes,
                 self.scene.observed_data.variables,
-                self.scene.observed_data.iid_observations,
+                self.iid_observations,
+                compress_columns=True,
+                observation_index=self._get_observation_index(),
+                nworkers=self.nworkers,
                 )
+
+    def _build_root_conditional_likelihoods(self, sources):
+        d = self._get_likelihood_arrays(False, get_conditional_likelihoods)
         self.root_conditional_likelihoods = d[self.root]
-        return True
 
-    def _create_node_to_conditional_likelihoods(self, unmet_core_requests):
-        if self.node_to_conditional_likelihoods is not None:
-            return False
-        if not (unmet_core_requests & {'deri'}):
-            # other likelihood objects can be used for non-deri applications
-            return False
-        store_all = True
-        self.node_to_conditional_likelihoods = get_conditional_likelihoods(
-                self.expm_objects,
-                store_all,
-                self.T,
-                self.root,
-                self.edges,
-                self.edge_rate_pairs,
-                self.edge_process_pairs,
-                self.scene.state_space_shape,
-                self.scene.observed_data.nodes,
-                self.scene.observed_data.variables,
-                self.scene.observed_data.iid_observations,
-                )
-        return True
+    def _build_node_to_conditional_likelihoods(self, sources):
+        self.node_to_conditional_likelihoods = self._get_likelihood_arrays(
+                True, get_conditional_likelihoods)
 
-    def _create_node_to_subtree_likelihoods(self, unmet_core_requests):
-        if self.node_to_subtree_likelihoods is not None:
-            return False
-        if not (unmet_core_requests & {'dwel', 'tran', 'node'}):
-            # other likelihood objects can take over for other applications
-            return False
-        #TODO restrict the requested number of arrays
-        store_all = True
-        self.node_to_subtree_likelihoods = get_subtree_likelihoods(
-                self.expm_objects,
-                store_all,
-                self.T,
-                self.root,
-                self.edges,
-                self.edge_rate_pairs,
-                self.edge_process_pairs,
-                self.scene.state_space_shape,
-                self.scene.observed_data.nodes,
-                self.scene.observed_data.variables,
-                self.scene.observed_data.iid_observations,
-                )
-        return True
+    def _build_node_to_subtree_likelihoods(self, sources):
+        self.node_to_subtree_likelihoods = self._get_likelihood_arrays(
+                True, get_subtree_likelihoods)
 
-    def _create_node_to_marginal_distn(self, unmet_core_requests):
-        if self.node_to_marginal_distn is not None:
-            return False
-        if not (unmet_core_requests & {'dwel', 'tran', 'node'}):
-            return False
-        if self.node_to_subtree_likelihoods is None:
-            return False
+    def _build_node_to_marginal_distn(self, sources):
         debug = False
         self.node_to_marginal_distn = expect.get_node_to_marginal_distn(
                 self.expm_objects,
@@ -351,9 +403,8 @@ class Reactor(object):
                 self.scene.state_space_shape,
                 self.scene.observed_data.nodes,
                 self.scene.observed_data.variables,
-                self.scene.observed_data.iid_observations,
+                self.iid_observations,
                 debug=debug)
-        return True
 
 
     #FIXME
@@ -375,9 +426,8 @@ class Reactor(object):
             prefix = request.property[:3]
             suffix = request.property[-4:]
             if suffix == 'root':
-                s = self.scene.state_space_shape
-                out = apply_reductions(s, request, full_array)
-                responses[i] = out.tolist()
+                out = self._apply_reductions(request, full_array)
+                responses[i] = out
         return True
 
     def _respond_to_logl(self, unmet_core_requests, requests, responses):
@@ -389,9 +439,8 @@ class Reactor(object):
             prefix = request.property[:3]
             suffix = request.property[-4:]
             if suffix == 'logl':
-                s = self.scene.state_space_shape
-                out = apply_reductions(s, request, self.log_likelihoods)
-                responses[i] = out.tolist()
+                out = self._apply_reductions(request, self.log_likelihoods)
+                responses[i] = out
         return True
 
     def _respond_to_deri(self, unmet_core_requests, requests, responses):
@@ -403,9 +452,8 @@ class Reactor(object):
             prefix = request.property[:3]
             suffix = request.property[-4:]
             if suffix == 'deri':
-                s = self.scene.state_space_shape
-                out = apply_reductions(s, request, self.derivatives)
-                responses[i] = out.tolist()
+                out = self._apply_reductions(request, self.derivatives)
+                responses[i] = out
         return True
 
     def _respond_to_node(self, unmet_core_requests, requests, responses):
@@ -421,11 +469,29 @@ class Reactor(object):
             prefix = request.property[:3]
             suffix = request.property[-4:]
             if suffix == 'node':
-                s = self.scene.state_space_shape
-                out = apply_reductions(s, request, full_node_array)
-                responses[i] = out.tolist()
+                out = self._apply_reductions(request, full_node_array)
+                responses[i] = out
         return True
 
+    def _get_spectral_factors(self):
+        # Get the diagonalization of each process, with None for processes
+        # that are not diagonalized.  These are computed once per reactor.
+        if self.spectral_factors is None:
+            factors = []
+            for p, expm_object in zip(
+                    self.scene.process_definitions, self.expm_objects):
+                f = None
+                if self.spectral:
+                    f = get_spectral_factors(
+                            expm_object,
+                            self.scene.state_space_shape,
+                            p.row_states,
+                            p.column_states,
+                            p.transition_rates)
+                factors.append(f)
+            self.spectral_factors = factors
+        return self.spectral_factors
+
     def _respond_to_dwel(self, unmet_core_requests, requests, responses):
         if 'dwel' not in unmet_core_requests:
             return False
@@ -435,7 +501,7 @@ class Reactor(object):
             return False
 
         # Precompute some counts.
-        nsites = self.scene.observed_data.iid_observations.shape[0]
+        nsites = self.iid_observations.shape[0]
         nstates = np.prod(self.scene.state_space_shape)
 
         # If any dwell request does not reduce the 'state' axis,
@@ -458,10 +524,36 @@ class Reactor(object):
         if nstates <= unmet_dwel_request_count:
             precompute_per_state = True
 
-        if precompute_per_state:
+        # If every process is diagonalized then the dwell times
+        # of all states are computed in one pass over the edges.
+        spectral_factors = self._get_spectral_factors()
+        all_spectral = all(f is not None for f in spectral_factors)
+
+        if precompute_per_state and all_spectral:
+            edge_to_dwell_times = expect.get_edge_to_site_dwell_times(
+                    nsites, nstates,
+                    spectral_factors,
+                    self.node_to_marginal_distn,
+                    self.node_to_subtree_likelihoods,
+                    self.T,
+                    self.root,
+                    self.edges,
+                    self.edge_rate_pairs,
+                    self.edge_process_pairs)
+            # Create an array like (nsites, nedges, nstates).
+            full_dwell_array = np.array([
+                edge_to_dwell_times[edge] for edge in self.edges]).transpose(
+                        2, 0, 1)
+            for i, request in enumerate(requests):
+                suffix = request.property[-4:]
+                if suffix == 'dwel':
+                    out = self._apply_reductions(request, full_dwell_array)
+                    responses[i] = out
+        elif precompute_per_state:
             # Apply the precomputed dwell objects, creating
             # an array like (nsites, nedges, nstates) after the transposition.
-            all_dwell_objects = _eagerly_precompute_dwell_objects(self.scene)
+            all_dwell_objects = _eagerly_precompute_dwell_objects(
+                    self.scene, self.expm_objects, spectral=self.spectral)
             arr = []
             for dwell_state_index in range(nstates):
                 dwell_objects = all_dwell_objects[dwell_state_index]
@@ -476,16 +568,16 @@ class Reactor(object):
                         self.root,
                         self.edges,
                         self.edge_rate_pairs,
-                        self.edge_process_pairs))
+                        self.edge_process_pairs,
+                        iid_observations=self.iid_observations))
             full_dwell_array = np.array(arr).T
             # Use the full dwell array to meet the requests.
             for i, request in enumerate(requests):
                 prefix = request.property[:3]
                 suffix = request.property[-4:]
                 if suffix == 'dwel':
-                    s = self.scene.state_space_shape
-                    out = apply_reductions(s, request, full_dwell_array)
-                    responses[i] = out.tolist()
+                    out = self._apply_reductions(request, full_dwell_array)
+                    responses[i] = out
         else:
             # Compute each reduction separately.
             for i, request in enumerate(requests):
@@ -496,14 +588,19 @@ class Reactor(object):
 
                 # Compute the dwell object per process for the request.
                 dwell_objects = []
-                for p in self.scene.process_definitions:
-                    obj = ImplicitDwellExpmFrechet(
+                for p, expm_object, factors in zip(
+                        self.scene.process_definitions, self.expm_objects,
+                        spectral_factors):
+                    obj = create_dwell_expm_frechet(
+                            expm_object,
                             self.scene.state_space_shape,
                             p.row_states,
                             p.column_states,
                             p.transition_rates,
                             request.state_reduction.states,
                             request.state_reduction.weights,
+                            spectral_factors=factors,
+                            spectral=self.spectral,
                             )
                     dwell_objects.append(obj)
 
@@ -523,7 +620,7 @@ class Reactor(object):
                         self.scene.state_space_shape,
                         self.scene.observed_data.nodes,
                         self.scene.observed_data.variables,
-                        self.scene.observed_data.iid_observations,
+                        self.iid_observations,
                         debug=False)
 
                 # These dwell times will have been scaled
@@ -550,12 +647,9 @@ class Reactor(object):
                 custom_prefix = ''.join(custom_prefix)
 
                 # Compute the requested reduction using the custom prefix.
-                out = apply_prefixed_reductions(
-                    self.scene.state_space_shape,
-                    custom_prefix,
-                    request,
-                    dwell_array)
-                responses[i] = out.tolist()
+                out = self._apply_reductions(
+                        request, dwell_array, custom_prefix=custom_prefix)
+                responses[i] = out
 
         return True
 
@@ -566,129 +660,212 @@ class Reactor(object):
             return False
         if self.node_to_marginal_distn is None:
             return False
+        # Group the requests by their transition reductions,
+        # so that each distinct expectation array is computed once.
+        key_to_indices = {}
+        reductions = []
         for i, request in enumerate(requests):
-            prefix = request.property[:3]
-            suffix = request.property[-4:]
-            if suffix != 'tran':
+            if request.property[-4:] != 'tran':
                 continue
-
-            # Create the request-specific expm transition objects.
-            expm_transition_objects = []
-            for p in self.scene.process_definitions:
-                obj = ImplicitTransitionExpmFrechetEx(
-                        self.scene.state_space_shape,
-                        p.row_states,
-                        p.column_states,
-                        p.transition_rates,
-                        request.transition_reduction.row_states,
-                        request.transition_reduction.column_states,
-                        request.transition_reduction.weights,
-                        )
-                expm_transition_objects.append(obj)
-            arr = _compute_transition_expectations(
-                self.scene,
-                self.expm_objects,
-                expm_transition_objects,
+            key = _get_transition_reduction_key(
+                    self.scene.state_space_shape,
+                    request.transition_reduction)
+            if key not in key_to_indices:
+                key_to_indices[key] = []
+                r = request.transition_reduction
+                reductions.append((key, (
+                    r.row_states, r.column_states, r.weights)))
+            key_to_indices[key].append(i)
+
+        # Create the expm transition objects for all distinct reductions.
+        # Each edge uses a single Frechet evaluation for all reductions.
+        expm_transition_stacks = []
+        for p, expm_object, factors in zip(
+                self.scene.process_definitions, self.expm_objects,
+                self._get_spectral_factors()):
+            obj = create_transition_expm_frechet_stack(
+                    expm_object,
+                    self.scene.state_space_shape,
+                    p.row_states,
+                    p.column_states,
+                    p.transition_rates,
+                    [reduction for key, reduction in reductions],
+                    spectral_factors=factors,
+                    spectral=self.spectral,
+                    )
+            expm_transition_stacks.append(obj)
+        edge_to_expectations = expect.get_edge_to_site_expectation_stacks(
+                expm_transition_stacks,
                 self.node_to_marginal_distn,
                 self.node_to_subtree_likelihoods,
-                self.prior_distn,
                 self.T,
                 self.root,
                 self.edges,
                 self.edge_rate_pairs,
-                self.edge_process_pairs,
-                debug=False)
-            out = np.array(arr).T
+                self.edge_process_pairs)
+
+        for k, (key, reduction) in enumerate(reductions):
+            # This has shape (nsites, nedges).
+            out = np.array([edge_to_expectations[e][k] for e in self.edges]).T
 
             # Apply further reductions.
-            s = self.scene.state_space_shape
-            out = apply_reductions(s, request, out)
-            responses[i] = out.tolist()
+            for i in key_to_indices[key]:
+                responses[i] = self._apply_reductions(requests[i], out)
 
         return True
 
 
-    def react(self, requests, responses):
+    def plan(self, requests, nsites=None):
         """
-        This is called repeatedly, with some progress made in each call.
-        The two input lists should have equal lengths, and this function
-        should eventually replace each None entry of the responses list
-        with a useful entry after enough calls.
+        Plan the steps used to respond to the requests.
+
+        The plan is a schedule of steps that create and delete
+        intermediate arrays, check feasibility, and respond to requests.
+        If a memory budget was provided then the plan is chosen
+        to fit the budget for a block of nsites observation patterns
+        if possible.  The plans are cached, and they can be printed
+        for inspection.
+
+        Parameters
+        ----------
+        requests : sequence
+            The requests.
+        nsites : integer, optional
+            The number of observation patterns in a block.
+
+        Returns
+        -------
+        plan : planner.Plan
+            The plan.
 
         """
-        # Get the set of unmet core properties.
-        unmet_core_requests = set()
-        for request, response in zip(requests, responses):
-            if response is None:
-                unmet_core_requests.add(request.property[-4:])
-
-        # Delete intermediate arrays.
-        if self._delete_root_marginal_distn(unmet_core_requests):
-            return self._note('delete root marginal distn')
-        if self._delete_derivatives(unmet_core_requests):
-            return self._note('delete derivatives')
-        if self._delete_root_conditional_likelihoods(unmet_core_requests):
-            return self._note('delete root conditional likelihoods')
-        if self._delete_likelihoods(unmet_core_requests):
-            return self._note('delete likelihoods')
-        if self._delete_log_likelihoods(unmet_core_requests):
-            return self._note('delete log likelihoods')
-        if self._delete_node_to_conditional_likelihoods(unmet_core_requests):
-            return self._note('delete node to conditional likelihoods')
-        if self._delete_node_to_subtree_likelihoods(unmet_core_requests):
-            return self._note('delete node to subtree likelihoods')
-        if self._delete_node_to_marginal_distn(unmet_core_requests):
-            return self._note('delete node to marginal distn')
-
-        # Check feasibility.
-        if self._check_feasibility():
-            return self._note('check feasibility')
-
-        # Respond to requests.
-        if self._respond_to_root(unmet_core_requests, requests, responses):
-            return self._note('respond to a "root" request')
-        if self._respond_to_logl(unmet_core_requests, requests, responses):
-            return self._note('respond to a "logl" request')
-        if self._respond_to_deri(unmet_core_requests, requests, responses):
-            return self._note('respond to a "deri" request')
-        if self._respond_to_node(unmet_core_requests, requests, responses):
-            return self._note('respond to a "node" request')
-        if self._respond_to_dwel(unmet_core_requests, requests, responses):
-            return self._note('respond to a "dwel" request')
-        if self._respond_to_tran(unmet_core_requests, requests, responses):
-            return self._note('respond to a "tran" request')
-
-        # Create intermediate arrays.
-        if self._create_likelihoods(unmet_core_requests):
-            return self._note('create likelihoods')
-        if self._create_log_likelihoods(unmet_core_requests):
-            return self._note('create log likelihoods')
-        if self._create_node_to_conditional_likelihoods(unmet_core_requests):
-            return self._note('create node to conditional likelihoods')
-        if self._create_node_to_subtree_likelihoods(unmet_core_requests):
-            return self._note('create node to subtree likelihoods')
-        if self._create_derivatives(unmet_core_requests):
-            return self._note('create derivatives')
-        if self._create_root_conditional_likelihoods(unmet_core_requests):
-            return self._note('create root conditional likelihoods')
-        if self._create_root_marginal_distn(unmet_core_requests):
-            return self._note('create root marginal distn')
-        if self._create_node_to_marginal_distn(unmet_core_requests):
-            return self._note('create node to marginal distn')
-
-        # No progress was made towards an unfulfilled request.
-        raise Exception(dir(self))
+        core_properties = frozenset(r.property[-4:] for r in requests)
+        nstates = np.prod(self.scene.state_space_shape)
+        budget = None
+        if self.memory_budget_bytes is not None and nsites:
+            itemsize = np.dtype(float).itemsize
+            budget = (self.memory_budget_bytes // (itemsize * nsites) -
+                    self._get_pass_workspace_floats())
+        key = (core_properties, budget)
+        if key not in self._plans:
+            self._plans[key] = planner.make_plan(
+                    core_properties, nstates, len(self.T), len(self.edges),
+                    budget=budget)
+        return self._plans[key]
+
+    def _run_step(self, step, requests, responses):
+        self._note(str(step))
+        if step.action == 'create':
+            getattr(self, '_build_' + step.name)(step.sources)
+        elif step.action == 'delete':
+            setattr(self, step.name, None)
+        elif step.action == 'check':
+            self._check_feasibility()
+        elif step.action == 'respond':
+            respond = getattr(self, '_respond_to_' + step.name)
+            assert_(respond({step.name}, requests, responses))
+        else:
+            raise ValueError('unrecognized step: %s' % step.action)
 
+    def process_chunk(self, requests, chunk):
+        """
+        Compute partial responses for a block of observation patterns.
 
-    def main(self, requests):
+        The observation axis of each partial response is either
+        a 'd' axis over the patterns in the block,
+        or it has been reduced using only the patterns in the block.
+
+        """
+        self._init_arrays()
+        self.chunk = chunk
+        self.iid_observations = self.patterns[chunk]
         responses = [None] * len(requests)
+        plan = self.plan(requests, nsites=len(self.iid_observations))
+        for step in plan.steps:
+            self._run_step(step, requests, responses)
+        assert_(all(r is not None for r in responses))
+        return responses
+
+    def merge_chunk_responses(self, requests, chunk_responses):
+        """
+        Combine the partial responses of consecutive pattern blocks.
+
+        Distinct observation axes are concatenated across blocks
+        and expanded from patterns to iid observations,
+        whereas reduced observation axes are summed across blocks.
+
+        """
+        responses = []
+        for i, request in enumerate(requests):
+            arrays = [partial[i] for partial in chunk_responses]
+            if request.property[0] == 'd':
+                out = np.concatenate(arrays, axis=0)
+                out = np.take(out, self.pattern_inverse, axis=0)
+            else:
+                out = arrays[0]
+                for arr in arrays[1:]:
+                    out = out + arr
+            responses.append(np.asarray(out).tolist())
+        return responses
+
+    def process_chunks_in_pool(self, requests, chunks):
+        """
+        Compute partial responses for blocks of patterns in worker processes.
+
+        The partial responses are returned in the order of the blocks,
+        so merging them gives the same responses as processing
+        the blocks serially.
+        The worker processes are forked,
+        so they share the reactor with the calling process.
+
+        """
+        global _pool_state
+        self._note('processing %d blocks of patterns in %d processes' % (
+            len(chunks), self.nprocesses))
+        _pool_state = (self, requests)
+        try:
+            pool = _get_fork_context().Pool(self.nprocesses)
+            try:
+                chunk_responses = pool.map(_process_chunk_in_worker, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _pool_state = None
+        # Each worker checked the feasibility of its blocks.
+        self.checked_feasibility = True
+        if any(r is None for r in chunk_responses):
+            raise InfeasibilityError
+        return chunk_responses
+
+    def main(self, requests):
+        # The pattern weights are cached by request identity,
+        # so they are not kept across calls.
+        self._pattern_weights = {}
+        npatterns = len(self.patterns)
+        chunk_size = self._get_chunk_size(requests)
+        chunks = []
+        for start in range(0, max(npatterns, 1), chunk_size):
+            chunks.append(slice(start, min(start + chunk_size, npatterns)))
         try:
-            while None in responses or not self.checked_feasibility:
-                self.react(requests, responses)
+            # Without forked worker processes the blocks are processed
+            # serially.
+            if (self.nprocesses > 1 and len(chunks) > 1 and
+                    _get_fork_context() is not None):
+                chunk_responses = self.process_chunks_in_pool(
+                        requests, chunks)
+            else:
+                chunk_responses = []
+                for chunk in chunks:
+                    self._note('processing patterns %d to %d of %d' % (
+                        chunk.start, chunk.stop, npatterns))
+                    chunk_responses.append(
+                            self.process_chunk(requests, chunk))
             j_out = dict(
                     status = 'feasible',
-                    responses = responses)
-        except InfeasibilityError as e:
+                    responses = self.merge_chunk_responses(
+                        requests, chunk_responses))
+        except InfeasibilityError:
             j_out = dict(
                     status = 'infeasible',
                     responses = None)
@@ -697,6 +874,13 @@ class Reactor(object):
         return j_out
 
 
-def process_json_in(j_in, debug=False):
+def process_json_in(j_in, debug=False,
+        max_sites_per_chunk=None, memory_budget_bytes=None, nworkers=1,
+        nprocesses=1):
     toplevel = TopLevel(j_in)
-    return Reactor(toplevel.scene, debug=debug).main(toplevel.requests)
+    reactor = Reactor(toplevel.scene, debug=debug,
+            max_sites_per_chunk=max_sites_per_chunk,
+            memory_budget_bytes=memory_budget_bytes,
+            nworkers=nworkers,
+            nprocesses=nprocesses)
+    return reactor.main(toplevel.requests)
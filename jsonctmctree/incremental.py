@@ -0,0 +1,227 @@
+"""
+Persistent likelihood calculations for a scene whose edge rates change.
+
+Branch length optimization changes the rate scaling factor of one edge
+at a time, but each call to interface.process_json_in
+re-processes the whole scene.
+Instead, this module keeps the conditional likelihood array of each node
+and after a change of one edge rate it recomputes only the arrays
+on the path from that edge to the root.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+from numpy.testing import assert_equal
+
+from .expm_helpers import get_registered_expm_object
+from .common_likelihood import (
+        get_observation_index,
+        get_conditional_likelihoods,
+        _get_indicator_array)
+from .common_unpacking_ex import (
+        TopLevel, interpret_tree, interpret_root_prior,
+        interpret_iid_observations)
+from .impl_v2 import InfeasibilityError
+from . import ll
+
+__all__ = ['IncrementalLikelihood']
+
+
+class IncrementalLikelihood(object):
+    """
+    Log likelihood and its derivatives, updated one edge at a time.
+
+    The log likelihood and the derivatives are summed over
+    the iid observations, like the 'snnlogl' and 'sdnderi' properties.
+    The calculations are done once per distinct observation pattern.
+
+    """
+    def __init__(self, scene):
+        """
+
+        Parameters
+        ----------
+        scene : dict
+            The scene in the json format of interface.process_json_in.
+
+        """
+        self.scene = TopLevel(dict(scene=scene, requests=[])).scene
+        self.prior_distn = interpret_root_prior(self.scene)
+        (
+                self.T,
+                self.root,
+                self.edges,
+                edge_rate_pairs,
+                edge_process_pairs,
+                ) = interpret_tree(self.scene)
+        self.edge_to_rate = dict(edge_rate_pairs)
+        self.edge_to_process = dict(edge_process_pairs)
+        self.child_to_edge = dict((tail, (head, tail))
+                for head, tail in self.edges)
+        (
+                self.patterns,
+                self.pattern_inverse,
+                self.pattern_counts,
+                ) = interpret_iid_observations(self.scene)
+
+        # For each process, get the object that computes
+        # expm_mul and rate_mul.
+        self.expm_objects = []
+        for p in self.scene.process_definitions:
+            obj = get_registered_expm_object(
+                    self.scene.state_space_shape,
+                    p.row_states,
+                    p.column_states,
+                    p.transition_rates)
+            self.expm_objects.append(obj)
+
+        # Compute the conditional likelihood arrays of all nodes once.
+        self.observation_index = get_observation_index(
+                self.T,
+                self.scene.state_space_shape,
+                self.scene.observed_data.nodes,
+                self.scene.observed_data.variables,
+                self.patterns)
+        store_all = True
+        self.node_to_array = get_conditional_likelihoods(
+                self.expm_objects,
+                store_all,
+                self.T,
+                self.root,
+                self.edges,
+                self._get_edge_rate_pairs(),
+                self._get_edge_process_pairs(),
+                self.scene.state_space_shape,
+                self.scene.observed_data.nodes,
+                self.scene.observed_data.variables,
+                self.patterns,
+                compress_columns=True,
+                observation_index=self.observation_index)
+        self._update_likelihoods()
+
+    def _get_edge_rate_pairs(self):
+        return [(edge, self.edge_to_rate[edge]) for edge in self.edges]
+
+    def _get_edge_process_pairs(self):
+        return [(edge, self.edge_to_process[edge]) for edge in self.edges]
+
+    def _update_likelihoods(self):
+        self.likelihoods = self.prior_distn.dot(self.node_to_array[self.root])
+
+    def _get_product(self, node, excluded_child=None):
+        # The elementwise product of the observation indicator array
+        # of the node and the conditional likelihood arrays of its children.
+        # The returned array may be modified by the caller.
+        arr = _get_indicator_array(self.observation_index, node)
+        for child in self.T.successors(node):
+            if child == excluded_child:
+                continue
+            child_arr = self.node_to_array[child]
+            if arr is None:
+                arr = child_arr.copy()
+            else:
+                arr *= child_arr
+        if arr is None:
+            nstates = np.prod(self.scene.state_space_shape)
+            arr = np.ones((nstates, len(self.patterns)), dtype=float)
+        return arr
+
+    def set_edge_rate(self, edge_index, edge_rate):
+        """
+        Change the rate scaling factor of one edge.
+
+        Only the arrays on the path from the edge to the root
+        are recomputed.
+
+        """
+        if edge_rate < 0:
+            raise ValueError('the edge-specific rate scaling factors '
+                    'should be non-negative')
+        edge = self.edges[edge_index]
+        self.edge_to_rate[edge] = edge_rate
+        head, node = edge
+        while True:
+            arr = self._get_product(node)
+            if node != self.root:
+                edge = self.child_to_edge[node]
+                f = self.expm_objects[self.edge_to_process[edge]]
+                arr = f.expm_mul(self.edge_to_rate[edge], arr)
+            self.node_to_array[node] = arr
+            if node == self.root:
+                break
+            head, tail = edge
+            node = head
+        self._update_likelihoods()
+
+    def get_log_likelihood(self):
+        """
+        Return the log likelihood summed over iid observations.
+
+        If some observation is infeasible then this is -inf.
+
+        """
+        with np.errstate(divide='ignore'):
+            log_likelihoods = np.log(self.likelihoods)
+        if not np.all(np.isfinite(log_likelihoods)):
+            return -np.inf
+        return float(self.pattern_counts.dot(log_likelihoods))
+
+    def _check_feasibility(self):
+        if not np.all(self.likelihoods):
+            raise InfeasibilityError
+
+    def get_edge_derivative(self, edge_index):
+        """
+        Return the derivative of the log likelihood with respect to the log
+        of the rate scaling factor of one edge.
+
+        The cost is proportional to the depth of the edge.
+
+        """
+        self._check_feasibility()
+        edge = self.edges[edge_index]
+        f = self.expm_objects[self.edge_to_process[edge]]
+        head, tail = edge
+        arr = f.rate_mul(self.edge_to_rate[edge], self.node_to_array[tail])
+        child, node = tail, head
+        while True:
+            arr *= self._get_product(node, excluded_child=child)
+            if node == self.root:
+                break
+            edge = self.child_to_edge[node]
+            f = self.expm_objects[self.edge_to_process[edge]]
+            arr = f.expm_mul(self.edge_to_rate[edge], arr)
+            head, tail = edge
+            child, node = tail, head
+        derivatives = self.prior_distn.dot(arr)
+        return float(self.pattern_counts.dot(derivatives / self.likelihoods))
+
+    def get_edge_derivatives(self):
+        """
+        Return the derivatives of the log likelihood with respect to the logs
+        of the rate scaling factors of all edges.
+
+        This uses a single pass over the tree.
+
+        """
+        self._check_feasibility()
+        nedges = len(self.edges)
+        ei_to_derivatives = ll.get_edge_derivatives_by_outside_pass(
+                self.expm_objects, range(nedges),
+                self.node_to_array, self.prior_distn,
+                self.T,
+                self.root,
+                self.edges,
+                self._get_edge_rate_pairs(),
+                self._get_edge_process_pairs(),
+                self.scene.state_space_shape,
+                self.scene.observed_data.nodes,
+                self.scene.observed_data.variables,
+                self.patterns,
+                observation_index=self.observation_index)
+        out = np.empty(nedges)
+        for ei, derivatives in ei_to_derivatives.items():
+            out[ei] = self.pattern_counts.dot(derivatives / self.likelihoods)
+        assert_equal(len(ei_to_derivatives), nedges)
+        return out
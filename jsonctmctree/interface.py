@@ -62,7 +62,9 @@ def diagnose_expm_multiply():
     return _expm_multiply.expm_multiply(None, None)
 
 
-def process_json_in(j_in, debug=False):
+def process_json_in(j_in, debug=False,
+        max_sites_per_chunk=None, memory_budget_bytes=None, nworkers=1,
+        nprocesses=1):
     """
     The part of the input that is the same across requests is as follows.
     I'm bundling all of this stuff together and calling it a 'scene'.
@@ -126,5 +128,27 @@ def process_json_in(j_in, debug=False):
         }
         ]
 
+    Memory usage grows with the number of distinct iid observations.
+    To bound it, the observations can be processed in independent blocks
+    whose responses are accumulated, by providing a maximum number
+    of distinct observations per block (max_sites_per_chunk)
+    and/or an approximate memory budget in bytes (memory_budget_bytes).
+    The responses do not depend on the block size.
+
+    Independent subtrees of the tree can be evaluated concurrently
+    by a pool of threads, by providing a number of workers (nworkers).
+    The responses do not depend on the number of workers.
+
+    On systems that fork processes, the blocks of distinct observations
+    can instead be processed by a pool of worker processes (nprocesses)
+    that share the scene with the calling process.
+    Elsewhere the blocks are processed serially.
+    The responses of the blocks are merged in order, so they are the same
+    as the responses of processing the same blocks in a single process.
+
     """
-    return impl_v2.process_json_in(j_in, debug=debug)
+    return impl_v2.process_json_in(j_in, debug=debug,
+            max_sites_per_chunk=max_sites_per_chunk,
+            memory_budget_bytes=memory_budget_bytes,
+            nworkers=nworkers,
+            nprocesses=nprocesses)
@@ -23,8 +23,9 @@ from .common_unpacking import (
         get_prior_info)
 
 from .common_likelihood import (
-        create_indicator_array,
-        get_conditional_likelihoods)
+        get_observation_index,
+        get_conditional_likelihoods,
+        _get_indicator_array)
 
 
 def get_site_weights(j_in):
@@ -62,14 +63,29 @@ def get_edge_derivative(
         observable_nodes,
         observable_axes,
         iid_observations,
+        observation_index=None,
         ):
     """
+    Compute the derivative of the likelihood arrays at the root.
+
+    The derivative is with respect to the rate scaling factor
+    of the derivative edge.
+    The observation_index is as returned by get_observation_index;
+    it is computed here if it is not provided.
 
     """
     # Some preprocessing.
+    nsites = iid_observations.shape[0]
     child_to_edge = dict((tail, (head, tail)) for head, tail in edges)
     edge_to_rate = dict(edge_rate_pairs)
     edge_to_process = dict(edge_process_pairs)
+    if observation_index is None:
+        observation_index = get_observation_index(
+                T,
+                state_space_shape,
+                observable_nodes,
+                observable_axes,
+                iid_observations)
 
     # Unpack the edge of interest.
     derivative_head_node, derivative_tail_node = derivative_edge
@@ -83,15 +99,6 @@ def get_edge_derivative(
     node = derivative_tail_node
     while True:
 
-        # When a node is activated, its associated array
-        # is initialized to its observational likelihood array.
-        arr = create_indicator_array(
-                node,
-                state_space_shape,
-                observable_nodes,
-                observable_axes,
-                iid_observations)
-
         # If we are not analyzing the root node then determine
         # the characteristics of the edge upstream of the node.
         if node != root:
@@ -110,12 +117,26 @@ def get_edge_derivative(
             arr = node_to_array[node]
             arr = f[edge_process].rate_mul(edge_rate, arr)
         else:
+            # When a node is activated, its associated array
+            # is initialized to its observational likelihood array,
+            # unless the node has no observables.
+            arr = _get_indicator_array(observation_index, node)
             for child in T.successors(node):
                 if child in node_to_deriv_array:
-                    arr *= node_to_deriv_array[child]
-                    del node_to_deriv_array[child]
+                    child_arr = node_to_deriv_array.pop(child)
+                    if arr is None:
+                        arr = child_arr
+                    else:
+                        arr *= child_arr
                 else:
-                    arr *= node_to_array[child]
+                    child_arr = node_to_array[child]
+                    if arr is None:
+                        arr = child_arr.copy()
+                    else:
+                        arr *= child_arr
+            if arr is None:
+                nstates = np.prod(state_space_shape)
+                arr = np.ones((nstates, nsites), dtype=float)
             if node != root:
                 arr = f[edge_process].expm_mul(edge_rate, arr)
 
@@ -147,6 +168,7 @@ def get_edge_derivatives(
         observable_nodes,
         observable_axes,
         iid_observations,
+        observation_index=None,
         ):
     """
     Recursively compute conditional likelihoods at the root.
@@ -167,12 +189,24 @@ def get_edge_derivatives(
         map from node to array returned by get_conditional_likelihoods
     distn : 1d array
         prior state distribution at the root
+    observation_index : dict, optional
+        map from node to compact observation indicator array
+        returned by get_observation_index
 
     """
     child_to_edge = dict((tail, (head, tail)) for head, tail in edges)
     edge_to_rate = dict(edge_rate_pairs)
     edge_to_process = dict(edge_process_pairs)
 
+    # The observation index is shared by all of the derivative edges.
+    if observation_index is None:
+        observation_index = get_observation_index(
+                T,
+                state_space_shape,
+                observable_nodes,
+                observable_axes,
+                iid_observations)
+
     # Compute the likelihood derivative for each requested edge length.
     edge_index_to_derivatives = dict()
     for edge_index in requested_derivative_edge_indices:
@@ -189,7 +223,8 @@ def get_edge_derivatives(
                 state_space_shape,
                 observable_nodes,
                 observable_axes,
-                iid_observations)
+                iid_observations,
+                observation_index=observation_index)
 
         # Apply the prior distribution to the array.
         # Now we have the derivatives of the likelihoods with respect
@@ -203,6 +238,128 @@ def get_edge_derivatives(
     return edge_index_to_derivatives
 
 
+def get_edge_derivatives_by_outside_pass(
+        f,
+        requested_derivative_edge_indices,
+        node_to_array,
+        distn,
+        T, root, edges, edge_rate_pairs, edge_process_pairs,
+        state_space_shape,
+        observable_nodes,
+        observable_axes,
+        iid_observations,
+        observation_index=None,
+        ):
+    """
+    Compute likelihood derivatives for all requested edges at once.
+
+    The inputs and outputs are the same as for get_edge_derivatives,
+    but instead of tracing a path from each derivative edge to the root,
+    this function makes a single preorder pass over the tree
+    that reuses the conditional likelihood arrays of the postorder pass.
+    This costs two propagator actions per edge
+    instead of one per edge on each path from a derivative edge to the root.
+
+    Notes
+    -----
+    For each edge (head, tail) the outside array W has shape (nstates, nsites)
+    and is indexed by the state at the head node.
+    It satisfies L = sum_i W[i] * C[i] where C is the conditional likelihood
+    array of the tail node and L is the likelihood.
+    Within the tree, W is the elementwise product of the outside array
+    of the head node, the observation indicator array of the head node,
+    and the conditional likelihood arrays of the siblings of the tail node.
+    The outside array of the tail node is then P.T W
+    where P is the matrix exponential associated with the edge,
+    and the outside array of the root is the prior distribution.
+    Only subtrees that contain a requested edge are visited.
+
+    """
+    nsites = iid_observations.shape[0]
+    child_to_edge = dict((tail, (head, tail)) for head, tail in edges)
+    edge_to_index = dict((edge, i) for i, edge in enumerate(edges))
+    edge_to_rate = dict(edge_rate_pairs)
+    edge_to_process = dict(edge_process_pairs)
+
+    if observation_index is None:
+        observation_index = get_observation_index(
+                T,
+                state_space_shape,
+                observable_nodes,
+                observable_axes,
+                iid_observations)
+
+    # Outside arrays are required only for the head nodes
+    # of requested derivative edges and for their ancestors.
+    requested_edges = set(edges[i] for i in requested_derivative_edge_indices)
+    outside_nodes = set()
+    for head, tail in requested_edges:
+        node = head
+        while node not in outside_nodes:
+            outside_nodes.add(node)
+            if node == root:
+                break
+            node, tail = child_to_edge[node]
+
+    # Traverse the tree in preorder, starting with the prior distribution
+    # as the outside array of the root.
+    edge_index_to_derivatives = dict()
+    node_to_outside_array = {}
+    if outside_nodes:
+        node_to_outside_array[root] = np.outer(distn, np.ones(nsites))
+    for head in nx.dfs_preorder_nodes(T, root):
+        if head not in node_to_outside_array:
+            continue
+        base = node_to_outside_array.pop(head)
+        obs = _get_indicator_array(observation_index, head)
+        if obs is not None:
+            base = base * obs
+
+        # The outside array of each edge excludes the conditional likelihood
+        # array of its own tail node, so accumulate products of the arrays
+        # of the preceding siblings and the following siblings.
+        children = list(T.successors(head))
+        prefixes = [base]
+        for child in children[:-1]:
+            prefixes.append(prefixes[-1] * node_to_array[child])
+        suffix = None
+        for k in reversed(range(len(children))):
+            child = children[k]
+            edge = (head, child)
+            if edge in requested_edges or child in outside_nodes:
+                if suffix is None:
+                    W = prefixes[k]
+                else:
+                    W = prefixes[k] * suffix
+                edge_rate = edge_to_rate[edge]
+                edge_process = edge_to_process[edge]
+
+                # The derivative of the likelihood with respect to the
+                # log of the edge-specific rate scaling factor.
+                if edge in requested_edges:
+                    D = f[edge_process].rate_mul(
+                            edge_rate, node_to_array[child])
+                    edge_index = edge_to_index[edge]
+                    edge_index_to_derivatives[edge_index] = np.einsum(
+                            'ij,ij->j', W, D)
+
+                # Propagate the outside array across the edge.
+                if child in outside_nodes:
+                    outside = f[edge_process].expm_rmul(edge_rate, W.T).T
+                    node_to_outside_array[child] = outside
+
+            if k:
+                if suffix is None:
+                    suffix = node_to_array[child]
+                else:
+                    suffix = suffix * node_to_array[child]
+
+    # Return the map from edge index to edge-specific derivatives.
+    assert_equal(set(edge_index_to_derivatives),
+            set(requested_derivative_edge_indices))
+    return edge_index_to_derivatives
+
+
 def process_json_in(j_in):
 
     # Unpack some sizes and shapes.
@@ -256,7 +413,15 @@ def process_json_in(j_in):
     # Determine whether to store intermediate arrays
     # or whether to store only as many as necessary to compute
     # the log likelihood.
-    store_all_likelihood_arrays = bool(np.any(requested_derivatives))
+    store_all_likelihood_arrays = bool(len(requested_derivatives))
+
+    # Precompute the observation indicator arrays per node.
+    observation_index = get_observation_index(
+            T,
+            state_space_shape,
+            observable_nodes,
+            observable_axes,
+            iid_observations)
 
     # Precompute conditional likelihood arrays per node.
     node_to_array = get_conditional_likelihoods(
@@ -265,7 +430,8 @@ def process_json_in(j_in):
             state_space_shape,
             observable_nodes,
             observable_axes,
-            iid_observations)
+            iid_observations,
+            observation_index=observation_index)
 
     # Get likelihoods at the root.
     # These are passed to the derivatives procedure,
@@ -276,15 +442,17 @@ def process_json_in(j_in):
     
     # Compute the derivative of the likelihood
     # with respect to each edge-specific rate scaling parameter.
+    # Only the requested edges are visited by the outside pass.
     requested_derivative_edge_indices = set(requested_derivatives)
-    ei_to_derivatives = get_edge_derivatives(
+    ei_to_derivatives = get_edge_derivatives_by_outside_pass(
             f, requested_derivative_edge_indices,
             node_to_array, distn,
             T, root, edges, edge_rate_pairs, edge_process_pairs,
             state_space_shape,
             observable_nodes,
             observable_axes,
-            iid_observations)
+            iid_observations,
+            observation_index=observation_index)
 
     # Apply the prior distribution and take logs of the likelihoods.
     log_likelihoods = np.log(likelihoods)
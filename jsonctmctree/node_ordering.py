@@ -17,8 +17,8 @@ def get_node_to_depth(T, root):
 
 def get_node_to_subtree_depth(T, root):
     subdepth = {}
-    for node in reversed(list(nx.bfs_nodes(T, root))):
-        successors = T.successors(tail)
+    for node in nx.dfs_postorder_nodes(T, root):
+        successors = T.successors(node)
         if not successors:
             subdepth[node] = 0
         else:
@@ -55,3 +55,20 @@ def get_node_evaluation_order(T, root):
                 pairs = [(thickness[x], x) for x in successors]
                 progeny = [x for w, x in sorted(pairs)]
                 stack.extend([n] + progeny)
+
+
+def get_node_evaluation_levels(T, root):
+    """
+    Group the nodes into levels whose nodes can be evaluated concurrently.
+
+    Each node is in the level given by the depth of its subtree,
+    so all of its children are in earlier levels.
+    Within a level, nodes are listed in the order
+    of get_node_evaluation_order.
+
+    """
+    subdepth = get_node_to_subtree_depth(T, root)
+    levels = [[] for i in range(subdepth[root] + 1)]
+    for node in get_node_evaluation_order(T, root):
+        levels[subdepth[node]].append(node)
+    return levels
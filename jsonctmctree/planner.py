@@ -0,0 +1,300 @@
+"""
+Plan the intermediate arrays used to respond to requests.
+
+The responses to the requested core properties are computed from
+a few intermediate arrays, some of which require a pass over the tree
+and some of which can be computed from any of several other arrays.
+These arrays and their dependencies form a directed acyclic graph.
+A plan chooses a source for each array, which determines the number
+of passes over the tree, and an order of the steps that create arrays,
+check feasibility, and respond to requests.
+Each array is deleted as soon as the steps that use it are complete,
+so the order determines the peak memory.
+
+Memory is measured in floats per observation pattern, not counting
+the workspace of the passes over the tree.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+from collections import namedtuple
+from itertools import product
+
+__all__ = ['Step', 'Plan', 'make_plan']
+
+
+ROOT_CONDITIONAL = 'root_conditional_likelihoods'
+NODE_TO_CONDITIONAL = 'node_to_conditional_likelihoods'
+NODE_TO_SUBTREE = 'node_to_subtree_likelihoods'
+NODE_TO_MARGINAL = 'node_to_marginal_distn'
+LIKELIHOODS = 'likelihoods'
+LOG_LIKELIHOODS = 'log_likelihoods'
+DERIVATIVES = 'derivatives'
+ROOT_MARGINAL = 'root_marginal_distn'
+
+# The alternative sources of each intermediate array, in order of preference.
+_SOURCES = {
+        ROOT_CONDITIONAL : [()],
+        NODE_TO_CONDITIONAL : [()],
+        NODE_TO_SUBTREE : [()],
+        NODE_TO_MARGINAL : [(NODE_TO_SUBTREE, )],
+        LIKELIHOODS : [
+            (ROOT_CONDITIONAL, ),
+            (NODE_TO_SUBTREE, ),
+            (NODE_TO_CONDITIONAL, )],
+        LOG_LIKELIHOODS : [(LIKELIHOODS, )],
+        DERIVATIVES : [(LIKELIHOODS, NODE_TO_CONDITIONAL)],
+        ROOT_MARGINAL : [
+            (NODE_TO_MARGINAL, ),
+            (ROOT_CONDITIONAL, ),
+            (NODE_TO_SUBTREE, ),
+            (NODE_TO_CONDITIONAL, )],
+        }
+
+# The number of passes over the tree used to create each array.
+# The derivatives use an outside pass.
+_PASSES = {
+        ROOT_CONDITIONAL : 1,
+        NODE_TO_CONDITIONAL : 1,
+        NODE_TO_SUBTREE : 1,
+        NODE_TO_MARGINAL : 1,
+        LIKELIHOODS : 0,
+        LOG_LIKELIHOODS : 0,
+        DERIVATIVES : 1,
+        ROOT_MARGINAL : 0,
+        }
+
+# The arrays used to respond to each core property.
+_RESPONSE_SOURCES = {
+        'logl' : (LOG_LIKELIHOODS, ),
+        'deri' : (DERIVATIVES, ),
+        'root' : (ROOT_MARGINAL, ),
+        'node' : (NODE_TO_MARGINAL, ),
+        'dwel' : (NODE_TO_SUBTREE, NODE_TO_MARGINAL),
+        'tran' : (NODE_TO_SUBTREE, NODE_TO_MARGINAL),
+        }
+
+# The order in which ready steps are preferred among equally good plans.
+_CREATE_ORDER = (
+        LIKELIHOODS, LOG_LIKELIHOODS, NODE_TO_CONDITIONAL, NODE_TO_SUBTREE,
+        DERIVATIVES, ROOT_CONDITIONAL, ROOT_MARGINAL, NODE_TO_MARGINAL)
+_RESPONSE_ORDER = ('root', 'logl', 'deri', 'node', 'dwel', 'tran')
+
+
+class Step(namedtuple('Step', 'action name sources')):
+    """
+    A step of a plan.
+
+    The action is one of 'create', 'delete', 'check', or 'respond'.
+    The name is an intermediate array, or a core property
+    for 'respond' steps.  The sources are the names
+    of the arrays used by the step.
+
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        if self.action == 'create':
+            return 'create %s from %s' % (
+                    self.name, ', '.join(self.sources) or 'the tree')
+        if self.action == 'check':
+            return 'check feasibility'
+        if self.action == 'respond':
+            return 'respond to "%s" requests' % self.name
+        return '%s %s' % (self.action, self.name)
+
+
+class Plan(object):
+    """
+    A schedule of steps for responding to requests.
+
+    Attributes
+    ----------
+    steps : list of Step
+        The steps in order of execution.
+    sources : dict
+        Maps each created array to the arrays it is computed from.
+    passes : integer
+        The number of passes over the tree.
+    peak : integer
+        The peak memory in floats per observation pattern.
+
+    """
+    def __init__(self, steps, sources, passes, peak):
+        self.steps = steps
+        self.sources = sources
+        self.passes = passes
+        self.peak = peak
+
+    def __str__(self):
+        lines = ['plan with %d passes over the tree and '
+                 'peak memory of %d floats per pattern:' % (
+                     self.passes, self.peak)]
+        for step in self.steps:
+            lines.append('  ' + str(step))
+        return '\n'.join(lines)
+
+
+def _get_sizes(nstates, nnodes, nedges):
+    # The number of floats per pattern of each array.
+    return {
+            ROOT_CONDITIONAL : nstates,
+            NODE_TO_CONDITIONAL : nnodes * nstates,
+            NODE_TO_SUBTREE : nnodes * nstates,
+            NODE_TO_MARGINAL : nnodes * nstates,
+            LIKELIHOODS : 1,
+            LOG_LIKELIHOODS : 1,
+            DERIVATIVES : nedges,
+            ROOT_MARGINAL : nstates,
+            }
+
+
+def _get_workspace(core_property, nstates, nedges):
+    # The number of floats per pattern used while responding to requests.
+    # Dwell times may be computed for all states at once.
+    if core_property == 'dwel':
+        return nedges * nstates
+    if core_property == 'tran':
+        return nedges
+    return 0
+
+
+def _gen_source_choices(core_properties):
+    # Yield each distinct choice of sources of the needed arrays.
+    names = sorted(_SOURCES)
+    seen = set()
+    for indices in product(*[range(len(_SOURCES[n])) for n in names]):
+        choice = dict((n, _SOURCES[n][i]) for n, i in zip(names, indices))
+        sources = {}
+        stack = [LIKELIHOODS]
+        for p in core_properties:
+            stack.extend(_RESPONSE_SOURCES[p])
+        while stack:
+            name = stack.pop()
+            if name not in sources:
+                sources[name] = choice[name]
+                stack.extend(choice[name])
+        key = tuple(sorted(sources.items()))
+        if key not in seen:
+            seen.add(key)
+            yield sources
+
+
+def _schedule(core_properties, sources, sizes, workspace):
+    # Find an order of the steps that minimizes the peak memory.
+    # Returns the peak memory and the steps including deletions.
+    # Among equally good orders, feasibility is checked
+    # and requests are met as early as possible.
+    steps = [Step('check', None, (LIKELIHOODS, ))]
+    for p in _RESPONSE_ORDER:
+        if p in core_properties:
+            steps.append(Step('respond', p, _RESPONSE_SOURCES[p]))
+    for name in _CREATE_ORDER:
+        if name in sources:
+            steps.append(Step('create', name, sources[name]))
+
+    # Each step requires the creation of its sources,
+    # and each response requires the feasibility check.
+    created_by = dict((s.name, i) for i, s in enumerate(steps)
+                      if s.action == 'create')
+    check = 0
+    requirements = []
+    consumers = dict((name, set()) for name in sources)
+    for i, step in enumerate(steps):
+        req = set(created_by[name] for name in step.sources)
+        if step.action == 'respond':
+            req.add(check)
+        requirements.append(frozenset(req))
+        for name in step.sources:
+            consumers[name].add(i)
+
+    def live_size(done):
+        return sum(sizes[name] for name, i in created_by.items()
+                   if i in done and not consumers[name] <= done)
+
+    # Search the orders by dynamic programming over the sets of done steps.
+    memo = {}
+
+    def best(done):
+        if len(done) == len(steps):
+            return 0, ()
+        if done in memo:
+            return memo[done]
+        live = live_size(done)
+        result = None
+        for i, step in enumerate(steps):
+            if i in done or not requirements[i] <= done:
+                continue
+            during = live
+            if step.action == 'create':
+                during += sizes[step.name]
+            elif step.action == 'respond':
+                during += workspace[step.name]
+            peak, order = best(done | frozenset([i]))
+            candidate = (max(during, peak), (i, ) + order)
+            if result is None or candidate[0] < result[0]:
+                result = candidate
+        memo[done] = result
+        return result
+
+    peak, order = best(frozenset())
+
+    # Delete each array after its last consumer.
+    scheduled = []
+    done = set()
+    for i in order:
+        scheduled.append(steps[i])
+        done.add(i)
+        for name in _CREATE_ORDER:
+            if name in created_by and created_by[name] in done:
+                if consumers[name] and i in consumers[name]:
+                    if consumers[name] <= done:
+                        scheduled.append(Step('delete', name, ()))
+    return peak, scheduled
+
+
+def make_plan(core_properties, nstates, nnodes, nedges, budget=None):
+    """
+    Choose the sources and the order of the steps.
+
+    Among the plans whose peak memory is within the budget,
+    the plan with the fewest passes over the tree is chosen,
+    with ties broken by the peak memory.
+    If no plan is within the budget then the plan
+    with the smallest peak memory is chosen.
+
+    Parameters
+    ----------
+    core_properties : collection of strings
+        The requested core properties, like 'logl' or 'dwel'.
+    nstates : integer
+        The number of states.
+    nnodes : integer
+        The number of nodes of the tree.
+    nedges : integer
+        The number of edges of the tree.
+    budget : integer, optional
+        The peak memory budget in floats per observation pattern.
+
+    Returns
+    -------
+    plan : Plan
+        The chosen plan.
+
+    """
+    core_properties = set(core_properties)
+    unknown = core_properties - set(_RESPONSE_SOURCES)
+    if unknown:
+        raise ValueError('unrecognized core properties: %s' % sorted(unknown))
+    sizes = _get_sizes(nstates, nnodes, nedges)
+    workspace = dict(
+            (p, _get_workspace(p, nstates, nedges)) for p in core_properties)
+    plans = []
+    for sources in _gen_source_choices(core_properties):
+        passes = sum(_PASSES[name] for name in sources)
+        peak, steps = _schedule(core_properties, sources, sizes, workspace)
+        plans.append(Plan(steps, sources, passes, peak))
+    within = [p for p in plans if budget is None or p.peak <= budget]
+    if within:
+        return min(within, key=lambda p: (p.passes, p.peak))
+    return min(plans, key=lambda p: (p.peak, p.passes))
@@ -23,6 +23,14 @@ class HighLevelInterface(object):
         return self._adjoint()
     def dot(self, other):
         return self._matmat(other)
+    def dot_into(self, other, out):
+        # Write the product into the preallocated array out,
+        # which must not share memory with other.
+        return self._matmat_into(other, out)
+    def _matmat_into(self, other, out):
+        # Operators that can write their products in place override this.
+        out[...] = self._matmat(other)
+        return out
 
 
 class VanillaAdjointOperator(HighLevelInterface):
@@ -64,6 +72,11 @@ class ExtendedAdjointOperator(HighLevelInterface):
         return self._L.dtype
     def _matmat(self, other):
         return self._L._my_adjoint_matmat(other)
+    def _matmat_into(self, other, out):
+        if hasattr(self._L, '_my_adjoint_matmat_into'):
+            return self._L._my_adjoint_matmat_into(other, out)
+        out[...] = self._L._my_adjoint_matmat(other)
+        return out
     def abs_sum_axis_0(self):
         return self._L.abs_sum_axis_1()
     def abs_sum_axis_1(self):
@@ -0,0 +1,327 @@
+"""
+Predict the costs of explicit vs. abstract matrix exponential actions.
+
+The action of a matrix exponential on a block of columns can be computed
+either by computing the explicit transition matrix once per distinct
+scaling factor and then multiplying dense matrices,
+or by the truncated Taylor series iterations of the abstract
+linear operator approach, whose number of sparse matrix products
+depends on the 1-norm of the scaled rate matrix.
+The better choice depends on the number of states, the number
+of nonzero rates, the scaling factors of the edges that share the process,
+and the number of columns.
+
+The flop counts are converted to seconds by a few machine-dependent
+constants, which can be fitted on the host machine by calibrate().
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import timeit
+
+import numpy as np
+import scipy.sparse
+
+from .constants import THETA
+
+__all__ = [
+        'CostModel', 'calibrate',
+        'get_default_cost_model', 'set_default_cost_model']
+
+
+# The theta values of the truncated Taylor series, ordered by degree.
+_THETA_M = np.array(sorted(THETA), dtype=int)
+_THETA = np.array([THETA[m] for m in sorted(THETA)])
+
+# The scaling-and-squaring threshold of the degree 13 Pade approximation.
+_PADE_13_THETA = 5.371920351148152
+
+# The dense flops of a symmetric eigendecomposition with eigenvectors
+# and of the least squares stationary distribution, in units of n**3.
+_SPECTRAL_FLOPS = 10
+
+
+def _get_taylor_matmat_count(one_norm, t):
+    # Estimate the number of matrix products used by the
+    # truncated Taylor series, using only the 1-norm of the matrix.
+    # This is the small-norm branch of fragment 3.1.
+    onenorm = one_norm * abs(t)
+    if not onenorm:
+        return 0
+    s = np.ceil(onenorm / _THETA)
+    return int(np.min(_THETA_M * s))
+
+
+def _get_expm_matmul_count(one_norm, t):
+    # Estimate the number of dense matrix products used by
+    # scaling and squaring with the degree 13 Pade approximation,
+    # counting the linear solve as two products.
+    onenorm = one_norm * abs(t)
+    if not onenorm:
+        return 0
+    nsquarings = max(0, int(np.ceil(np.log2(onenorm / _PADE_13_THETA))))
+    return 8 + nsquarings
+
+
+class CostModel(object):
+    """
+    Predict the seconds used by the explicit and abstract strategies.
+
+    Parameters
+    ----------
+    dense_flop_time : float, optional
+        Seconds per flop of a dense matrix product.
+    sparse_flop_time : float, optional
+        Seconds per flop of a sparse matrix product with dense columns.
+    call_overhead : float, optional
+        Seconds of interpreter overhead per matrix product.
+    max_dense_nstates : integer, optional
+        Never use the explicit strategy for larger state spaces,
+        to bound the memory used by dense transition matrices.
+
+    """
+    # A nominal workload for choices that are made before
+    # the scaling factors and the number of columns are known.
+    nominal_ncols = 100
+
+    def __init__(self, dense_flop_time=1e-9, sparse_flop_time=4e-9,
+            call_overhead=2e-5, max_dense_nstates=5000):
+        self.dense_flop_time = dense_flop_time
+        self.sparse_flop_time = sparse_flop_time
+        self.call_overhead = call_overhead
+        self.max_dense_nstates = max_dense_nstates
+
+    def __repr__(self):
+        return ('CostModel(dense_flop_time=%r, sparse_flop_time=%r, '
+                'call_overhead=%r, max_dense_nstates=%r)' % (
+                    self.dense_flop_time, self.sparse_flop_time,
+                    self.call_overhead, self.max_dense_nstates))
+
+    def predict_dense(self, n, one_norm, ts, ncols, npasses=1):
+        """
+        Predict the seconds used by the explicit strategy.
+
+        Parameters
+        ----------
+        n : integer
+            The number of states.
+        one_norm : float
+            The 1-norm of the rate matrix.
+        ts : sequence of floats
+            The scaling factors of the edges that share the process.
+        ncols : integer
+            The number of columns of each matrix exponential action.
+        npasses : integer, optional
+            The number of actions per edge.
+
+        """
+        ts = np.unique(np.asarray(ts, dtype=float))
+        nmatmuls = sum(_get_expm_matmul_count(one_norm, t) for t in ts)
+        expm_seconds = nmatmuls * (
+                2 * n**3 * self.dense_flop_time + self.call_overhead)
+        action_seconds = len(ts) * npasses * (
+                2 * n**2 * ncols * self.dense_flop_time + self.call_overhead)
+        return expm_seconds + action_seconds
+
+    def predict_abstract(self, n, nnz, one_norm, ts, ncols, npasses=1):
+        """
+        Predict the seconds used by the abstract linear operator strategy.
+
+        Parameters
+        ----------
+        n : integer
+            The number of states.
+        nnz : integer
+            The number of nonzero off-diagonal rates.
+        one_norm : float
+            The 1-norm of the shifted rate matrix.
+        ts : sequence of floats
+            The scaling factors of the edges that share the process.
+        ncols : integer
+            The number of columns of each matrix exponential action.
+        npasses : integer, optional
+            The number of actions per edge.
+
+        """
+        nmatmats = sum(_get_taylor_matmat_count(one_norm, t) for t in ts)
+        return npasses * nmatmats * (
+                2 * (nnz + n) * ncols * self.sparse_flop_time +
+                self.call_overhead)
+
+    def predict_spectral(self, n, ts, ncols, npasses=1):
+        """
+        Predict the seconds used by a time-reversible decomposition.
+
+        The rate matrix is decomposed once, after which each action
+        uses two dense products regardless of the scaling factor.
+
+        Parameters
+        ----------
+        n : integer
+            The number of states.
+        ts : sequence of floats
+            The scaling factors of the edges that share the process.
+        ncols : integer
+            The number of columns of each matrix exponential action.
+        npasses : integer, optional
+            The number of actions per edge.
+
+        """
+        decomposition_seconds = _SPECTRAL_FLOPS * n**3 * self.dense_flop_time
+        action_seconds = len(ts) * npasses * 2 * (
+                2 * n**2 * ncols * self.dense_flop_time + self.call_overhead)
+        return decomposition_seconds + action_seconds
+
+    def prefer_dense(self, n, nnz, one_norm, ts=(1.0,), ncols=None,
+            npasses=1):
+        """
+        Return True if the explicit strategy is predicted to be cheaper.
+
+        The 1-norm is the norm of the shifted rate matrix
+        used by the abstract strategy;
+        the explicit strategy uses an upper bound of the norm
+        of the unshifted rate matrix.
+
+        """
+        if n > self.max_dense_nstates:
+            return False
+        if ncols is None:
+            ncols = self.nominal_ncols
+        if not len(ts):
+            return True
+        dense = self.predict_dense(n, 2 * one_norm, ts, ncols, npasses)
+        abstract = self.predict_abstract(n, nnz, one_norm, ts, ncols, npasses)
+        return dense <= abstract
+
+    def prefer_kronecker(self, nnz, dense_flops, sparse_flops, nproducts,
+            ncols=None):
+        """
+        Return True if a Kronecker sum product is predicted to be cheaper
+        than the product with the full sparse rate matrix.
+
+        Parameters
+        ----------
+        nnz : integer
+            The number of nonzero off-diagonal rates.
+        dense_flops : integer
+            The dense flops per column of the Kronecker sum product.
+        sparse_flops : integer
+            The sparse flops per column of the Kronecker sum product.
+        nproducts : integer
+            The number of matrix products of the Kronecker sum product.
+        ncols : integer, optional
+            The number of columns of each product.
+
+        """
+        if ncols is None:
+            ncols = self.nominal_ncols
+        kronecker = nproducts * self.call_overhead + ncols * (
+                dense_flops * self.dense_flop_time +
+                sparse_flops * self.sparse_flop_time)
+        sparse = self.call_overhead + ncols * (
+                2 * nnz * self.sparse_flop_time)
+        return kronecker < sparse
+
+    def prefer_spectral(self, n, nnz, one_norm, ts=(1.0,), ncols=None,
+            npasses=1):
+        """
+        Return True if a time-reversible decomposition is predicted
+        to be cheaper than the abstract strategy.
+
+        This is checked before the rate matrix is tested for
+        time-reversibility, which itself requires dense matrices.
+
+        """
+        if n > self.max_dense_nstates:
+            return False
+        if ncols is None:
+            ncols = self.nominal_ncols
+        if not len(ts):
+            return True
+        spectral = self.predict_spectral(n, ts, ncols, npasses)
+        abstract = self.predict_abstract(n, nnz, one_norm, ts, ncols, npasses)
+        return spectral <= abstract
+
+
+_default_cost_model = CostModel()
+
+
+def get_default_cost_model():
+    return _default_cost_model
+
+
+def set_default_cost_model(cost_model):
+    """
+    Set the cost model used to choose between the strategies.
+
+    For example set_default_cost_model(calibrate()) fits the constants
+    on the host machine.
+
+    """
+    global _default_cost_model
+    _default_cost_model = cost_model
+
+
+def _get_seconds(f, repeat):
+    return min(timeit.repeat(f, number=1, repeat=repeat))
+
+
+def calibrate(sizes=(50, 100, 200, 400), ncols=50, repeat=5):
+    """
+    Fit the constants of the cost model on the host machine.
+
+    Dense and sparse matrix products are timed for several
+    numbers of states, and the time per flop and the overhead per call
+    are fitted by least squares.
+
+    Parameters
+    ----------
+    sizes : sequence of integers, optional
+        The numbers of states of the benchmark matrices.
+    ncols : integer, optional
+        The number of columns of the benchmark products.
+    repeat : integer, optional
+        The best of this many timings is used for each product.
+
+    Returns
+    -------
+    cost_model : CostModel
+        The fitted cost model.
+
+    """
+    # Use a private random number generator,
+    # so that the state of the global generator is not changed.
+    rng = np.random.RandomState(1234)
+    dense_flops, dense_seconds = [], []
+    sparse_flops, sparse_seconds = [], []
+    for n in sizes:
+        A = rng.randn(n, n)
+        B = rng.randn(n, ncols)
+        dense_flops.append(2 * n * n * ncols)
+        dense_seconds.append(_get_seconds(lambda: A.dot(B), repeat))
+
+        # A sparse matrix with about as many nonzero rates per state
+        # as a codon model has.
+        density = min(1.0, 10 / n)
+        R = scipy.sparse.rand(n, n, density=density, format='csr',
+                random_state=rng)
+        d = rng.randn(n)
+        nnz = R.nnz
+        sparse_flops.append(2 * (nnz + n) * ncols)
+        sparse_seconds.append(_get_seconds(
+            lambda: R.dot(B) + d[:, np.newaxis] * B, repeat))
+
+    # Fit seconds = flop_time * flops + overhead.
+    dense_flop_time, dense_overhead = np.polyfit(
+            dense_flops, dense_seconds, 1)
+    sparse_flop_time, sparse_overhead = np.polyfit(
+            sparse_flops, sparse_seconds, 1)
+    tiny = np.finfo(float).tiny
+    return CostModel(
+            dense_flop_time=max(dense_flop_time, tiny),
+            sparse_flop_time=max(sparse_flop_time, tiny),
+            call_overhead=max(dense_overhead, sparse_overhead, 0))
+
+
+if __name__ == '__main__':
+    print(calibrate())
@@ -4,20 +4,56 @@ Define some custom linear operators.
 """
 from __future__ import division, print_function, absolute_import
 
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
 import numpy as np
 
 import scipy.linalg
+import scipy.sparse
 from scipy.linalg import get_lapack_funcs
 
+# The private sparsetools module lets a sparse product accumulate
+# into a preallocated array; fall back to R.dot if it has moved.
+try:
+    from scipy.sparse import _sparsetools
+except ImportError:
+    _sparsetools = None
+
 from .experimental import IterationStash
+from .cost_model import get_default_cost_model
 from .basic_ops import (
         HighLevelInterface, VanillaAdjointOperator,
         ConcreteInterface, ExtendedAdjointOperator, ExtendedMatrixOperator)
 
 
-__all__ = ['RdOperator', 'RdcOperator', 'RdCOperator',
+__all__ = ['RdOperator', 'RdcOperator', 'RdCOperator', 'RdCStackOperator',
            'Propagator', 'ExplicitPropagator', 'SmarterPropagator',
-           'MatrixExponential']
+           'MatrixExponential', 'CacheInfo']
+
+
+# Statistics of a cache of explicit matrix exponentials,
+# like the named tuple returned by functools.lru_cache in Python 3.
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+def _sparse_diag_matmat_into(R, d, other, out):
+    # Compute R.dot(other) + d[:, np.newaxis] * other, writing into out.
+    # R is a csr matrix and out must not share memory with other.
+    # If scipy exposes its sparsetools and the dense arrays are
+    # C-contiguous with the dtype of R then the sparse product
+    # is accumulated into out directly without temporary arrays.
+    np.multiply(d[:, np.newaxis], other, out=out)
+    if (
+            _sparsetools is not None and
+            out.flags.c_contiguous and other.flags.c_contiguous and
+            out.dtype == R.dtype and other.dtype == R.dtype):
+        M, N = R.shape
+        _sparsetools.csr_matvecs(M, N, other.shape[1],
+                R.indptr, R.indices, R.data, other.ravel(), out.ravel())
+    else:
+        out += R.dot(other)
+    return out
 
 
 class RdOperator(HighLevelInterface, ConcreteInterface):
@@ -42,6 +78,8 @@ class RdOperator(HighLevelInterface, ConcreteInterface):
         self._d_abs = np.abs(d)
         self.args = R, d
         self._RT = None
+        self._R_csr = None
+        self._RT_csr = None
         self._abs_sum_axis_0 = None
         self._abs_sum_axis_1 = None
         self._init_concrete_cache()
@@ -64,6 +102,16 @@ class RdOperator(HighLevelInterface, ConcreteInterface):
             self._RT = self._R.T
         return self._RT.dot(other) + self._d[:, np.newaxis] * other
 
+    def _matmat_into(self, other, out):
+        if self._R_csr is None:
+            self._R_csr = scipy.sparse.csr_matrix(self._R)
+        return _sparse_diag_matmat_into(self._R_csr, self._d, other, out)
+
+    def _my_adjoint_matmat_into(self, other, out):
+        if self._RT_csr is None:
+            self._RT_csr = scipy.sparse.csr_matrix(self._R.T)
+        return _sparse_diag_matmat_into(self._RT_csr, self._d, other, out)
+
 
 class RdcOperator(HighLevelInterface, ConcreteInterface):
     # R+d  c
@@ -157,6 +205,63 @@ class RdCOperator(HighLevelInterface, ConcreteInterface):
         return M
 
 
+class RdCStackOperator(HighLevelInterface, ConcreteInterface):
+    # R+d   0   ...   0   C1
+    #  0   R+d  ...   0   C2
+    #            ...
+    #  0    0   ...  R+d  Ck
+    #  0    0   ...   0   R+d
+    def __init__(self, Rd, Cs):
+        k = len(Cs) + 1
+        self.dtype = Rd.dtype
+        self.shape = Rd.shape[0]*k, Rd.shape[1]*k
+        self._Rd = Rd
+        self._Cs = [ExtendedMatrixOperator(C) for C in Cs]
+        self._CHs = None
+        self.args = Rd, Cs
+        self._abs_sum_axis_0 = None
+        self._abs_sum_axis_1 = None
+        self._init_concrete_cache()
+
+    def abs_sum_axis_0(self):
+        if self._abs_sum_axis_0 is None:
+            last = self._Rd.abs_sum_axis_0().copy()
+            for C in self._Cs:
+                last += C.abs_sum_axis_0()
+            self._abs_sum_axis_0 = np.concatenate(
+                    [self._Rd.abs_sum_axis_0()] * len(self._Cs) + [last])
+        return self._abs_sum_axis_0
+
+    def abs_sum_axis_1(self):
+        if self._abs_sum_axis_1 is None:
+            self._abs_sum_axis_1 = np.concatenate(
+                    [self._Rd.abs_sum_axis_1() + C.abs_sum_axis_1()
+                        for C in self._Cs] + [self._Rd.abs_sum_axis_1()])
+        return self._abs_sum_axis_1
+
+    def _matmat(self, other):
+        n = self._Rd.shape[0]
+        last = other[-n:, :]
+        M = np.empty_like(other)
+        for i, C in enumerate(self._Cs):
+            M[i*n:(i+1)*n, :] = (self._Rd.dot(other[i*n:(i+1)*n, :]) +
+                                 C.dot(last))
+        M[-n:, :] = self._Rd.dot(last)
+        return M
+
+    def _my_adjoint_matmat(self, other):
+        n = self._Rd.shape[0]
+        if self._CHs is None:
+            self._CHs = [C.H for C in self._Cs]
+        M = np.empty_like(other)
+        M[-n:, :] = self._Rd._my_adjoint_matmat(other[-n:, :])
+        for i, CH in enumerate(self._CHs):
+            block = other[i*n:(i+1)*n, :]
+            M[i*n:(i+1)*n, :] = self._Rd._my_adjoint_matmat(block)
+            M[-n:, :] += CH.dot(block)
+        return M
+
+
 def _expm_product_helper(A, mu, iteration_stash, t, B):
     # Estimate expm(t*M).dot(B).
     # A = M - mu*I
@@ -192,6 +297,115 @@ def _expm_product_helper(A, mu, iteration_stash, t, B):
     return F
 
 
+def _column_inf_norms(X):
+    # The infinity norm of each column of a 2d array,
+    # without temporary arrays of the size of X.
+    return np.maximum(X.max(axis=0), -X.min(axis=0))
+
+
+def _compact_columns(X, keep, storage):
+    # Copy the kept columns of X into a C-contiguous 2d array
+    # that uses the memory of the flat storage array.
+    # If X itself uses that memory then numpy buffers the copy
+    # through a temporary array of the size of the output.
+    n = X.shape[0]
+    k = np.count_nonzero(keep)
+    out = storage[:n*k].reshape(n, k)
+    np.compress(keep, X, axis=1, out=out)
+    return out
+
+
+def _expm_product_helper_inplace(A, mu, iteration_stash, t, B):
+    # Estimate expm(t*M).dot(B).
+    # This is like _expm_product_helper except that it uses
+    # preallocated work buffers instead of allocating new arrays
+    # for each term of the Taylor series, and the products of A
+    # are written into the buffers by A.dot_into.
+    #
+    # Convergence of the Taylor series is tracked per column,
+    # and converged columns are dropped from the active working set
+    # so that only the remaining columns are multiplied by A.
+    # The active columns are compacted into the memory
+    # of the work buffers, so the work buffers are not reallocated
+    # as the working set shrinks.  After the first deflation the active
+    # columns of the sum are compacted within their own buffer,
+    # and numpy copies them through a temporary to do this.
+    #
+    # The infinity norm of each column of the accumulated sum F
+    # is tracked by the triangle inequality bounds
+    # |F| - |B| <= |F + B| <= |F| + |B|,
+    # and the exact norms are computed only when the bounds
+    # cannot decide the convergence test.
+
+    # Compute some input-dependent constants.
+    tol = np.ldexp(1, -53)
+    n, n0 = B.shape
+    m, s = iteration_stash.fragment_3_1(n0, t)
+    if not s:
+        return B
+
+    # Allocate the work buffers.
+    dtype = np.result_type(A.dtype, B.dtype, float)
+    F = np.array(B, dtype=dtype, order='C')
+    if not n0:
+        return F
+    X_storage = np.empty(F.size, dtype=dtype)
+    Y_storage = np.empty(F.size, dtype=dtype)
+    F_storage = None
+
+    eta = np.exp(t*mu / float(s))
+    for i in range(s):
+        active = np.arange(n0)
+        Fa = F
+        Xs, Ys = X_storage, Y_storage
+        Xa = Xs.reshape(n, n0)
+        Ya = Ys.reshape(n, n0)
+        Xa[...] = F
+        c1 = _column_inf_norms(Xa)
+        F_lower = F_upper = c1
+        for j in range(m):
+            coeff = t / float(s*(j+1))
+            A.dot_into(Xa, Ya)
+            Ya *= coeff
+            c2 = _column_inf_norms(Ya)
+            Fa += Ya
+            F_lower = np.maximum(F_lower - c2, 0)
+            F_upper = F_upper + c2
+            c = c1 + c2
+            if np.any((tol * F_lower < c) & (c <= tol * F_upper)):
+                F_lower = F_upper = _column_inf_norms(Fa)
+            converged = c <= tol * F_lower
+            if np.all(converged):
+                break
+
+            # The new term is the input of the next product.
+            c1 = c2
+            Xa, Ya = Ya, Xa
+            Xs, Ys = Ys, Xs
+
+            # Drop the converged columns from the working set.
+            if np.any(converged):
+                keep = ~converged
+                k = n * np.count_nonzero(keep)
+                if Fa is F:
+                    if F_storage is None or F_storage.size < k:
+                        F_storage = np.empty(k, dtype=dtype)
+                else:
+                    F[:, active[converged]] = Fa[:, converged]
+                Fa = _compact_columns(Fa, keep, F_storage)
+                Xa = _compact_columns(Xa, keep, Ys)
+                Xs, Ys = Ys, Xs
+                Ya = Ys[:k].reshape(Xa.shape)
+                active = active[keep]
+                c1 = c1[keep]
+                F_lower = F_lower[keep]
+                F_upper = F_upper[keep]
+        if Fa is not F:
+            F[:, active] = Fa
+        F *= eta
+    return F
+
+
 class SmarterPropagator(object):
     """
     Wraps a sparse rate matrix.
@@ -200,26 +414,29 @@ class SmarterPropagator(object):
     matrix exponential calculation or use an abstract linear operator
     to compute matrix exponential vector products.
 
-    Ideally the cutoff would depend on not only the size of the state
-    space but also properties such as norms of powers of the rate matrix.
+    The choice is made by a cost model that depends on the size
+    of the state space, the number of nonzero rates,
+    and the 1-norm of the rate matrix.
 
     """
-    def __init__(self, M):
+    def __init__(self, M, cost_model=None):
         # M is a sparse matrix of non-negative rates.
         self.shape = M.shape
         self.dtype = M.dtype
 
         # Compute exit rates.
         exit_rates = M.sum(axis=1).A.ravel()
+        d = -exit_rates
+        mu = np.mean(d)
+        op = RdOperator(M, d - mu)
 
         # Determine whether to use abstract or explicit linear operators.
-        if exit_rates.shape[0] < 100:
+        if cost_model is None:
+            cost_model = get_default_cost_model()
+        if cost_model.prefer_dense(M.shape[0], M.nnz, op.one_norm()):
             Q = M - np.diag(exit_rates)
             self._P = ExplicitPropagator(Q)
         else:
-            d = -exit_rates
-            mu = np.mean(d)
-            op = RdOperator(M, d - mu)
             self._P = Propagator(op, mu)
 
     def _parameterized_matmat(self, t, B):
@@ -254,14 +471,27 @@ class Propagator(object):
         self._forward_iteration_stash = None
         self._adjoint_iteration_stash = None
 
+    def _get_forward_iteration_stash(self):
+        if self._forward_iteration_stash is None:
+            self._forward_iteration_stash = IterationStash(self._A)
+        return self._forward_iteration_stash
+
+    def prefetch(self, ts, n0=1):
+        # Select the iteration counts of the forward action
+        # for several scaling factors at once.
+        # Only the scaling factors that need the norms of matrix powers
+        # for n0 columns are included.
+        stash = self._get_forward_iteration_stash()
+        ts = [t for t in ts if not stash.condition_3_13(n0, t, 2)]
+        if ts:
+            stash.cmstar_batch(ts)
+
     def _parameterized_matmat(self, t, B):
         # Approximate expm(M*t).dot(B).
         # t is a scaling factor of L
         # B the input matrix of the linear function
-        if self._forward_iteration_stash is None:
-            self._forward_iteration_stash = IterationStash(self._A)
-        return _expm_product_helper(
-                self._A, self._mu, self._forward_iteration_stash, t, B)
+        return _expm_product_helper_inplace(
+                self._A, self._mu, self._get_forward_iteration_stash(), t, B)
 
     def _parameterized_adjoint_matmat(self, t, B):
         # Approximate expm(M.H*t).dot(B).
@@ -269,7 +499,7 @@ class Propagator(object):
         # B the input matrix of the adjoint linear function
         if self._adjoint_iteration_stash is None:
             self._adjoint_iteration_stash = IterationStash(self._A.H)
-        return _expm_product_helper(
+        return _expm_product_helper_inplace(
                 self._A.H, self._mu, self._adjoint_iteration_stash, t, B)
 
 
@@ -277,24 +507,122 @@ class ExplicitPropagator(object):
     """
     This explicitly computes the matrix exponential.
 
+    The same scaling factors recur across edges and across passes
+    over the tree, so the explicit matrix exponentials are kept
+    in a bounded least-recently-used cache keyed by the scaling factor.
+    The cache is bounded both by the number of matrices
+    and by the total bytes of the matrices,
+    so that large dense state spaces keep only a few matrices.
+    The forward and adjoint actions share the cached matrices,
+    because expm(M.H*t) is the transpose of expm(M*t) for real M.
+    The cache may be shared by threads that evaluate independent subtrees.
+
     """
-    def __init__(self, M):
+    def __init__(self, M, maxsize=128, maxbytes=2**26):
         # M is assumed to be an explicit ndarray.
+        # maxsize is the maximum number of cached matrix exponentials,
+        # and maxbytes is the maximum number of bytes of cached matrices,
+        # except that at least one matrix is cached if maxsize is positive.
         self.shape = M.shape
         self.dtype = M.dtype
         self._M = M
+        nbytes = M.shape[0] * M.shape[1] * np.dtype(float).itemsize
+        self._maxsize = min(maxsize, max(1, maxbytes // nbytes))
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def cache_info(self):
+        return CacheInfo(self._hits, self._misses,
+                self._maxsize, len(self._cache))
+
+    def cache_clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def _get_expm(self, t):
+        # Get expm(M*t), moving it to the most recently used position.
+        # The matrix exponential is computed outside of the lock.
+        key = float(t)
+        with self._lock:
+            P = self._cache.pop(key, None)
+            if P is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._cache[key] = P
+                return P
+        P = scipy.linalg.expm(self._M*t)
+        if self._maxsize > 0:
+            with self._lock:
+                self._cache[key] = P
+                while len(self._cache) > self._maxsize:
+                    self._cache.popitem(last=False)
+        return P
+
+    def prefetch(self, ts, max_condition_number=1e3):
+        """
+        Compute and cache the matrix exponentials for several scaling factors.
+
+        A single eigendecomposition of M is shared by all of the
+        scaling factors, so that the exponentials are computed
+        by one vectorized product instead of one expm call per factor.
+        If the eigenvectors are ill-conditioned, for example if M
+        is defective, then expm is called separately for each factor.
+        At most maxsize matrices are prefetched.
+
+        The error of the eigendecomposition grows faster than
+        the condition number of the eigenvectors, so a larger
+        max_condition_number trades accuracy for speed.
+        With the default, the prefetched matrices agree with expm
+        to about 1e-10 relative to their largest entry,
+        and rate matrices usually have much better conditioned
+        eigenvectors than this.
+
+        """
+        with self._lock:
+            ts = [t for t in np.unique(np.asarray(ts, dtype=float))
+                    if t not in self._cache]
+        ts = np.array(ts[:self._maxsize])
+        if not ts.size:
+            return
+        w, U = scipy.linalg.eig(self._M)
+        Ps = None
+        if np.linalg.cond(U) <= max_condition_number:
+            Uinv = scipy.linalg.inv(U)
+            W = np.exp(np.outer(ts, w))
+            Ps = np.einsum('ij,tj,jk->tik', U, W, Uinv)
+            if np.any(np.abs(Ps.imag) > 1e-8 * max(np.abs(Ps.real).max(), 1)):
+                Ps = None
+            else:
+                Ps = Ps.real
+        if Ps is None:
+            Ps = [scipy.linalg.expm(self._M*t) for t in ts]
+        # The eigendecomposition only approximates the identity
+        # for a zero scaling factor, whose transition matrix must be exact
+        # so that zero probabilities are not perturbed.
+        Ps = [np.eye(self.shape[0]) if not t else P for t, P in zip(ts, Ps)]
+        with self._lock:
+            for t, P in zip(ts, Ps):
+                self._misses += 1
+                self._cache[float(t)] = P
+            while len(self._cache) > self._maxsize:
+                self._cache.popitem(last=False)
 
     def _parameterized_matmat(self, t, B):
         # Approximate expm(M*t).dot(B).
         # t is a scaling factor of L
         # B the input matrix of the linear function
-        return scipy.linalg.expm(self._M*t).dot(B)
+        return self._get_expm(t).dot(B)
 
     def _parameterized_adjoint_matmat(self, t, B):
         # Approximate expm(M.H*t).dot(B).
         # t is a scaling factor of L
         # B the input matrix of the adjoint linear function
-        return scipy.linalg.expm(self._M.T*t).dot(B)
+        return self._get_expm(t).T.dot(B)
 
 
 class MatrixExponential(HighLevelInterface):
@@ -29,6 +29,9 @@ http://eprints.ma.man.ac.uk/1591/01/covered/MIMS_ep2010_30.pdf
 """
 from __future__ import division, print_function, absolute_import
 
+from collections import OrderedDict
+from threading import Lock
+
 import numpy as np
 
 from ._onenormest import onenormest
@@ -41,8 +44,10 @@ class IterationStash(object):
     """
     Stash information for computing iteration counts.
 
-    Some norms of matrix powers are pre-estimated for a given
-    matrix with zero trace.
+    Some norms of matrix powers are estimated for a given
+    matrix with zero trace.  These estimates are needed only
+    if the 1-norm of the scaled matrix is too large for the
+    cheaper condition (3.13), so they are made when first needed.
 
     These cached norms are subsequently used to compute
     iteration counts given a matrix scaling factor
@@ -54,29 +59,69 @@ class IterationStash(object):
     The second iteration count is related to the number
     of requested segments that the interval should be broken into.
 
+    The same scaling factors and numbers of columns recur
+    across passes over the tree, so the iteration counts are memoized
+    in bounded least-recently-used caches.
+
     """
-    def __init__(self, A):
+    def __init__(self, A, maxsize=1024):
         self._A = A
         self._mmax = MMAX
         self._pmax = PMAX
+        self._maxsize = maxsize
+        self._fragment_cache = OrderedDict()
+        self._cmstar_cache = OrderedDict()
+        self._lock = Lock()
+        self._init_lock = Lock()
 
         self._A_1_norm = A.one_norm()
         self._d = {1 : self._A_1_norm}
         self._alpha = {}
+        self._M = None
+
+        # The theta values ordered by m, for the vectorized fragment 3.1.
+        self._theta_m = np.array(sorted(THETA), dtype=int)
+        self._theta = np.array([THETA[m] for m in sorted(THETA)])
+
+    def _init_norm_matrix(self):
+        # This may be called by several threads,
+        # and the matrix M is assigned last.
+        with self._init_lock:
+            if self._M is not None:
+                return
+
+            # Initialize the S matrix.
+            self._S = np.zeros((self._pmax+1, self._mmax+1))
+            for p in range(2, self._pmax+1):
+                for m in range(p*(p-1)-1, self._mmax+1):
+                    if m in THETA:
+                        self._S[p, m] = self.alpha(p) / THETA[m]
+
+            # Remove connections to some values that had been used
+            # to create the _S matrix.
+            # Some other values are kept.
+            self._A = None
+            self._d = None
+            self._alpha = None
+
+            # Prepare a matrix that is like S except with inf replacing 0,
+            # and the column scaling used by cmstar.
+            row = np.arange(self._mmax + 1)
+            self._row = np.where(row == 0, np.inf, row)
+            self._M = np.where(self._S == 0, np.inf, self._S)
 
-        # Initialize the S matrix.
-        self._S = np.zeros((self._pmax+1, self._mmax+1))
-        for p in range(2, self._pmax+1):
-            for m in range(p*(p-1)-1, self._mmax+1):
-                if m in THETA:
-                    self._S[p, m] = self.alpha(p) / THETA[m]
+    def _cache_get(self, cache, key):
+        with self._lock:
+            value = cache.pop(key, None)
+            if value is not None:
+                cache[key] = value
+            return value
 
-        # Remove connections to some values that had been used
-        # to create the _S matrix.
-        # Some other values are kept.
-        self._A = None
-        self._d = None
-        self._alpha = None
+    def _cache_set(self, cache, key, value):
+        with self._lock:
+            cache[key] = value
+            while len(cache) > self._maxsize:
+                cache.popitem(last=False)
 
     def d(self, p):
         # This calculation requires computing a root of an estimate
@@ -103,7 +148,15 @@ class IterationStash(object):
         """
         if ell < 1:
             raise ValueError('expected ell to be a positive integer')
-        elif self.condition_3_13(n0, t, ell):
+        key = (n0, float(t), ell)
+        value = self._cache_get(self._fragment_cache, key)
+        if value is None:
+            value = self._fragment_3_1(n0, t, ell)
+            self._cache_set(self._fragment_cache, key, value)
+        return value
+
+    def _fragment_3_1(self, n0, t, ell):
+        if self.condition_3_13(n0, t, ell):
             onenorm = self._A_1_norm * t
             triples = []
             for m, theta in THETA.items():
@@ -145,17 +198,90 @@ class IterationStash(object):
         [ g h i ]               [ gu hv iw ]
 
         """
-        # Prepare a matrix that is like S except with inf replacing 0.
-        M = np.where(self._S == 0, np.inf, self._S)
-
-        # Transform entries of the matrix.
-        abst = np.abs(t)
-        row = np.arange(self._mmax + 1)
-        row = np.where(row == 0, np.inf, row)
-        M = np.ceil((abst * M) * row)
-
-        # Get the row and value of the smallest element.
-        r, c = np.unravel_index(np.argmin(M), M.shape)
-        mstar = c
-        value = int(M[r, c])
-        return mstar, value
+        key = float(t)
+        value = self._cache_get(self._cmstar_cache, key)
+        if value is None:
+            if self._M is None:
+                self._init_norm_matrix()
+
+            # Transform entries of the matrix.
+            M = np.ceil((np.abs(t) * self._M) * self._row)
+
+            # Get the row and value of the smallest element.
+            r, c = np.unravel_index(np.argmin(M), M.shape)
+            value = (c, int(M[r, c]))
+            self._cache_set(self._cmstar_cache, key, value)
+        return value
+
+    def cmstar_batch(self, ts):
+        """
+        Vectorized cmstar for several scaling factors at once.
+
+        The results are added to the memoization cache of cmstar.
+
+        """
+        ts = np.asarray(ts, dtype=float)
+        if self._M is None:
+            self._init_norm_matrix()
+        abst = np.abs(ts)[:, None, None]
+        M = np.ceil((abst * self._M) * self._row)
+        flat = M.reshape(M.shape[0], -1)
+        k = np.argmin(flat, axis=1)
+        mstars = k % M.shape[2]
+        values = flat[np.arange(flat.shape[0]), k].astype(int)
+        for t, mstar, value in zip(ts, mstars, values):
+            self._cache_set(self._cmstar_cache, float(t),
+                    (mstar, int(value)))
+        return mstars, values
+
+    def fragment_3_1_batch(self, n0, ts, ell=2):
+        """
+        Compute the iteration counts for several scaling factors at once.
+
+        The matrix scan of cmstar is vectorized over the scaling factors,
+        and the results are added to the memoization caches.
+
+        Parameters
+        ----------
+        n0 : integer
+            The number of columns on the right hand side.
+        ts : 1d ndarray
+            Matrix scaling factors.
+        ell : integer, optional
+            A parameter of the norm estimation.
+
+        Returns
+        -------
+        ms : 1d ndarray
+            The order of the taylor expansion for each scaling factor.
+        ss : 1d ndarray
+            The number of segments for each scaling factor.
+
+        """
+        if ell < 1:
+            raise ValueError('expected ell to be a positive integer')
+        ts = np.asarray(ts, dtype=float)
+        ms = np.empty(ts.shape[0], dtype=int)
+        ss = np.empty(ts.shape[0], dtype=int)
+        small = np.array([self.condition_3_13(n0, t, ell) for t in ts],
+                dtype=bool)
+
+        # The matrix 1-norm is small.
+        # Ties in the cost m*s are broken by the smaller m.
+        if np.any(small):
+            onenorms = self._A_1_norm * ts[small]
+            s = np.ceil(onenorms[:, None] / self._theta).astype(int)
+            j = np.argmin(s * self._theta_m, axis=1)
+            ms[small] = self._theta_m[j]
+            ss[small] = s[np.arange(s.shape[0]), j]
+
+        # The matrix 1-norm is large.
+        if not np.all(small):
+            mstars, values = self.cmstar_batch(ts[~small])
+            ms[~small] = mstars
+            ss[~small] = np.maximum(values // mstars, 1)
+
+        for t, m, s in zip(ts, ms, ss):
+            self._cache_set(self._fragment_cache, (n0, float(t), ell),
+                    (int(m), int(s)))
+        return ms, ss
@@ -0,0 +1,253 @@
+"""
+Rate operators with Kronecker sum structure on multivariate state spaces.
+
+For multivariate processes such as paralog models with state space shape
+(61, 61) or (4, 4), most transitions change only one variable,
+with a rate that depends only on the old and new values of that variable.
+These rates are the Kronecker sum of small per-axis rate matrices.
+The remaining rates, for example the extra rates of gene conversion
+that depend on the states of both paralogs, form a sparse residual.
+Products with the full rate matrix are computed by tensor contractions
+along the state axes plus a product with the sparse residual,
+without building the full sparse matrix of the Kronecker sum.
+The per-axis rate matrices of sparse models like codon models
+are applied as sparse matrices, because their dense contractions
+would use more flops than the sparse product with the full rate matrix.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+import scipy.sparse
+
+from .basic_ops import HighLevelInterface, ConcreteInterface
+
+__all__ = ['KroneckerSumRates', 'KroneckerRdOperator',
+           'decompose_kronecker_sum']
+
+
+# Per-axis rate matrices with at most this fraction of nonzero entries
+# are applied as sparse matrices.
+_MAX_DENSE_AXIS_FILL = 0.25
+
+
+def _add_along_axes(shape, vectors):
+    # Return the flattened array x[i_0, ..., i_k] = sum_a vectors[a][i_a].
+    total = np.zeros(shape)
+    for a, v in enumerate(vectors):
+        index_shape = [1] * len(shape)
+        index_shape[a] = shape[a]
+        total = total + np.reshape(v, index_shape)
+    return total.ravel()
+
+
+class KroneckerSumRates(object):
+    """
+    A sparse pre-rate matrix as a Kronecker sum plus a sparse residual.
+
+    Parameters
+    ----------
+    state_space_shape : sequence of integers
+        The number of values of each variable.
+    axis_rates : sequence of 2d ndarrays
+        The square pre-rate matrix of each variable.
+    residual : sparse matrix
+        The remaining rates, indexed by flattened states.
+
+    """
+    def __init__(self, state_space_shape, axis_rates, residual):
+        self.state_space_shape = tuple(int(x) for x in state_space_shape)
+        self.axis_rates = [np.asarray(R, dtype=float) for R in axis_rates]
+        self.residual = scipy.sparse.csr_matrix(residual)
+        self._axis_operators = []
+        for R in self.axis_rates:
+            if np.count_nonzero(R) <= _MAX_DENSE_AXIS_FILL * R.size:
+                R = scipy.sparse.csr_matrix(R)
+            self._axis_operators.append(R)
+        self._axis_adjoint_operators = [R.T for R in self._axis_operators]
+        nstates = int(np.prod(self.state_space_shape))
+        self.shape = (nstates, nstates)
+        self.dtype = np.dtype(float)
+
+    @property
+    def nnz(self):
+        # The number of rates represented by the Kronecker sum
+        # and by the residual, which may overlap.
+        nstates = self.shape[0]
+        n = self.residual.nnz
+        for k, R in zip(self.state_space_shape, self.axis_rates):
+            n += np.count_nonzero(R) * (nstates // k)
+        return n
+
+    def get_matmat_flops(self):
+        """
+        Count the flops of a product with one column.
+
+        Returns
+        -------
+        dense_flops : integer
+            The flops of the products with dense per-axis matrices.
+        sparse_flops : integer
+            The flops of the products with sparse per-axis matrices
+            and with the residual, counting the copies
+            of the rolled state axes as one flop per entry.
+        nproducts : integer
+            The number of matrix products.
+
+        """
+        nstates = self.shape[0]
+        dense_flops = 0
+        sparse_flops = 2 * self.residual.nnz
+        for k, R in zip(self.state_space_shape, self._axis_operators):
+            if scipy.sparse.issparse(R):
+                sparse_flops += 2 * R.nnz * (nstates // k) + nstates
+            else:
+                dense_flops += 2 * k * nstates
+                sparse_flops += nstates
+        return dense_flops, sparse_flops, len(self._axis_operators) + 1
+
+    def sum_axis_0(self):
+        return _add_along_axes(self.state_space_shape,
+                [R.sum(axis=0) for R in self.axis_rates]) + np.asarray(
+                        self.residual.sum(axis=0)).ravel()
+
+    def sum_axis_1(self):
+        return _add_along_axes(self.state_space_shape,
+                [R.sum(axis=1) for R in self.axis_rates]) + np.asarray(
+                        self.residual.sum(axis=1)).ravel()
+
+    def _contract(self, matrices, residual, other):
+        # Apply the Kronecker sum of the matrices along the state axes
+        # and add the product with the residual.
+        # Each matrix is dense or sparse, and it acts on the state axis
+        # rolled to the front and flattened with the other axes.
+        nstates, ncols = other.shape
+        X = np.reshape(other, self.state_space_shape + (ncols, ))
+        out = residual.dot(other)
+        Y = np.reshape(out, self.state_space_shape + (ncols, ))
+        for a, (k, R) in enumerate(zip(self.state_space_shape, matrices)):
+            Xa = np.reshape(np.rollaxis(X, a), (k, -1))
+            Ya = np.rollaxis(Y, a)
+            Ya += np.reshape(R.dot(Xa), Ya.shape)
+        return out
+
+    def dot(self, other):
+        return self._contract(self._axis_operators, self.residual, other)
+
+    def rdot(self, other):
+        # Compute the product of the transpose with other.
+        return self._contract(
+                self._axis_adjoint_operators, self.residual.T, other)
+
+    def tocsr(self):
+        # Build the equivalent sparse matrix, for testing.
+        M = self.residual.copy()
+        nstates = self.shape[0]
+        for a, (k, R) in enumerate(zip(self.state_space_shape,
+                                       self.axis_rates)):
+            before = int(np.prod(self.state_space_shape[:a]))
+            after = nstates // (before * k)
+            M = M + scipy.sparse.kron(scipy.sparse.kron(
+                scipy.sparse.identity(before), scipy.sparse.csr_matrix(R)),
+                scipy.sparse.identity(after))
+        return scipy.sparse.csr_matrix(M)
+
+
+def decompose_kronecker_sum(state_space_shape, row, col, rate):
+    """
+    Split a process definition into a Kronecker sum and a sparse residual.
+
+    For each variable and each pair of its values, the Kronecker sum rate
+    is the smallest rate of the transitions that change only that variable
+    between those values, taken over all values of the other variables;
+    it is zero unless each such transition has a rate.
+    The residual holds the remaining positive rates.
+
+    Parameters
+    ----------
+    state_space_shape : sequence of integers
+        The number of values of each variable.
+    row : 2d ndarray
+        The initial multivariate state of each transition.
+    col : 2d ndarray
+        The final multivariate state of each transition.
+    rate : 1d ndarray
+        The rate of each transition.
+
+    Returns
+    -------
+    rates : KroneckerSumRates
+        The decomposed pre-rate matrix.
+
+    """
+    shape = tuple(int(x) for x in state_space_shape)
+    nstates = int(np.prod(shape))
+    mrow = np.ravel_multi_index(np.asarray(row).T, shape)
+    mcol = np.ravel_multi_index(np.asarray(col).T, shape)
+
+    # Combine duplicate transitions.
+    M = scipy.sparse.coo_matrix(
+            (np.asarray(rate, dtype=float), (mrow, mcol)),
+            (nstates, nstates)).tocsr().tocoo()
+    data = M.data.copy()
+    r = np.array(np.unravel_index(M.row, shape))
+    c = np.array(np.unravel_index(M.col, shape))
+    changed = (r != c)
+    nchanged = changed.sum(axis=0)
+
+    axis_rates = []
+    for a, k in enumerate(shape):
+        mask = (nchanged == 1) & changed[a]
+        key = r[a][mask] * k + c[a][mask]
+        counts = np.bincount(key, minlength=k*k)
+        # Find the smallest rate for each key by sorting.
+        smallest = np.zeros(k*k)
+        order = np.lexsort((data[mask], key))
+        keys, first = np.unique(key[order], return_index=True)
+        smallest[keys] = data[mask][order][first]
+        R = np.where(counts == nstates // k, smallest, 0)
+        data[mask] -= R[key]
+        axis_rates.append(R.reshape(k, k))
+
+    residual_mask = data > 0
+    residual = scipy.sparse.csr_matrix(
+            (data[residual_mask],
+                (M.row[residual_mask], M.col[residual_mask])),
+            (nstates, nstates))
+    return KroneckerSumRates(shape, axis_rates, residual)
+
+
+class KroneckerRdOperator(HighLevelInterface, ConcreteInterface):
+    """
+    Like RdOperator except that R has Kronecker sum structure.
+
+    It is the sum of the pre-rate matrix R, represented by
+    a KroneckerSumRates object, and a diagonal matrix d.
+
+    """
+    def __init__(self, R, d):
+        self.dtype = R.dtype
+        self.shape = R.shape
+        self._R = R
+        self._d = d
+        self._d_abs = np.abs(d)
+        self.args = R, d
+        self._abs_sum_axis_0 = None
+        self._abs_sum_axis_1 = None
+        self._init_concrete_cache()
+
+    def abs_sum_axis_0(self):
+        if self._abs_sum_axis_0 is None:
+            self._abs_sum_axis_0 = self._R.sum_axis_0() + self._d_abs
+        return self._abs_sum_axis_0
+
+    def abs_sum_axis_1(self):
+        if self._abs_sum_axis_1 is None:
+            self._abs_sum_axis_1 = self._R.sum_axis_1() + self._d_abs
+        return self._abs_sum_axis_1
+
+    def _matmat(self, other):
+        return self._R.dot(other) + self._d[:, np.newaxis] * other
+
+    def _my_adjoint_matmat(self, other):
+        return self._R.rdot(other) + self._d[:, np.newaxis] * other
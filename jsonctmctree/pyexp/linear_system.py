@@ -7,6 +7,8 @@ import numpy as np
 from numpy.testing import assert_
 
 from .ctmc_ops import Propagator, ExplicitPropagator, RdOperator
+from .cost_model import get_default_cost_model
+from .kronecker import KroneckerRdOperator
 
 
 class LinearSystem(object):
@@ -26,9 +28,16 @@ class LinearSystem(object):
     The style hint determines whether to use a dense vs. an abstract
     linear operator.  Note that regardless of the style hint,
     the input should still be a scipy sparse matrix.
+    With the 'auto' style, a cost model predicts which strategy is cheaper;
+    the choice can be revised per call by select_propagator
+    when the scaling factors and the number of columns are known.
+
+    If the rates of a multivariate process are given also as
+    a KroneckerSumRates object, then the abstract linear operators
+    use its Kronecker sum structure.
 
     """
-    def __init__(self, R, style='auto'):
+    def __init__(self, R, style='auto', cost_model=None, structure=None):
 
         # Input validation.
         assert_(style in {'auto', 'dense', 'abstract'})
@@ -37,38 +46,87 @@ class LinearSystem(object):
         if R.shape[1] != R.shape[0]:
             raise ValueError
 
+        # R : sparse square matrix of non-negative off-diagonal rates
+        self.shape = R.shape
+        self.dtype = R.dtype
+        self.style = style
+        self._R = R
+        self._cost_model = cost_model
+        self._structure = structure
+
+        # Compute exit rates.
+        self._exit_rates = R.sum(axis=1).A.ravel()
+        d = -self._exit_rates
+        self._mu = np.mean(d)
+        self._op = self._create_abstract_operator(d - self._mu)
+
+        # The propagators of each strategy are created when first needed.
+        self._explicit = None
+        self._abstract = None
+
         # Determine whether to use a dense matrix or not.
-        n = R.shape[0]
         if style == 'auto':
-            auto_threshold = 100
-            if n < auto_threshold:
-                use_dense_matrix = True
-            else:
-                use_dense_matrix = False
+            use_dense_matrix = self.prefer_dense()
         elif style == 'dense':
             use_dense_matrix = True
         elif style == 'abstract':
             use_dense_matrix = False
         else:
             raise ValueError
+        self._set_strategy(use_dense_matrix)
 
-        # R : sparse square matrix of non-negative off-diagonal rates
-        self.shape = R.shape
-        self.dtype = R.dtype
+    def _create_abstract_operator(self, d):
+        if self._structure is None:
+            return RdOperator(self._R, d)
+        return KroneckerRdOperator(self._structure, d)
 
-        # Compute exit rates.
-        exit_rates = R.sum(axis=1).A.ravel()
+    def _get_cost_model(self):
+        if self._cost_model is None:
+            return get_default_cost_model()
+        return self._cost_model
 
+    def _set_strategy(self, use_dense_matrix):
         # Determine whether to use abstract or explicit linear operators.
         if use_dense_matrix:
-            self._Q = R.A - np.diag(exit_rates)
-            self._P = ExplicitPropagator(self._Q)
+            if self._explicit is None:
+                Q = self._R.A - np.diag(self._exit_rates)
+                self._explicit = (Q, ExplicitPropagator(Q))
+            self._Q, self._P = self._explicit
         else:
-            d = -exit_rates
-            mu = np.mean(d)
-            op = RdOperator(R, d - mu)
-            self._P = Propagator(op, mu)
-            self._Q = RdOperator(R, d)
+            if self._abstract is None:
+                Q = self._create_abstract_operator(-self._exit_rates)
+                self._abstract = (Q, Propagator(self._op, self._mu))
+            self._Q, self._P = self._abstract
+        self.uses_dense_matrix = use_dense_matrix
+
+    def prefer_dense(self, ts=(1.0,), ncols=None, npasses=1):
+        """
+        Predict whether the explicit strategy is cheaper.
+
+        Parameters
+        ----------
+        ts : sequence of floats, optional
+            The scaling factors of the edges that share the process.
+        ncols : integer, optional
+            The number of columns of each matrix exponential action.
+        npasses : integer, optional
+            The number of actions per edge.
+
+        """
+        return self._get_cost_model().prefer_dense(
+                self.shape[0], self._R.nnz, self._op.one_norm(),
+                ts=ts, ncols=ncols, npasses=npasses)
+
+    def select_propagator(self, ts, ncols=None, npasses=1):
+        """
+        Choose the cheaper strategy for a planned set of actions.
+
+        This has no effect unless the style is 'auto'.
+
+        """
+        if self.style == 'auto':
+            self._set_strategy(self.prefer_dense(ts, ncols, npasses))
+        return self._P
 
     @property
     def instantaneous_operator(self):
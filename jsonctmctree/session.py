@@ -0,0 +1,196 @@
+"""
+A persistent session for repeated requests on a changing scene.
+
+Optimizers evaluate the same scene many times with different
+edge rate scaling factors, process definitions, or root priors,
+but each call to interface.process_json_in re-parses the scene,
+rebuilds the tree, compresses the observations into patterns,
+and creates the observation index and the expm objects.
+A session parses the scene once.
+An update replaces only the parts of the scene that changed,
+and only the cached objects that depend on them are recreated:
+
+    * the tree, the observation patterns, and the observation index
+      depend only on the tree topology and the observed data
+    * the expm object of a process, including its norm estimates
+      and its choice of strategy, depends on its process definition
+      and on the rate scaling factors of its edges
+    * the prior distribution depends on the root prior
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+
+from .common_unpacking_ex import (
+        TopLevel, Request, RootPrior, ProcessDefinition,
+        ContentError, ShapeError, interpret_root_prior,
+        _unpack_object_array, _np_array_float_1d)
+from .expm_helpers import get_registered_expm_object
+from .impl_v2 import Reactor
+
+__all__ = ['Session']
+
+
+def _same_process_definition(a, b):
+    return (
+            np.array_equal(a.row_states, b.row_states) and
+            np.array_equal(a.column_states, b.column_states) and
+            np.array_equal(a.transition_rates, b.transition_rates))
+
+
+def _same_structure(a, b):
+    # Check the parts of two parsed scenes that are kept by a session.
+    return (
+            a.node_count == b.node_count and
+            len(a.process_definitions) == len(b.process_definitions) and
+            np.array_equal(a.state_space_shape, b.state_space_shape) and
+            np.array_equal(a.tree.row_nodes, b.tree.row_nodes) and
+            np.array_equal(a.tree.column_nodes, b.tree.column_nodes) and
+            np.array_equal(a.tree.edge_processes, b.tree.edge_processes) and
+            np.array_equal(a.observed_data.nodes, b.observed_data.nodes) and
+            np.array_equal(
+                a.observed_data.variables, b.observed_data.variables) and
+            np.array_equal(
+                a.observed_data.iid_observations,
+                b.observed_data.iid_observations))
+
+
+class _Requests(object):
+    def __init__(self, d):
+        _unpack_object_array(self, d, Request, 'requests')
+
+
+class _ProcessDefinitions(object):
+    def __init__(self, d):
+        _unpack_object_array(
+                self, d, ProcessDefinition, 'process_definitions')
+
+
+class Session(object):
+    """
+    Respond to requests on a scene that is updated between calls.
+
+    Parameters
+    ----------
+    scene : dict
+        The scene in the json format of interface.process_json_in.
+    kwargs : dict, optional
+        Keyword arguments of interface.process_json_in, like
+        max_sites_per_chunk or nworkers.
+
+    """
+    def __init__(self, scene, **kwargs):
+        self._reactor_kwargs = kwargs
+        self._reactor = None
+        self.set_scene(scene)
+
+    def set_scene(self, scene):
+        """
+        Replace the scene, reusing what the new scene shares with the old.
+
+        If the tree topology, the number of processes, the state space,
+        and the observed data are unchanged then the scene is updated
+        in place like update(), otherwise the session starts over.
+
+        """
+        new_scene = TopLevel(dict(scene=scene, requests=[])).scene
+        if self._reactor is None or not _same_structure(
+                self._reactor.scene, new_scene):
+            self._reactor = Reactor(new_scene, **self._reactor_kwargs)
+            self._reactor.reuse_observation_indices = True
+            return
+        self._set_edge_rates(new_scene.tree.edge_rate_scaling_factors)
+        self._set_process_definitions(new_scene.process_definitions)
+        self._set_root_prior(new_scene.root_prior)
+
+    def update(self, edge_rate_scaling_factors=None,
+            process_definitions=None, root_prior=None):
+        """
+        Replace some parts of the scene.
+
+        Parameters
+        ----------
+        edge_rate_scaling_factors : sequence of floats, optional
+            The rate scaling factor of each edge, in the order of the edges
+            of the tree section of the scene.
+        process_definitions : sequence of dicts, optional
+            The process definitions in json format.
+        root_prior : dict, optional
+            The root prior in json format.
+
+        """
+        if edge_rate_scaling_factors is not None:
+            try:
+                rates = _np_array_float_1d(edge_rate_scaling_factors)
+            except ShapeError as e:
+                raise ContentError('error interpreting the edge rate '
+                        'scaling factors: %s' % str(e))
+            self._set_edge_rates(rates)
+        if process_definitions is not None:
+            d = dict(process_definitions=process_definitions)
+            self._set_process_definitions(
+                    _ProcessDefinitions(d).process_definitions)
+        if root_prior is not None:
+            self._set_root_prior(RootPrior(root_prior))
+
+    def _set_edge_rates(self, rates):
+        reactor = self._reactor
+        tree = reactor.scene.tree
+        if rates.shape != tree.edge_rate_scaling_factors.shape:
+            raise ContentError('expected one edge rate scaling factor '
+                    'per edge of the tree')
+        if np.min(rates) < 0:
+            raise ContentError(
+                    'the edge-specific rate scaling factors '
+                    'should be non-negative')
+        if np.array_equal(rates, tree.edge_rate_scaling_factors):
+            return
+        tree.edge_rate_scaling_factors = rates
+        reactor.edge_rate_pairs = list(zip(reactor.edges, rates))
+        reactor._prefetch_expm_objects()
+
+    def _set_process_definitions(self, process_definitions):
+        reactor = self._reactor
+        scene = reactor.scene
+        if len(process_definitions) != len(scene.process_definitions):
+            raise ContentError('expected %d process definitions' % (
+                len(scene.process_definitions)))
+        changed = []
+        for i, p in enumerate(process_definitions):
+            if _same_process_definition(p, scene.process_definitions[i]):
+                continue
+            scene.process_definitions[i] = p
+            reactor.expm_objects[i] = get_registered_expm_object(
+                    scene.state_space_shape,
+                    p.row_states,
+                    p.column_states,
+                    p.transition_rates)
+            changed.append(i)
+        if changed:
+            reactor.spectral_factors = None
+            reactor._prefetch_expm_objects(changed)
+
+    def _set_root_prior(self, root_prior):
+        reactor = self._reactor
+        reactor.scene.root_prior = root_prior
+        reactor.prior_distn = interpret_root_prior(reactor.scene)
+
+    def process_requests(self, requests):
+        """
+        Respond to requests on the current scene.
+
+        Parameters
+        ----------
+        requests : sequence of dicts
+            The requests in the json format of interface.process_json_in.
+
+        Returns
+        -------
+        j_out : dict
+            The status and the responses,
+            like the output of interface.process_json_in.
+
+        """
+        parsed = _Requests(dict(requests=requests)).requests
+        return self._reactor.main(parsed)
@@ -0,0 +1,99 @@
+"""
+Test compact representations of observation indicator arrays.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+from numpy.testing import (
+        assert_, assert_equal, assert_allclose, assert_array_less)
+
+from jsonctmctree.common_likelihood import (
+        create_indicator_array,
+        create_compact_indicator_array,
+        get_observation_index,
+        get_conditional_likelihoods,
+        get_subtree_likelihoods,
+        )
+
+
+def _get_observations():
+    # Two observable nodes of a bivariate process with shape (3, 2).
+    # Missing observations are represented by -1.
+    state_space_shape = np.array([3, 2])
+    observable_nodes = np.array([1, 1, 2])
+    observable_axes = np.array([0, 1, 1])
+    iid_observations = np.array([
+        [0, 1, 0],
+        [2, 1, 1],
+        [0, 1, -1],
+        [-1, 0, 0],
+        [2, 1, 1],
+        [0, -1, 1],
+        [0, 1, 0]])
+    return (
+            state_space_shape,
+            observable_nodes,
+            observable_axes,
+            iid_observations)
+
+
+def test_compact_indicator_array():
+    info = _get_observations()
+    state_space_shape, observable_nodes, observable_axes, obs = info
+    nsites = obs.shape[0]
+    for node, max_ncodes in (0, 1), (1, 5), (2, 3):
+        args = (node, state_space_shape, observable_nodes, observable_axes, obs)
+        desired = create_indicator_array(*args)
+        columns, codes = create_compact_indicator_array(*args)
+        assert_equal(codes.shape, (nsites, ))
+        assert_array_less(columns.shape[1] - 1, max_ncodes)
+        assert_equal(np.take(columns, codes, axis=1), desired)
+
+
+def test_compressed_columns():
+    # Compare likelihood arrays computed with and without compression.
+    from jsonctmctree.common_unpacking_ex import (
+            TopLevel, interpret_tree)
+    from jsonctmctree.expm_helpers import ActionExpm
+    from jsonctmctree.tests.test_site_patterns import (
+            _get_scene_with_repeated_patterns)
+    toplevel = TopLevel(dict(
+        scene=_get_scene_with_repeated_patterns(), requests=[]))
+    scene = toplevel.scene
+    T, root, edges, edge_rate_pairs, edge_process_pairs = interpret_tree(scene)
+    expm_objects = []
+    for p in scene.process_definitions:
+        expm_objects.append(ActionExpm(
+            scene.state_space_shape,
+            p.row_states, p.column_states, p.transition_rates))
+    for f in get_conditional_likelihoods, get_subtree_likelihoods:
+        for store_all in False, True:
+            arrays = []
+            for compress_columns in False, True:
+                arrays.append(f(
+                    expm_objects, store_all,
+                    T, root, edges, edge_rate_pairs, edge_process_pairs,
+                    scene.state_space_shape,
+                    scene.observed_data.nodes,
+                    scene.observed_data.variables,
+                    scene.observed_data.iid_observations,
+                    compress_columns=compress_columns))
+            d_dense, d_compressed = arrays
+            assert_equal(set(d_dense), set(d_compressed))
+            for node in d_dense:
+                assert_allclose(d_dense[node], d_compressed[node])
+
+
+def test_observation_index():
+    info = _get_observations()
+    state_space_shape, observable_nodes, observable_axes, obs = info
+    index = get_observation_index(
+            [0, 1, 2], state_space_shape, observable_nodes, observable_axes, obs)
+    assert_equal(sorted(index), [0, 1, 2])
+    assert_(index[0] is None)
+    for node in 1, 2:
+        args = (node, state_space_shape, observable_nodes, observable_axes, obs)
+        desired = create_indicator_array(*args)
+        columns, codes = index[node]
+        assert_equal(np.take(columns, codes, axis=1), desired)
@@ -0,0 +1,65 @@
+"""
+Test the structured operators of the implicit expm Frechet objects.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+from scipy.linalg import expm
+
+from jsonctmctree.expm_helpers import (
+        create_dense_rate_matrix, create_sparse_pre_rate_matrix,
+        ImplicitDwellExpmFrechet,
+        ImplicitTransitionExpmFrechet,
+        ImplicitTransitionExpmFrechetEx)
+from jsonctmctree.tests.test_kronecker import _get_gene_conversion_process
+
+
+def _get_brute_force_products(Q, C, t, A):
+    # Exponentiate the block triangular matrix explicitly.
+    n = Q.shape[0]
+    F = np.zeros((2*n, 2*n))
+    F[:n, :n] = Q
+    F[:n, n:] = C
+    F[n:, n:] = Q
+    P = expm(F * t)
+    return P[n:, n:].dot(A), P[:n, n:].dot(A)
+
+
+def test_implicit_expm_frechet():
+    np.random.seed(1234)
+    shape, row, col, rate = _get_gene_conversion_process(3, 0.5)
+    nstates = np.prod(shape)
+    Q = create_dense_rate_matrix(shape, row, col, rate)
+    A = np.random.randn(nstates, 4)
+
+    s_state = np.array([[0, 0], [1, 2], [1, 2]])
+    s_weight = np.array([1.0, 2.0, 0.5])
+    E_dwell = create_sparse_pre_rate_matrix(
+            shape, s_state, s_state, s_weight).A
+    expect = np.random.rand(len(rate))
+    R = create_sparse_pre_rate_matrix(shape, row, col, rate).A
+    E_tran = R * create_sparse_pre_rate_matrix(shape, row, col, expect).A
+
+    pairs = (
+            (
+                ImplicitDwellExpmFrechet(
+                    shape, row, col, rate, s_state, s_weight),
+                E_dwell),
+            (
+                ImplicitTransitionExpmFrechet(
+                    shape, row, col, rate, expect),
+                E_tran),
+            (
+                ImplicitTransitionExpmFrechetEx(
+                    shape, row, col, rate, row, col, expect),
+                E_tran),
+            )
+    for obj, C in pairs:
+        for t in 0.0, 0.1, 2.0, 10.0:
+            desired = _get_brute_force_products(Q, C, t, A)
+            actual = obj.get_expm_frechet_product(t, A)
+            for x, y in zip(actual, desired):
+                assert_allclose(x, y, atol=1e-12)
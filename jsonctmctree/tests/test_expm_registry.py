@@ -0,0 +1,44 @@
+"""
+Test the registry of expm objects shared across calls.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+from numpy.testing import assert_, assert_equal, assert_allclose
+
+from jsonctmctree.expm_helpers import ActionExpm, ExpmObjectRegistry
+from jsonctmctree.testutil import sample_time_reversible_rate_matrix
+from jsonctmctree.tests.test_reversible_expm import _get_sparse_process
+
+
+def test_registry_hits_and_eviction():
+    np.random.seed(1234)
+    shape = np.array([2, 3])
+    Q, d = sample_time_reversible_rate_matrix(6)
+    row, col, rate = _get_sparse_process(Q, shape)
+    registry = ExpmObjectRegistry(maxsize=1)
+    a = registry.get(shape, row, col, rate)
+    b = registry.get(list(shape), np.array(row), np.array(col), list(rate))
+    assert_(a is b)
+    assert_equal(registry.cache_info(), (1, 1, 1, 1))
+
+    # A different transition rate gives a different object
+    # and evicts the least recently used object.
+    other_rate = np.array(rate, dtype=float)
+    other_rate[0] *= 2
+    c = registry.get(shape, row, col, other_rate)
+    assert_(c is not a)
+    assert_equal(registry.cache_info(), (1, 2, 1, 1))
+    d = registry.get(shape, row, col, rate)
+    assert_(d is not a)
+    assert_equal(registry.cache_info(), (1, 3, 1, 1))
+
+    # The shared objects compute the same things as fresh objects.
+    B = np.eye(6)
+    desired = ActionExpm(shape, row, col, rate).expm_mul(0.3, B)
+    assert_allclose(a.expm_mul(0.3, B), desired)
+    assert_allclose(d.expm_mul(0.3, B), desired)
+
+    registry.cache_clear()
+    assert_equal(registry.cache_info(), (0, 0, 1, 0))
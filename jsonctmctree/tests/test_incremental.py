@@ -0,0 +1,48 @@
+"""
+Test incremental re-evaluation after changing single edge rates.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import copy
+
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose, assert_raises
+
+from jsonctmctree import impl_v2
+from jsonctmctree.incremental import IncrementalLikelihood
+from jsonctmctree.tests.test_outside_derivatives import _get_caterpillar_scene
+
+
+def _get_desired(scene):
+    j_in = dict(
+            scene=scene,
+            requests=[dict(property='snnlogl'), dict(property='sdnderi')])
+    j_out = impl_v2.process_json_in(j_in)
+    assert_equal(j_out['status'], 'feasible')
+    return j_out['responses']
+
+
+def test_incremental_vs_reactor():
+    scene = _get_caterpillar_scene()
+    obj = IncrementalLikelihood(scene)
+    scene = copy.deepcopy(scene)
+    rates = scene['tree']['edge_rate_scaling_factors']
+    for edge_index, edge_rate in (3, 0.25), (0, 1.5), (6, 0.0), (4, 2.0):
+        rates[edge_index] = edge_rate
+        obj.set_edge_rate(edge_index, edge_rate)
+        logl, derivatives = _get_desired(scene)
+        assert_allclose(obj.get_log_likelihood(), logl)
+        assert_allclose(obj.get_edge_derivatives(), derivatives)
+        for ei in range(len(rates)):
+            assert_allclose(obj.get_edge_derivative(ei), derivatives[ei])
+
+
+def test_incremental_infeasible():
+    scene = _get_caterpillar_scene()
+    scene['root_prior'] = dict(states=[[1, 1]], probabilities=[1.0])
+    scene['tree']['edge_rate_scaling_factors'] = [0.0] * 7
+    obj = IncrementalLikelihood(scene)
+    assert_equal(obj.get_log_likelihood(), -np.inf)
+    assert_raises(impl_v2.InfeasibilityError, obj.get_edge_derivatives)
+    assert_raises(ValueError, obj.set_edge_rate, 0, -1.0)
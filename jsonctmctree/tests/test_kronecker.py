@@ -0,0 +1,125 @@
+"""
+Test rate operators with Kronecker sum structure.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+from itertools import product
+
+import numpy as np
+import scipy.sparse
+from numpy.testing import assert_, assert_equal, assert_allclose
+
+from scipy.linalg import expm
+
+from jsonctmctree.expm_helpers import (
+        ActionExpm, create_sparse_pre_rate_matrix)
+from jsonctmctree.pyexp.ctmc_ops import RdOperator, MatrixExponential
+from jsonctmctree.pyexp.kronecker import (
+        decompose_kronecker_sum, KroneckerRdOperator)
+from jsonctmctree.pyexp.linear_system import LinearSystem
+from jsonctmctree.pyexp.cost_model import CostModel
+
+
+def _get_gene_conversion_process(n, tau):
+    # Two paralogs evolve independently with the same rate matrix,
+    # and a paralog changes to the state of the other paralog
+    # with the additional gene conversion rate tau.
+    Q = np.exp(np.random.randn(n, n))
+    row, col, rate = [], [], []
+    for a, b in product(range(n), repeat=2):
+        for c in range(n):
+            if c != a:
+                row.append((a, b))
+                col.append((c, b))
+                rate.append(Q[a, c] + (tau if c == b else 0))
+            if c != b:
+                row.append((a, b))
+                col.append((a, c))
+                rate.append(Q[b, c] + (tau if c == a else 0))
+    return np.array([n, n]), np.array(row), np.array(col), np.array(rate)
+
+
+def test_decompose_kronecker_sum():
+    np.random.seed(1234)
+    n = 4
+    shape, row, col, rate = _get_gene_conversion_process(n, 0.5)
+    R = create_sparse_pre_rate_matrix(shape, row, col, rate)
+    K = decompose_kronecker_sum(shape, row, col, rate)
+    assert_allclose(K.tocsr().A, R.A)
+    # Only the gene conversion rates are in the residual.
+    assert_equal(K.residual.nnz, 2 * n * (n-1))
+    assert_equal(K.nnz, R.tocsr().nnz + K.residual.nnz)
+    assert_allclose(K.residual.data, 0.5)
+
+    # Transitions that are allowed only from some values
+    # of the other variable are all in the residual.
+    mask = row[:, 0] == row[:, 1]
+    K = decompose_kronecker_sum(shape, row[mask], col[mask], rate[mask])
+    assert_equal(K.residual.nnz, np.count_nonzero(mask))
+    for R in K.axis_rates:
+        assert_equal(R, 0)
+
+
+def test_KroneckerRdOperator():
+    np.random.seed(1234)
+    shape, row, col, rate = _get_gene_conversion_process(3, 0.2)
+    R = create_sparse_pre_rate_matrix(shape, row, col, rate)
+    K = decompose_kronecker_sum(shape, row, col, rate)
+    d = np.random.randn(R.shape[0])
+    desired = RdOperator(R, d)
+    actual = KroneckerRdOperator(K, d)
+    B = np.random.randn(R.shape[0], 4)
+    for f, g in (actual, desired), (actual.H, desired.H):
+        assert_allclose(f.dot(B), g.dot(B))
+        assert_allclose(f.one_norm(), g.one_norm())
+        assert_allclose(f.inf_norm(), g.inf_norm())
+
+
+def test_kronecker_linear_system():
+    np.random.seed(1234)
+    shape, row, col, rate = _get_gene_conversion_process(4, 0.3)
+    R = create_sparse_pre_rate_matrix(shape, row, col, rate)
+    K = decompose_kronecker_sum(shape, row, col, rate)
+    Q = R.A - np.diag(R.A.sum(axis=1))
+    L = LinearSystem(R, style='abstract', structure=K)
+    B = np.random.randn(R.shape[0], 3)
+    for t in 0.1, 2.0:
+        P = MatrixExponential(L.propagator, t)
+        assert_allclose(P.dot(B), expm(Q*t).dot(B))
+        assert_allclose(P.T.dot(B), expm(Q.T*t).dot(B))
+    assert_allclose(L.instantaneous_operator.dot(B), Q.dot(B))
+
+    # The expm object of a multivariate process uses the structure
+    # only if the cost model predicts that it is cheaper.
+    dense_model = CostModel(dense_flop_time=0, call_overhead=0)
+    f = ActionExpm(shape, row, col, rate, cost_model=dense_model)
+    assert_(f._L._structure is not None)
+    f = ActionExpm(shape, row, col, rate)
+    assert_(f._L._structure is None)
+
+
+def test_sparse_axis_rates():
+    # Sparse per-axis rate matrices are applied as sparse matrices.
+    np.random.seed(1234)
+    n = 12
+    shape, row, col, rate = _get_gene_conversion_process(n, 0.3)
+    mask = np.random.rand(n, n) < 0.1
+    keep = (
+            ((row[:, 1] == col[:, 1]) & mask[row[:, 0], col[:, 0]]) |
+            ((row[:, 0] == col[:, 0]) & mask[row[:, 1], col[:, 1]]))
+    row, col, rate = row[keep], col[keep], rate[keep]
+    R = create_sparse_pre_rate_matrix(shape, row, col, rate)
+    K = decompose_kronecker_sum(shape, row, col, rate)
+    assert_(all(scipy.sparse.issparse(A) for A in K._axis_operators))
+    B = np.random.randn(R.shape[0], 3)
+    assert_allclose(K.dot(B), R.dot(B))
+    assert_allclose(K.rdot(B), R.T.dot(B))
+
+    # The flops are not fewer than those of the sparse product,
+    # so the full sparse matrix is used.
+    dense_flops, sparse_flops, nproducts = K.get_matmat_flops()
+    assert_equal(dense_flops, 0)
+    assert_(sparse_flops >= 2 * R.tocsr().nnz)
+    f = ActionExpm(shape, row, col, rate)
+    assert_(f._L._structure is None)
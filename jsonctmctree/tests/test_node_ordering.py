@@ -12,6 +12,7 @@ from jsonctmctree.node_ordering import (
         get_node_to_subtree_depth,
         get_node_to_subtree_thickness,
         get_node_evaluation_order,
+        get_node_evaluation_levels,
         )
 
 
@@ -51,3 +52,26 @@ def test_node_evaluation_order():
     v_actual = list(get_node_evaluation_order(T, root))
     v_desired = (7, 6, 5, 8, 4, 3, 2, 1, 0)
     assert_equal(v_actual, v_desired)
+
+
+def test_subtree_depth():
+    T, root = get_example_tree()
+    d_actual = get_node_to_subtree_depth(T, root)
+    d_desired = {
+            0 : 3,
+            1 : 1,
+            2 : 0,
+            3 : 0,
+            4 : 2,
+            5 : 1,
+            6 : 0,
+            7 : 0,
+            8 : 0}
+    assert_equal(d_actual, d_desired)
+
+
+def test_node_evaluation_levels():
+    T, root = get_example_tree()
+    v_actual = get_node_evaluation_levels(T, root)
+    v_desired = [[7, 6, 8, 3, 2], [5, 1], [4], [0]]
+    assert_equal(v_actual, v_desired)
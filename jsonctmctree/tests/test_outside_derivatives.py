@@ -0,0 +1,86 @@
+"""
+Test edge derivatives computed by a single preorder (outside) pass.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose
+
+from jsonctmctree import ll, impl_naive, impl_v2
+from jsonctmctree.common_likelihood import get_conditional_likelihoods
+from jsonctmctree.common_unpacking_ex import (
+        TopLevel, interpret_tree, interpret_root_prior)
+from jsonctmctree.expm_helpers import ActionExpm
+from jsonctmctree.tests.test_site_patterns import (
+        _get_scene_with_repeated_patterns, _get_request)
+
+
+def _get_caterpillar_scene():
+    # A tree whose internal nodes form a path,
+    # with a multifurcation at the root and an unobserved internal node.
+    scene = _get_scene_with_repeated_patterns()
+    scene['node_count'] = 8
+    scene['tree'] = dict(
+            row_nodes = [0, 0, 0, 2, 2, 5, 5],
+            column_nodes = [1, 2, 6, 3, 5, 4, 7],
+            edge_rate_scaling_factors = [1.0, 2.0, 0.5, 3.0, 0.1, 4.0, 0.2],
+            edge_processes = [0, 1, 0, 1, 0, 2, 1],
+            )
+    return scene
+
+
+def _check_derivatives(scene_dict, requested_derivative_edge_indices):
+    scene = TopLevel(dict(scene=scene_dict, requests=[])).scene
+    T, root, edges, edge_rate_pairs, edge_process_pairs = interpret_tree(scene)
+    distn = interpret_root_prior(scene)
+    f = []
+    for p in scene.process_definitions:
+        f.append(ActionExpm(
+            scene.state_space_shape,
+            p.row_states, p.column_states, p.transition_rates))
+    args = (
+            T, root, edges, edge_rate_pairs, edge_process_pairs,
+            scene.state_space_shape,
+            scene.observed_data.nodes,
+            scene.observed_data.variables,
+            scene.observed_data.iid_observations)
+    node_to_array = get_conditional_likelihoods(f, True, *args)
+    desired = ll.get_edge_derivatives(
+            f, requested_derivative_edge_indices, node_to_array, distn, *args)
+    actual = ll.get_edge_derivatives_by_outside_pass(
+            f, requested_derivative_edge_indices, node_to_array, distn, *args)
+    assert_equal(set(actual), set(desired))
+    for edge_index in desired:
+        assert_allclose(actual[edge_index], desired[edge_index])
+
+
+def test_outside_pass_vs_path_derivatives():
+    scene_dicts = (
+            _get_scene_with_repeated_patterns(),
+            _get_caterpillar_scene())
+    for scene_dict in scene_dicts:
+        nedges = len(scene_dict['tree']['row_nodes'])
+        _check_derivatives(scene_dict, set(range(nedges)))
+        for edge_index in range(nedges):
+            _check_derivatives(scene_dict, {edge_index})
+        _check_derivatives(scene_dict, set())
+
+
+def test_zero_rate_edge_derivatives():
+    # The derivative with respect to the log of a zero rate is zero.
+    scene = _get_caterpillar_scene()
+    scene['tree']['edge_rate_scaling_factors'][4] = 0.0
+    for prefix in 'ddn', 'sdn', 'wdn':
+        j_in = dict(
+                scene=scene,
+                requests=[_get_request(prefix + 'deri')])
+        j_out_naive = impl_naive.process_json_in(j_in)
+        j_out_v2 = impl_v2.process_json_in(j_in)
+        assert_equal(j_out_v2['status'], 'feasible')
+        # Some derivatives vanish, and the two implementations
+        # round them to different values near zero.
+        assert_allclose(
+                j_out_v2['responses'], j_out_naive['responses'], atol=1e-12)
+        if prefix == 'ddn':
+            assert_equal(np.array(j_out_v2['responses'][0])[:, 4], 0)
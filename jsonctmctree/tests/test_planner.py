@@ -0,0 +1,109 @@
+"""
+Test the plans of the steps used to respond to requests.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+from itertools import combinations
+
+from numpy.testing import assert_, assert_equal, assert_raises
+
+from jsonctmctree import impl_v2, planner
+from jsonctmctree.common_unpacking_ex import TopLevel
+from jsonctmctree.tests.test_site_patterns import (
+        _get_scene_with_repeated_patterns, _get_request)
+
+
+_CORE_PROPERTIES = ('logl', 'deri', 'root', 'node', 'dwel', 'tran')
+
+
+def _simulate(plan, nstates, nnodes, nedges):
+    # Check the order of the steps and return the peak memory.
+    sizes = planner._get_sizes(nstates, nnodes, nedges)
+    live = set()
+    created = set()
+    checked = False
+    responded = set()
+    peak = 0
+    for step in plan.steps:
+        if step.action == 'delete':
+            assert_(step.name in live)
+            live.remove(step.name)
+            continue
+        for name in step.sources:
+            assert_(name in live)
+        during = sum(sizes[name] for name in live)
+        if step.action == 'create':
+            assert_(step.name not in created)
+            created.add(step.name)
+            live.add(step.name)
+            during += sizes[step.name]
+        elif step.action == 'check':
+            checked = True
+        elif step.action == 'respond':
+            assert_(checked)
+            responded.add(step.name)
+            during += planner._get_workspace(step.name, nstates, nedges)
+        peak = max(peak, during)
+    assert_(checked)
+    assert_equal(live, set())
+    return responded, peak
+
+
+def test_all_plans():
+    nstates, nnodes, nedges = 4, 5, 4
+    for n in range(len(_CORE_PROPERTIES) + 1):
+        for core_properties in combinations(_CORE_PROPERTIES, n):
+            plan = planner.make_plan(core_properties, nstates, nnodes, nedges)
+            responded, peak = _simulate(plan, nstates, nnodes, nedges)
+            assert_equal(responded, set(core_properties))
+            assert_equal(peak, plan.peak)
+
+
+def test_fewest_passes():
+    # Feasibility is checked using the arrays that are needed anyway.
+    plan = planner.make_plan(['logl'], 4, 5, 4)
+    assert_equal(plan.passes, 1)
+    plan = planner.make_plan(['dwel'], 4, 5, 4)
+    assert_equal(plan.passes, 2)
+    assert_equal(plan.sources[planner.LIKELIHOODS],
+            (planner.NODE_TO_SUBTREE, ))
+    plan = planner.make_plan(['root', 'deri'], 4, 5, 4)
+    assert_equal(plan.passes, 2)
+
+
+def test_peak_memory():
+    # The per-node conditional likelihoods used for the derivatives
+    # are deleted before the per-node marginal distributions are created.
+    nstates, nnodes, nedges = 61, 20, 19
+    plan = planner.make_plan(['deri', 'dwel'], nstates, nnodes, nedges)
+    sizes = planner._get_sizes(nstates, nnodes, nedges)
+    everything = (
+            sizes[planner.NODE_TO_CONDITIONAL] +
+            sizes[planner.NODE_TO_SUBTREE] +
+            sizes[planner.NODE_TO_MARGINAL])
+    assert_(plan.peak < everything)
+
+    # If no plan fits the budget then the smallest peak memory is used.
+    tight = planner.make_plan(
+            ['deri', 'dwel'], nstates, nnodes, nedges, budget=1)
+    assert_(tight.peak <= plan.peak)
+
+
+def test_bad_core_property():
+    assert_raises(ValueError, planner.make_plan, ['wat'], 4, 5, 4)
+
+
+def test_reactor_plan():
+    j_in = dict(
+            scene=_get_scene_with_repeated_patterns(),
+            requests=[_get_request('snnlogl'), _get_request('dnwnode')])
+    toplevel = TopLevel(j_in)
+    reactor = impl_v2.Reactor(toplevel.scene)
+    plan = reactor.plan(toplevel.requests)
+    assert_(plan is reactor.plan(toplevel.requests))
+    text = str(plan)
+    assert_('respond to "logl" requests' in text)
+    assert_('respond to "node" requests' in text)
+    j_out = reactor.main(toplevel.requests)
+    assert_equal(j_out['status'], 'feasible')
@@ -3,16 +3,22 @@
 from __future__ import division, print_function, absolute_import
 
 import numpy as np
-from numpy.testing import assert_equal, assert_array_less, assert_allclose
+from numpy.testing import (
+        assert_, assert_equal, assert_array_less, assert_allclose)
 
 import scipy.sparse
 from scipy.linalg import expm
 
 import jsonctmctree
 from jsonctmctree.pyexp.basic_ops import PowerOperator, ExtendedMatrixOperator
+from jsonctmctree.pyexp import ctmc_ops
 from jsonctmctree.pyexp.ctmc_ops import (
-        RdOperator, RdcOperator, RdCOperator,
-        Propagator, SmarterPropagator, MatrixExponential)
+        RdOperator, RdcOperator, RdCOperator, RdCStackOperator,
+        Propagator, SmarterPropagator, ExplicitPropagator, MatrixExponential,
+        _expm_product_helper, _expm_product_helper_inplace)
+from jsonctmctree.pyexp.experimental import IterationStash
+from jsonctmctree.pyexp.linear_system import LinearSystem
+from jsonctmctree.pyexp.cost_model import CostModel, calibrate
 
 
 def get_random_rate_matrix(n):
@@ -115,6 +121,28 @@ def test_RdCOperator():
     check_operator_equivalence(L, M)
 
 
+def test_RdCStackOperator():
+    # This is a 3n x 3n square operator.
+    np.random.seed(1234)
+    n = 4
+    R = get_random_rate_matrix(n)
+    d = np.random.randn(n)
+    C1 = get_random_sparse_square_matrix(n)
+    C2 = get_random_sparse_square_matrix(n)
+
+    # Define the dense numpy ndarray.
+    Q = R.A + np.diag(d)
+    Z = np.zeros((n, n))
+    M = np.bmat([[Q, Z, C1.A], [Z, Q, C2.A], [Z, Z, Q]]).A
+
+    # Define the linear operator.
+    L_Rd = RdOperator(R, d)
+    L = RdCStackOperator(L_Rd, [C1, C2])
+
+    # Test properties of the operator, its transpose, and its adjoint.
+    check_operator_equivalence(L, M)
+
+
 def test_PowerOperator():
     # This is an n x 2 square operator.
     np.random.seed(1234)
@@ -216,3 +244,223 @@ def test_SmarterPropagator():
             desired = expm(Q * t).dot(B)
             actual = L.dot(B)
             assert_allclose(actual, desired)
+
+
+def test_ExplicitPropagator_cache():
+    np.random.seed(1234)
+    n = 5
+    R = get_random_rate_matrix(n)
+    Q = R.A - np.diag(R.sum(axis=1).A.ravel())
+    B = np.random.randn(n, 3)
+    P = ExplicitPropagator(Q, maxsize=2)
+    for t in 0.5, 0.5, 1.0, 0.5, 2.0, 1.0:
+        assert_allclose(P._parameterized_matmat(t, B), expm(Q*t).dot(B))
+        assert_allclose(
+                P._parameterized_adjoint_matmat(t, B), expm(Q.T*t).dot(B))
+    # The cache holds the two most recently used matrices,
+    # so the final t=1.0 is a miss after 0.5 and 2.0 were used.
+    hits, misses, maxsize, currsize = P.cache_info()
+    assert_equal((hits, misses, maxsize, currsize), (8, 4, 2, 2))
+    P.cache_clear()
+    assert_equal(P.cache_info(), (0, 0, 2, 0))
+
+
+def test_ExplicitPropagator_cache_bytes():
+    # The cache is bounded by the bytes of the matrices.
+    np.random.seed(1234)
+    n = 10
+    R = get_random_rate_matrix(n)
+    Q = R.A - np.diag(R.sum(axis=1).A.ravel())
+    nbytes = Q.nbytes
+    for maxbytes, maxsize in (3*nbytes, 3), (nbytes, 1), (0, 1):
+        P = ExplicitPropagator(Q, maxbytes=maxbytes)
+        P.prefetch([0.5, 1.0, 2.0, 4.0])
+        for t in 0.5, 1.0, 2.0, 4.0, 8.0:
+            P._get_expm(t)
+        assert_equal(P.cache_info()[2:], (maxsize, maxsize))
+    P = ExplicitPropagator(Q, maxsize=0, maxbytes=nbytes)
+    P._get_expm(1.0)
+    assert_equal(P.cache_info()[2:], (0, 0))
+
+
+def test_ExplicitPropagator_prefetch():
+    np.random.seed(1234)
+    n = 5
+    R = get_random_rate_matrix(n)
+    Q = R.A - np.diag(R.sum(axis=1).A.ravel())
+    ts = [0.5, 0.0, 2.0, 0.5]
+    # A defective matrix uses the fallback.
+    J = np.array([[-1.0, 1.0], [0.0, -1.0]])
+    for M, max_condition_number in (Q, 1e6), (Q, 0), (J, 1e6):
+        P = ExplicitPropagator(M)
+        P.prefetch(ts, max_condition_number=max_condition_number)
+        assert_equal(P.cache_info(), (0, 3, 128, 3))
+        for t in ts:
+            C = np.random.randn(M.shape[0], 2)
+            assert_allclose(P._parameterized_matmat(t, C), expm(M*t).dot(C))
+        assert_equal(P.cache_info(), (4, 3, 128, 3))
+        # The transition matrix of a zero scaling factor is exact.
+        assert_equal(P._get_expm(0.0), np.eye(M.shape[0]))
+
+
+def test_ExplicitPropagator_prefetch_conditioning():
+    # Matrices whose eigenvectors are nearly as ill-conditioned
+    # as the default threshold allows are accurate to about 1e-10,
+    # and worse conditioned matrices use expm for each scaling factor.
+    np.random.seed(1234)
+    n = 6
+    ts = [0.5, 2.0]
+    for condition_number in 5e2, 5e3:
+        A = np.linalg.qr(np.random.randn(n, n))[0]
+        B = np.linalg.qr(np.random.randn(n, n))[0]
+        s = np.logspace(0, -np.log10(condition_number), n)
+        U = A.dot(np.diag(s)).dot(B)
+        w = -3 * np.random.rand(n)
+        M = U.dot(np.diag(w)).dot(np.linalg.inv(U))
+        P = ExplicitPropagator(M)
+        P.prefetch(ts)
+        for t in ts:
+            desired = expm(M*t)
+            if condition_number < 1e3:
+                assert_allclose(P._get_expm(t), desired,
+                        atol=1e-10 * np.abs(desired).max())
+            else:
+                assert_equal(P._get_expm(t), desired)
+
+
+def test_IterationStash_batch():
+    np.random.seed(1234)
+    n = 20
+    R = get_random_rate_matrix(n)
+    d = -R.sum(axis=1).A.ravel()
+    op = RdOperator(R, d - np.mean(d))
+    ts = np.concatenate(([0.0], np.logspace(-4, 3, 30)))
+    for n0 in 1, 7, 100:
+        desired = [IterationStash(op).fragment_3_1(n0, t) for t in ts]
+        stash = IterationStash(op)
+        ms, ss = stash.fragment_3_1_batch(n0, ts)
+        assert_equal(list(zip(ms, ss)), desired)
+        # The batch results are memoized.
+        assert_equal([stash.fragment_3_1(n0, t) for t in ts], desired)
+        assert_equal(len(stash._fragment_cache), len(ts))
+
+
+def test_calibrate():
+    # The calibration does not change the global random state.
+    np.random.seed(1234)
+    state = np.random.get_state()
+    model = calibrate(sizes=(5, 10, 20), ncols=2, repeat=1)
+    assert_(isinstance(model, CostModel))
+    assert_equal(np.random.get_state()[1], state[1])
+    assert_equal(np.random.get_state()[2], state[2])
+
+
+def test_LinearSystem_cost_model():
+    np.random.seed(1234)
+    n = 6
+    R = get_random_rate_matrix(n)
+    Q = R.A - np.diag(R.sum(axis=1).A.ravel())
+    B = np.random.randn(n, 3)
+    ts = [0.5, 2.0]
+
+    # A cost model with free dense flops prefers explicit matrices,
+    # and one with free sparse flops and calls prefers abstract operators.
+    dense_model = CostModel(dense_flop_time=0, call_overhead=0)
+    abstract_model = CostModel(sparse_flop_time=0, call_overhead=0)
+    assert_(LinearSystem(R, cost_model=dense_model).uses_dense_matrix)
+    assert_(not LinearSystem(R, cost_model=abstract_model).uses_dense_matrix)
+    small_model = CostModel(max_dense_nstates=n-1)
+    assert_(not LinearSystem(R, cost_model=small_model).uses_dense_matrix)
+
+    # The choice is revised per call, and both strategies agree.
+    # Without call overhead, few columns favor the abstract operator
+    # and many columns favor the explicit matrix.
+    model = CostModel(dense_flop_time=1e-9, sparse_flop_time=1e-9,
+            call_overhead=0)
+    L = LinearSystem(R, cost_model=model)
+    for ncols, use_dense_matrix in (1, False), (10000, True):
+        P = L.select_propagator(ts, ncols)
+        assert_equal(L.uses_dense_matrix, use_dense_matrix)
+        for t in ts:
+            actual = MatrixExponential(P, t).dot(B)
+            assert_allclose(actual, expm(Q*t).dot(B))
+            actual = L.instantaneous_operator.dot(B)
+            assert_allclose(actual, Q.dot(B))
+
+    # Explicit styles are not revised.
+    L = LinearSystem(R, style='abstract', cost_model=dense_model)
+    L.select_propagator(ts, 10000)
+    assert_(not L.uses_dense_matrix)
+
+
+def test_dot_into():
+    np.random.seed(1234)
+    n = 5
+    for op in _sample_Rd(n), _sample_Rdc(n), _sample_RdC(n):
+        k = op.shape[1]
+        for f in op, op.H:
+            # Check C-contiguous and Fortran-contiguous inputs.
+            for B in np.random.randn(k, 3), np.asfortranarray(
+                    np.random.randn(k, 3)):
+                out = np.empty((k, 3))
+                assert_(f.dot_into(B, out) is out)
+                assert_allclose(out, f.dot(B))
+
+
+def test_dot_into_without_sparsetools():
+    # The products fall back to R.dot if the private scipy module
+    # is not available.
+    np.random.seed(1234)
+    n = 5
+    op = _sample_Rd(n)
+    B = np.random.randn(n, 3)
+    expected = op.dot(B)
+    sparsetools = ctmc_ops._sparsetools
+    ctmc_ops._sparsetools = None
+    try:
+        out = np.empty((n, 3))
+        assert_(op.dot_into(B, out) is out)
+    finally:
+        ctmc_ops._sparsetools = sparsetools
+    assert_allclose(out, expected)
+
+
+def test_expm_product_helper_inplace():
+    np.random.seed(1234)
+    n = 6
+    for t in 0.42, 4.2, 42.0:
+        for op in _sample_Rd(n), _sample_Rdc(n), _sample_RdC(n):
+            k = op.shape[1]
+            mu = np.random.randn()
+            for A in op, op.H:
+                stash = IterationStash(A)
+                B = np.random.randn(k, 4)
+                B_copy = B.copy()
+                desired = _expm_product_helper(A, mu, stash, t, B)
+                actual = _expm_product_helper_inplace(A, mu, stash, t, B)
+                assert_allclose(actual, desired)
+                # The input is not modified.
+                assert_equal(B, B_copy)
+    # A zero scaling factor gives the identity.
+    B = np.random.randn(k, 4)
+    actual = _expm_product_helper_inplace(A, mu, stash, 0.0, B)
+    assert_equal(actual, B)
+
+
+def test_expm_product_helper_column_deflation():
+    # Columns that converge after different numbers of terms
+    # are dropped from the working set at different iterations.
+    np.random.seed(1234)
+    n = 8
+    for op in _sample_Rd(n), _sample_Rdc(n), _sample_RdC(n):
+        k = op.shape[1]
+        mu = 0.3
+        B = np.random.randn(k, 6)
+        B[:, 1] = 0
+        B[:, 3] = np.identity(k)[0]
+        B[:, 4] *= 1e-8
+        M = op.dot(np.identity(k)) + mu * np.identity(k)
+        for t in 0.1, 3.0:
+            stash = IterationStash(op)
+            actual = _expm_product_helper_inplace(op, mu, stash, t, B)
+            assert_allclose(actual, expm(M*t).dot(B), atol=1e-13)
@@ -0,0 +1,481 @@
+"""
+Test the spectral backends for time-reversible and diagonalizable processes.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+from itertools import permutations, product
+
+import numpy as np
+from numpy.testing import assert_, assert_allclose, assert_equal
+
+from scipy.linalg import expm, expm_frechet
+
+from jsonctmctree import impl_naive, impl_v2
+from jsonctmctree.common_unpacking_ex import (
+        TopLevel, gen_valid_extended_properties)
+from jsonctmctree.expm_helpers import (
+        ActionExpm, ReversibleExpm,
+        SpectralExpmFrechet,
+        ReversibleExpmFrechet,
+        ImplicitDwellExpmFrechet,
+        ImplicitTransitionExpmFrechetEx,
+        ImplicitTransitionExpmFrechetStack,
+        get_reversible_stationary_distribution,
+        get_spectral_factors,
+        create_expm_object,
+        create_dwell_expm_frechet,
+        create_transition_expm_frechet,
+        create_transition_expm_frechet_stack,
+        )
+from jsonctmctree.pyexp.cost_model import CostModel
+from jsonctmctree.testutil import (
+        sample_symmetric_rates,
+        sample_time_reversible_rate_matrix,
+        sample_time_nonreversible_rate_matrix)
+from jsonctmctree.tests.test_site_patterns import (
+        _get_scene_with_repeated_patterns, _get_request)
+
+
+def _get_sparse_process(Q, state_space_shape):
+    states = list(product(*[range(k) for k in state_space_shape]))
+    row_states, column_states, rates = [], [], []
+    for i, j in permutations(range(len(states)), 2):
+        row_states.append(states[i])
+        column_states.append(states[j])
+        rates.append(Q[i, j])
+    return np.array(row_states), np.array(column_states), np.array(rates)
+
+
+def test_reversible_detection():
+    np.random.seed(1234)
+    Q, d = sample_time_reversible_rate_matrix(6)
+    assert_allclose(get_reversible_stationary_distribution(Q), d)
+    Q, d = sample_time_nonreversible_rate_matrix(6)
+    assert_(get_reversible_stationary_distribution(Q) is None)
+
+
+def test_reversible_cost_model():
+    # The time-reversible decomposition is used only if the cost model
+    # predicts that it is cheaper than sparse matrix exponential actions.
+    np.random.seed(1234)
+    state_space_shape = np.array([2, 3])
+    Q, d = sample_time_reversible_rate_matrix(6)
+    row, col, rate = _get_sparse_process(Q, state_space_shape)
+    dense_model = CostModel(dense_flop_time=0, call_overhead=0)
+    abstract_model = CostModel(sparse_flop_time=0, call_overhead=0)
+    small_model = CostModel(max_dense_nstates=5)
+    for cost_model, expm_class in (
+            (dense_model, ReversibleExpm),
+            (abstract_model, ActionExpm),
+            (small_model, ActionExpm)):
+        expm_object = create_expm_object(
+                state_space_shape, row, col, rate, cost_model=cost_model)
+        assert_(isinstance(expm_object, expm_class))
+
+
+def test_reversible_conditioning():
+    # A stationary probability near zero makes the eigenvectors
+    # of the time-reversible decomposition ill-conditioned,
+    # so the sparse matrix exponential actions are used instead.
+    np.random.seed(1234)
+    state_space_shape = np.array([4])
+    dense_model = CostModel(dense_flop_time=0, call_overhead=0)
+    S = sample_symmetric_rates(4)
+    for tiny, expm_class in (1e-3, ReversibleExpm), (1e-9, ActionExpm):
+        d = np.array([tiny, 1, 2, 3])
+        d /= d.sum()
+        Q = S * d
+        Q -= np.diag(Q.sum(axis=1))
+        row, col, rate = _get_sparse_process(Q, state_space_shape)
+        assert_allclose(get_reversible_stationary_distribution(Q), d,
+                atol=1e-12)
+        expm_object = create_expm_object(
+                state_space_shape, row, col, rate, cost_model=dense_model)
+        assert_(isinstance(expm_object, expm_class))
+        A = np.identity(4)
+        for t in 0.1, 2.0:
+            assert_allclose(expm_object.expm_mul(t, A), expm(Q * t),
+                    rtol=1e-12, atol=1e-14)
+
+
+def test_reversible_vs_action():
+    np.random.seed(1234)
+    state_space_shape = np.array([2, 3])
+    Q, d = sample_time_reversible_rate_matrix(6)
+    row, col, rate = _get_sparse_process(Q, state_space_shape)
+    desired = ActionExpm(state_space_shape, row, col, rate)
+    actual = create_expm_object(state_space_shape, row, col, rate)
+    assert_(isinstance(actual, ReversibleExpm))
+    A = np.random.randn(6, 4)
+    for t in 0.0, 0.1, 2.0:
+        for name in 'expm_mul', 'rate_mul':
+            assert_allclose(
+                    getattr(actual, name)(t, A),
+                    getattr(desired, name)(t, A), atol=1e-12)
+        assert_allclose(
+                actual.expm_rmul(t, A.T),
+                desired.expm_rmul(t, A.T), atol=1e-12)
+
+    # Compare the Frechet products for dwell and transition expectations.
+    s_state = np.array([[0, 0], [1, 2]])
+    s_weight = np.array([1.0, 2.0])
+    expect_rate = np.random.rand(len(rate))
+    pairs = (
+            (
+                create_dwell_expm_frechet(
+                    actual, state_space_shape, row, col, rate,
+                    s_state, s_weight),
+                ImplicitDwellExpmFrechet(
+                    state_space_shape, row, col, rate,
+                    s_state, s_weight)),
+            (
+                create_transition_expm_frechet(
+                    actual, state_space_shape, row, col, rate,
+                    row, col, expect_rate),
+                ImplicitTransitionExpmFrechetEx(
+                    state_space_shape, row, col, rate,
+                    row, col, expect_rate)),
+            )
+    for a, b in pairs:
+        for t in 0.0, 0.1, 2.0:
+            for x, y in zip(
+                    a.get_expm_frechet_product(t, A),
+                    b.get_expm_frechet_product(t, A)):
+                assert_allclose(x, y, atol=1e-12)
+
+
+def _get_k80_process(kappa):
+    # The Kimura two-parameter model on the states A, C, G, T.
+    row_states, column_states, rates = [], [], []
+    for i, j in permutations(range(4), 2):
+        row_states.append([i])
+        column_states.append([j])
+        rates.append(kappa if {i, j} in ({0, 2}, {1, 3}) else 1.0)
+    return dict(
+            row_states=row_states,
+            column_states=column_states,
+            transition_rates=rates)
+
+
+def test_reversible_zero_rate():
+    # The transition matrix of a zero length edge is exactly the identity.
+    np.random.seed(1234)
+    p = _get_k80_process(2.0)
+    args = (np.array([4]), np.array(p['row_states']),
+            np.array(p['column_states']), np.array(p['transition_rates']))
+    expm_object = ReversibleExpm(*args)
+    A = np.random.rand(4, 3)
+    assert_equal(expm_object.expm_mul(0, A), A)
+    assert_equal(expm_object.expm_rmul(0, A.T), A.T)
+    assert_equal(expm_object.rate_mul(0, A), np.zeros_like(A))
+
+    # Mismatched observations at the ends of a zero length edge
+    # are infeasible.
+    scene = dict(
+            node_count=3,
+            process_count=1,
+            state_space_shape=[4],
+            tree=dict(
+                row_nodes=[0, 0],
+                column_nodes=[1, 2],
+                edge_rate_scaling_factors=[0.0, 0.5],
+                edge_processes=[0, 0]),
+            root_prior=dict(
+                states=[[0], [1], [2], [3]],
+                probabilities=[0.25, 0.25, 0.25, 0.25]),
+            process_definitions=[p],
+            observed_data=dict(
+                nodes=[0, 1],
+                variables=[0, 0],
+                iid_observations=[[0, 1], [2, 2]]))
+    j_in = dict(scene=scene, requests=[dict(property='snnlogl')])
+    j_out_naive = impl_naive.process_json_in(j_in)
+    j_out_v2 = impl_v2.process_json_in(j_in)
+    assert_equal(j_out_naive['status'], 'infeasible')
+    assert_equal(j_out_v2, j_out_naive)
+
+
+def test_reversible_scene_vs_naive():
+    # Replace the first process of the scene by a reversible process.
+    np.random.seed(1234)
+    scene = _get_scene_with_repeated_patterns()
+    Q, d = sample_time_reversible_rate_matrix(4)
+    row, col, rate = _get_sparse_process(Q, scene['state_space_shape'])
+    scene['process_definitions'][0] = dict(
+            row_states=row.tolist(),
+            column_states=col.tolist(),
+            transition_rates=rate.tolist())
+    for extended_property in gen_valid_extended_properties():
+        j_in = dict(
+                scene=scene,
+                requests=[_get_request(extended_property)])
+        j_out_naive = impl_naive.process_json_in(j_in)
+        j_out_v2 = impl_v2.process_json_in(j_in)
+        assert_allclose(j_out_v2['responses'], j_out_naive['responses'])
+
+
+def test_reversible_long_edges_vs_naive():
+    # The scaled eigenvalues of long edges are far apart,
+    # and the divided differences of exp must not overflow.
+    np.random.seed(1234)
+    scene = _get_scene_with_repeated_patterns()
+    Q, d = sample_time_reversible_rate_matrix(4)
+    row, col, rate = _get_sparse_process(Q, scene['state_space_shape'])
+    scene['process_definitions'][0] = dict(
+            row_states=row.tolist(),
+            column_states=col.tolist(),
+            transition_rates=rate.tolist())
+    # Only the first edge uses the reversible process.
+    # The naive expectations are slow on long edges,
+    # so the reduced expectations are not compared.
+    scene['tree']['edge_rate_scaling_factors'][0] = 250.0
+    for extended_property in gen_valid_extended_properties():
+        if extended_property[:2] != 'dd' and extended_property[-4:] not in (
+                'logl', 'deri'):
+            continue
+        j_in = dict(
+                scene=scene,
+                requests=[_get_request(extended_property)])
+        j_out_naive = impl_naive.process_json_in(j_in)
+        j_out_v2 = impl_v2.process_json_in(j_in)
+        assert_(np.all(np.isfinite(j_out_v2['responses'][0])))
+        # The derivatives with respect to the saturated edge rates
+        # are zero up to rounding.
+        assert_allclose(j_out_v2['responses'], j_out_naive['responses'],
+                atol=1e-10)
+
+
+def test_reversible_scene_without_spectral():
+    # Replace the first process of the scene by a reversible process,
+    # and compare the expectations with and without the spectral backend.
+    np.random.seed(1234)
+    scene = _get_scene_with_repeated_patterns()
+    Q, d = sample_time_reversible_rate_matrix(4)
+    row, col, rate = _get_sparse_process(Q, scene['state_space_shape'])
+    scene['process_definitions'][0] = dict(
+            row_states=row.tolist(),
+            column_states=col.tolist(),
+            transition_rates=rate.tolist())
+
+    # Without the spectral backend the reversible process
+    # uses the implicit Frechet objects.
+    expm_object = create_expm_object(
+            np.array(scene['state_space_shape']), row, col, rate)
+    assert_(isinstance(expm_object, ReversibleExpm))
+    args = (expm_object, np.array(scene['state_space_shape']), row, col, rate)
+    s_state, s_weight = row[:1], np.ones(1)
+    assert_(isinstance(
+        create_dwell_expm_frechet(*args + (s_state, s_weight),
+            spectral=False),
+        ImplicitDwellExpmFrechet))
+    assert_(isinstance(
+        create_transition_expm_frechet(*args + (row, col, rate),
+            spectral=False),
+        ImplicitTransitionExpmFrechetEx))
+    assert_(isinstance(
+        create_transition_expm_frechet_stack(*args + ([(row, col, rate)], ),
+            spectral=False),
+        ImplicitTransitionExpmFrechetStack))
+
+    for extended_property in gen_valid_extended_properties():
+        if extended_property[-4:] not in ('dwel', 'tran'):
+            continue
+        j_in = dict(
+                scene=scene,
+                requests=[_get_request(extended_property)])
+        outputs = []
+        for spectral in True, False:
+            toplevel = TopLevel(j_in)
+            reactor = impl_v2.Reactor(toplevel.scene, spectral=spectral)
+            assert_(isinstance(reactor.expm_objects[0], ReversibleExpm))
+            outputs.append(reactor.main(toplevel.requests))
+        assert_allclose(outputs[0]['responses'], outputs[1]['responses'])
+
+
+def test_spectral_vs_implicit():
+    # Compare the closed form Frechet products of a nonreversible process
+    # to the implicit Frechet products.
+    np.random.seed(1234)
+    state_space_shape = np.array([2, 3])
+    Q, d = sample_time_nonreversible_rate_matrix(6)
+    row, col, rate = _get_sparse_process(Q, state_space_shape)
+    expm_object = create_expm_object(state_space_shape, row, col, rate)
+    assert_(isinstance(expm_object, ActionExpm))
+    factors = get_spectral_factors(
+            expm_object, state_space_shape, row, col, rate)
+    assert_(factors is not None)
+    A = np.random.randn(6, 4)
+    s_state = np.array([[0, 0], [1, 2]])
+    s_weight = np.array([1.0, 2.0])
+    expect_rate = np.random.rand(len(rate))
+    pairs = (
+            (
+                create_dwell_expm_frechet(
+                    expm_object, state_space_shape, row, col, rate,
+                    s_state, s_weight, spectral_factors=factors),
+                ImplicitDwellExpmFrechet(
+                    state_space_shape, row, col, rate,
+                    s_state, s_weight)),
+            (
+                create_transition_expm_frechet(
+                    expm_object, state_space_shape, row, col, rate,
+                    row, col, expect_rate, spectral_factors=factors),
+                ImplicitTransitionExpmFrechetEx(
+                    state_space_shape, row, col, rate,
+                    row, col, expect_rate)),
+            )
+    for a, b in pairs:
+        assert_(isinstance(a, SpectralExpmFrechet))
+        for t in 0.0, 0.1, 2.0:
+            for x, y in zip(
+                    a.get_expm_frechet_product(t, A),
+                    b.get_expm_frechet_product(t, A)):
+                assert_(np.isrealobj(x))
+                assert_allclose(x, y, atol=1e-12)
+
+
+def test_spectral_frechet_long_edges():
+    # Compare the closed form Frechet products to scipy
+    # at scaled eigenvalues that are far apart.
+    np.random.seed(1234)
+    state_space_shape = np.array([6])
+    A = np.random.randn(6, 4)
+    E = np.random.rand(6, 6)
+    for sample in (
+            sample_time_reversible_rate_matrix,
+            sample_time_nonreversible_rate_matrix):
+        Q, d = sample(6)
+        row, col, rate = _get_sparse_process(Q, state_space_shape)
+        expm_object = create_expm_object(
+                state_space_shape, row, col, rate,
+                cost_model=CostModel(dense_flop_time=0))
+        if isinstance(expm_object, ReversibleExpm):
+            obj = ReversibleExpmFrechet(expm_object, E)
+        else:
+            factors = get_spectral_factors(
+                    expm_object, state_space_shape, row, col, rate)
+            obj = SpectralExpmFrechet(factors, E)
+        # The eigenvalues of the sampled rate matrices are on the order
+        # of -1 to -10, so the longer edges have gaps beyond 709.
+        for t in 0.1, 250.0, 1000.0:
+            P, K = expm_frechet(Q * t, E * t)
+            PA, KA = obj.get_expm_frechet_product(t, A)
+            assert_allclose(PA, P.dot(A), atol=1e-12)
+            assert_allclose(KA, K.dot(A), rtol=1e-8, atol=1e-10)
+
+
+def test_spectral_scene_vs_implicit():
+    # Replace the first process of the scene by a nonreversible process,
+    # and compare the expectations with and without the spectral backend.
+    np.random.seed(1234)
+    scene = _get_scene_with_repeated_patterns()
+    Q, d = sample_time_nonreversible_rate_matrix(4)
+    row, col, rate = _get_sparse_process(Q, scene['state_space_shape'])
+    scene['process_definitions'][0] = dict(
+            row_states=row.tolist(),
+            column_states=col.tolist(),
+            transition_rates=rate.tolist())
+    for extended_property in gen_valid_extended_properties():
+        if extended_property[-4:] not in ('dwel', 'tran'):
+            continue
+        j_in = dict(
+                scene=scene,
+                requests=[_get_request(extended_property)])
+        outputs = []
+        for spectral in True, False:
+            toplevel = TopLevel(j_in)
+            reactor = impl_v2.Reactor(toplevel.scene, spectral=spectral)
+            outputs.append(reactor.main(toplevel.requests))
+        assert_allclose(outputs[0]['responses'], outputs[1]['responses'])
+
+
+def test_transition_stacks():
+    # Compare the Frechet products of several transition reductions
+    # computed at once to the products computed one reduction at a time.
+    np.random.seed(1234)
+    state_space_shape = np.array([2, 3])
+    A = np.random.randn(6, 4)
+    for sample in (
+            sample_time_reversible_rate_matrix,
+            sample_time_nonreversible_rate_matrix):
+        Q, d = sample(6)
+        row, col, rate = _get_sparse_process(Q, state_space_shape)
+        expm_object = create_expm_object(state_space_shape, row, col, rate)
+        factors = get_spectral_factors(
+                expm_object, state_space_shape, row, col, rate)
+        reductions = [
+                (row, col, np.random.rand(len(rate))),
+                (row[:5], col[:5], np.random.rand(5)),
+                (row[-3:], col[-3:], np.random.rand(3))]
+        for spectral_factors in factors, None:
+            stack = create_transition_expm_frechet_stack(
+                    expm_object, state_space_shape, row, col, rate,
+                    reductions, spectral_factors=spectral_factors)
+            for t in 0.0, 0.1, 2.0, 250.0:
+                PA, KAs = stack.get_expm_frechet_products(t, A)
+                assert_equal(len(KAs), len(reductions))
+                for KA, reduction in zip(KAs, reductions):
+                    obj = ImplicitTransitionExpmFrechetEx(
+                            state_space_shape, row, col, rate, *reduction)
+                    desired = obj.get_expm_frechet_product(t, A)
+                    assert_(np.isrealobj(KA))
+                    assert_allclose(PA, desired[0], atol=1e-12)
+                    assert_allclose(KA, desired[1], atol=1e-12)
+
+
+def test_grouped_transition_requests():
+    # Requests that share a transition reduction up to the order,
+    # duplication, and zero weights of its transitions are grouped,
+    # and their responses match the responses to separate requests.
+    scene = _get_scene_with_repeated_patterns()
+    request = _get_request('ddntran')
+    r = request['transition_reduction']
+    shuffled = dict(
+            row_states=r['row_states'][::-1] + [[0, 0], [1, 1]],
+            column_states=r['column_states'][::-1] + [[1, 1], [0, 0]],
+            weights=r['weights'][::-1] + [0, 0])
+    split = dict(
+            row_states=r['row_states'] + [[0, 0]],
+            column_states=r['column_states'] + [[1, 1]],
+            weights=[0.5] + r['weights'][1:] + [0.5])
+    other = dict(
+            row_states=[[1, 1], [0, 1]],
+            column_states=[[0, 0], [1, 1]],
+            weights=[1, 1])
+    requests = [request]
+    for extended_property in 'swntran', 'dsntran', 'wwntran':
+        request = _get_request(extended_property)
+        requests.append(request)
+        for reduction in shuffled, split, other:
+            request = dict(request, transition_reduction=reduction)
+            requests.append(request)
+    toplevel = TopLevel(dict(scene=scene, requests=requests))
+    keys = set(impl_v2._get_transition_reduction_key(
+        toplevel.scene.state_space_shape, request.transition_reduction)
+        for request in toplevel.requests)
+    assert_equal(len(keys), 2)
+    for spectral in True, False:
+        reactor = impl_v2.Reactor(toplevel.scene, spectral=spectral)
+        grouped = reactor.main(toplevel.requests)
+        assert_equal(grouped['status'], 'feasible')
+        for request, actual in zip(requests, grouped['responses']):
+            j_in = dict(scene=scene, requests=[request])
+            desired = impl_naive.process_json_in(j_in)['responses'][0]
+            assert_allclose(actual, desired)
+
+    # The grouped spectral expectations are also accurate on long edges.
+    # The naive implementation is slow on long edges,
+    # so only one request of each group is compared.
+    tree = scene['tree']
+    tree['edge_rate_scaling_factors'] = [
+            250 * r for r in tree['edge_rate_scaling_factors']]
+    toplevel = TopLevel(dict(scene=scene, requests=requests))
+    reactor = impl_v2.Reactor(toplevel.scene)
+    grouped = reactor.main(toplevel.requests)
+    for i in 0, 4:
+        j_in = dict(scene=scene, requests=[requests[i]])
+        desired = impl_naive.process_json_in(j_in)['responses'][0]
+        actual = grouped['responses'][i]
+        assert_(np.all(np.isfinite(actual)))
+        assert_allclose(actual, desired)
@@ -0,0 +1,128 @@
+"""
+Test the persistent session for repeated requests on a changing scene.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import copy
+
+import numpy as np
+from numpy.testing import assert_, assert_allclose, assert_equal, assert_raises
+
+from jsonctmctree import interface, extras
+from jsonctmctree.common_unpacking_ex import ContentError
+from jsonctmctree.session import Session
+from jsonctmctree.tests.test_site_patterns import (
+        _get_scene_with_repeated_patterns, _get_request)
+
+
+_PROPERTIES = ('snnlogl', 'ddnderi', 'wwwdwel', 'wsntran', 'dnwroot')
+
+
+def _check_responses(session, scene):
+    requests = [_get_request(p) for p in _PROPERTIES]
+    j_in = dict(scene=scene, requests=requests)
+    desired = interface.process_json_in(j_in)
+    actual = session.process_requests(requests)
+    assert_equal(actual['status'], desired['status'])
+    if desired['responses'] is None:
+        assert_(actual['responses'] is None)
+        return
+    for a, b in zip(actual['responses'], desired['responses']):
+        assert_allclose(a, b)
+
+
+def test_session_updates():
+    scene = _get_scene_with_repeated_patterns()
+    session = Session(scene)
+    _check_responses(session, scene)
+    reactor = session._reactor
+    T = reactor.T
+    observation_indices = dict(reactor._observation_indices)
+    assert_(observation_indices)
+    expm_objects = list(reactor.expm_objects)
+
+    # Change the edge rates.
+    # A zero rate makes some observations infeasible.
+    for rates in [0.5, 1.0, 0.0, 3.0], [0.5, 1.0, 0.25, 3.0]:
+        scene['tree']['edge_rate_scaling_factors'] = rates
+        session.update(edge_rate_scaling_factors=rates)
+        _check_responses(session, scene)
+    assert_equal(session.process_requests([])['status'], 'feasible')
+
+    # Change the rates of one process.
+    p = scene['process_definitions'][1]
+    p['transition_rates'] = [2 * r for r in p['transition_rates']]
+    session.update(process_definitions=scene['process_definitions'])
+    _check_responses(session, scene)
+    assert_(reactor.expm_objects[0] is expm_objects[0])
+    assert_(reactor.expm_objects[1] is not expm_objects[1])
+    assert_(reactor.expm_objects[2] is expm_objects[2])
+
+    # Change the root prior.
+    scene['root_prior'] = dict(
+            states=[[0, 0], [1, 1]],
+            probabilities=[0.4, 0.6])
+    session.update(root_prior=scene['root_prior'])
+    _check_responses(session, scene)
+
+    # The tree and the observation index have been reused.
+    assert_(session._reactor is reactor)
+    assert_(reactor.T is T)
+    for key, value in observation_indices.items():
+        assert_(reactor._observation_indices[key] is value)
+
+
+def test_session_set_scene():
+    scene = _get_scene_with_repeated_patterns()
+    session = Session(scene)
+    reactor = session._reactor
+
+    # A scene that differs only in its rates is updated in place.
+    scene = copy.deepcopy(scene)
+    scene['tree']['edge_rate_scaling_factors'] = [2.0, 1.0, 1.0, 0.5]
+    session.set_scene(scene)
+    assert_(session._reactor is reactor)
+    _check_responses(session, scene)
+
+    # A scene with different observations starts over.
+    scene = copy.deepcopy(scene)
+    scene['observed_data']['iid_observations'] = (
+            scene['observed_data']['iid_observations'][::-1])
+    session.set_scene(scene)
+    assert_(session._reactor is not reactor)
+    _check_responses(session, scene)
+
+
+def test_session_bad_updates():
+    session = Session(_get_scene_with_repeated_patterns())
+    assert_raises(ContentError, session.update,
+            edge_rate_scaling_factors=[1.0, 1.0])
+    assert_raises(ContentError, session.update,
+            edge_rate_scaling_factors=[1.0, -1.0, 1.0, 1.0])
+    assert_raises(ContentError, session.update,
+            process_definitions=[])
+    assert_raises(ContentError, session.update,
+            root_prior=dict(states=[[0, 0]]))
+
+
+def test_mixed_gradient_objective():
+    # The objective and the edge derivatives computed through a session
+    # should match those computed from the full scene.
+    scene = _get_scene_with_repeated_patterns()
+    process_definitions = scene['process_definitions']
+    root_prior = scene['root_prior']
+    B = np.log([0.5, 1.0, 2.0, 3.0])
+    y, dydX = extras._mixed_gradient_objective(
+            False, Session(scene), None,
+            lambda P: process_definitions,
+            lambda P: root_prior,
+            0, len(B), B)
+    scene = copy.deepcopy(scene)
+    scene['tree']['edge_rate_scaling_factors'] = np.exp(B).tolist()
+    j_in = dict(
+            scene=scene,
+            requests=[dict(property='snnlogl'), dict(property='sdnderi')])
+    logl, deri = interface.process_json_in(j_in)['responses']
+    assert_allclose(y, -logl)
+    assert_allclose(dydX, [-x for x in deri])
@@ -0,0 +1,154 @@
+"""
+Test the compression of iid observations into distinct patterns.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import copy
+
+import numpy as np
+from numpy.testing import assert_, assert_equal, assert_allclose
+
+from jsonctmctree import impl_naive, impl_v2
+from jsonctmctree.common_patterns import get_unique_rows
+from jsonctmctree.common_unpacking_ex import (
+        TopLevel, gen_valid_extended_properties)
+from jsonctmctree.tests.test_vs_naive import _get_scene
+
+
+def _get_scene_with_repeated_patterns():
+    # Repeat some of the observation patterns, out of order.
+    scene = copy.deepcopy(_get_scene())
+    rows = scene['observed_data']['iid_observations']
+    scene['observed_data']['iid_observations'] = [
+            rows[i] for i in (3, 0, 3, 1, 4, 0, 2, 3)]
+    return scene
+
+
+def _get_request(extended_property):
+    prefix = extended_property[:3]
+    core_property = extended_property[-4:]
+    observation_code, edge_code, state_code = prefix
+    request = dict(property=extended_property)
+    if observation_code == 'w':
+        request['observation_reduction'] = dict(
+                observation_indices=[0, 1, 2, 7, 5, 2],
+                weights=[0.1, 0.1, 0.2, 0.3, 0.5, 0.8])
+    if edge_code == 'w':
+        request['edge_reduction'] = dict(
+                edges=[0, 3, 2],
+                weights=[0.4, 0.5, 2.0])
+    if state_code == 'w':
+        request['state_reduction'] = dict(
+                states=[[0, 0], [0, 1], [1, 0]],
+                weights=[3, 3, 3])
+    if core_property == 'tran':
+        request['transition_reduction'] = dict(
+                row_states = [[0, 0], [0, 1], [1, 0]],
+                column_states = [[1, 1], [1, 1], [0, 1]],
+                weights = [1, 2, 3])
+    return request
+
+
+def test_get_unique_rows():
+    A = np.array([
+        [1, 0, 2],
+        [0, 0, 0],
+        [1, 0, 2],
+        [0, 1, 0],
+        [0, 0, 0],
+        [1, 0, 2]])
+    unique_rows, inverse, counts = get_unique_rows(A)
+    assert_equal(unique_rows, [[0, 0, 0], [0, 1, 0], [1, 0, 2]])
+    assert_equal(unique_rows[inverse], A)
+    assert_equal(counts, [2, 1, 3])
+
+
+def test_get_unique_rows_degenerate():
+    unique_rows, inverse, counts = get_unique_rows(np.zeros((3, 0), int))
+    assert_equal(unique_rows.shape, (1, 0))
+    assert_equal(inverse, [0, 0, 0])
+    assert_equal(counts, [3])
+    unique_rows, inverse, counts = get_unique_rows(np.zeros((0, 2), int))
+    assert_equal(unique_rows.shape, (0, 2))
+    assert_equal(inverse.shape, (0, ))
+    assert_equal(counts.shape, (0, ))
+
+
+def test_repeated_patterns_vs_naive():
+    scene = _get_scene_with_repeated_patterns()
+    for extended_property in gen_valid_extended_properties():
+        j_in = dict(
+                scene=scene,
+                requests=[_get_request(extended_property)])
+        j_out_naive = impl_naive.process_json_in(j_in)
+        j_out_v2 = impl_v2.process_json_in(j_in)
+        assert_equal(j_out_v2['status'], 'feasible')
+        assert_allclose(j_out_naive['responses'], j_out_v2['responses'])
+
+
+def test_chunked_vs_unchunked():
+    scene = _get_scene_with_repeated_patterns()
+    chunk_kwargs = (
+            dict(max_sites_per_chunk=1),
+            dict(max_sites_per_chunk=2),
+            dict(memory_budget_bytes=1),
+            )
+    for extended_property in gen_valid_extended_properties():
+        j_in = dict(
+                scene=scene,
+                requests=[_get_request(extended_property)])
+        j_out = impl_v2.process_json_in(j_in)
+        for kwargs in chunk_kwargs:
+            j_out_chunked = impl_v2.process_json_in(j_in, **kwargs)
+            assert_equal(j_out_chunked['status'], 'feasible')
+            assert_allclose(j_out_chunked['responses'], j_out['responses'])
+
+
+def test_chunked_observation_indices():
+    # Only the observation index of the current block is kept.
+    scene = _get_scene_with_repeated_patterns()
+    j_in = dict(scene=scene, requests=[_get_request('ddnderi')])
+    toplevel = TopLevel(j_in)
+    reactor = impl_v2.Reactor(toplevel.scene, max_sites_per_chunk=2)
+    for i in range(2):
+        reactor.main(toplevel.requests)
+        assert_(reactor.observation_index is not None)
+        assert_equal(reactor._observation_indices, {})
+
+
+def test_threaded_vs_serial():
+    scene = _get_scene_with_repeated_patterns()
+    for extended_property in gen_valid_extended_properties():
+        j_in = dict(
+                scene=scene,
+                requests=[_get_request(extended_property)])
+        j_out = impl_v2.process_json_in(j_in)
+        j_out_threaded = impl_v2.process_json_in(j_in, nworkers=3)
+        assert_equal(j_out_threaded['status'], 'feasible')
+        assert_allclose(j_out_threaded['responses'], j_out['responses'])
+
+
+def test_process_pool_vs_serial():
+    scene = _get_scene_with_repeated_patterns()
+    requests = [_get_request(p) for p in gen_valid_extended_properties()]
+    j_in = dict(scene=scene, requests=requests)
+    j_out = impl_v2.process_json_in(j_in, max_sites_per_chunk=2)
+    j_out_pool = impl_v2.process_json_in(j_in, nprocesses=3)
+    assert_equal(j_out_pool['status'], 'feasible')
+    assert_equal(j_out_pool['responses'], j_out['responses'])
+
+
+def test_process_pool_without_fork():
+    # Without forked worker processes the blocks are processed serially.
+    scene = _get_scene_with_repeated_patterns()
+    requests = [_get_request(p) for p in gen_valid_extended_properties()]
+    j_in = dict(scene=scene, requests=requests)
+    j_out = impl_v2.process_json_in(j_in, max_sites_per_chunk=2)
+    get_fork_context = impl_v2._get_fork_context
+    impl_v2._get_fork_context = lambda: None
+    try:
+        j_out_serial = impl_v2.process_json_in(j_in, nprocesses=3)
+    finally:
+        impl_v2._get_fork_context = get_fork_context
+    assert_equal(j_out_serial['responses'], j_out['responses'])
@@ -10,7 +10,7 @@ from __future__ import division, print_function, absolute_import
 import time
 
 import numpy as np
-from numpy.testing import assert_allclose, assert_equal
+from numpy.testing import assert_, assert_allclose, assert_equal
 
 from jsonctmctree import impl_naive, impl_v2
 from jsonctmctree.common_unpacking_ex import gen_valid_extended_properties
@@ -146,3 +146,54 @@ def test_all_properties():
         response_pairs = zip(j_out_naive['responses'], j_out_v2['responses'])
         for (response_naive, response_v2) in response_pairs:
             assert_allclose(response_naive, response_v2)
+
+
+def test_spectral_dwell_times():
+    # The dwell times of all states computed in one pass
+    # from the diagonalizations should match the per-state computation.
+    j_in = dict(
+            scene=_get_scene(),
+            requests=[dict(property='sdddwel'), dict(property='wdddwel',
+                observation_reduction=dict(
+                    observation_indices=[0, 1, 4],
+                    weights=[0.5, 1.0, 2.0]))])
+    toplevel = impl_v2.TopLevel(j_in)
+    reactor = impl_v2.Reactor(toplevel.scene)
+    j_out_spectral = reactor.main(toplevel.requests)
+    assert_(all(f is not None for f in reactor.spectral_factors))
+
+    # Disable the spectral pass.
+    toplevel = impl_v2.TopLevel(j_in)
+    reactor = impl_v2.Reactor(toplevel.scene, spectral=False)
+    j_out_per_state = reactor.main(toplevel.requests)
+
+    response_pairs = zip(
+            j_out_spectral['responses'], j_out_per_state['responses'])
+    for response_spectral, response_per_state in response_pairs:
+        assert_allclose(response_spectral, response_per_state)
+
+
+def test_spectral_dwell_times_long_edges():
+    # The dwell times on long edges, whose scaled eigenvalues
+    # are far apart, should match the naive implementation.
+    scene = _get_scene()
+    tree = scene['tree']
+    tree['edge_rate_scaling_factors'] = [
+            250 * r for r in tree['edge_rate_scaling_factors']]
+    j_in = dict(
+            scene=scene,
+            requests=[dict(property='ddddwel'), dict(property='wdddwel',
+                observation_reduction=dict(
+                    observation_indices=[0, 1, 4],
+                    weights=[0.5, 1.0, 2.0]))])
+    toplevel = impl_v2.TopLevel(j_in)
+    reactor = impl_v2.Reactor(toplevel.scene)
+    j_out_spectral = reactor.main(toplevel.requests)
+    assert_(all(f is not None for f in reactor.spectral_factors))
+    j_out_naive = impl_naive.process_json_in(j_in)
+
+    response_pairs = zip(
+            j_out_spectral['responses'], j_out_naive['responses'])
+    for response_spectral, response_naive in response_pairs:
+        assert_(np.all(np.isfinite(response_spectral)))
+        assert_allclose(response_spectral, response_naive)
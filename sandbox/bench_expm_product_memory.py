@@ -0,0 +1,82 @@
+"""
+Compare the peak memory of the allocating and the in-place Taylor loops.
+
+Each variant of the matrix exponential action is run in its own
+subprocess, and the peak resident set size of that subprocess is reported.
+The input block is created before the baseline is measured,
+so the reported increase is the memory used by the loop itself.
+
+Usage:
+    python bench_expm_product_memory.py [nstates [nsites]]
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import scipy.sparse
+
+from jsonctmctree.pyexp.ctmc_ops import (
+        RdOperator, _expm_product_helper, _expm_product_helper_inplace)
+from jsonctmctree.pyexp.experimental import IterationStash
+
+
+def _get_peak_rss_bytes():
+    # On linux ru_maxrss is in kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _sample_operator(nstates):
+    np.random.seed(1234)
+    density = min(1.0, 10 / nstates)
+    R = scipy.sparse.rand(nstates, nstates, density=density, format='csr')
+    d = -np.asarray(R.sum(axis=1)).ravel()
+    mu = np.mean(d)
+    return RdOperator(R, d - mu), mu
+
+
+def run_variant(variant, nstates, nsites):
+    f = {
+            'allocating' : _expm_product_helper,
+            'inplace' : _expm_product_helper_inplace,
+            }[variant]
+    A, mu = _sample_operator(nstates)
+    stash = IterationStash(A)
+    B = np.random.rand(nstates, nsites)
+    baseline = _get_peak_rss_bytes()
+    tm = time.time()
+    f(A, mu, stash, 2.0, B)
+    seconds = time.time() - tm
+    peak = _get_peak_rss_bytes()
+    print(peak - baseline, seconds)
+
+
+def main():
+    nstates = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    nsites = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    block_mb = nstates * nsites * 8 / 1e6
+    print('nstates:', nstates, 'nsites:', nsites,
+            'block size: %.1f MB' % block_mb)
+    results = {}
+    for variant in 'allocating', 'inplace':
+        out = subprocess.check_output([
+            sys.executable, __file__, '--variant', variant,
+            str(nstates), str(nsites)])
+        nbytes, seconds = out.split()
+        results[variant] = int(nbytes)
+        print('%-10s peak RSS increase: %8.1f MB  time: %.2f s' % (
+            variant, int(nbytes) / 1e6, float(seconds)))
+    saved = results['allocating'] - results['inplace']
+    print('peak RSS drop: %.1f MB (%.1f blocks)' % (
+        saved / 1e6, saved / (block_mb * 1e6)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--variant':
+        run_variant(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        main()